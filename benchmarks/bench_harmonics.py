@@ -0,0 +1,76 @@
+"""
+Benchmarks batched harmonic tide prediction csdllib.methods.harmonics.predict
+for many stations at once against predicting station by station (the
+shape of the per-station download path), on synthetic constituents.
+With --station, one CO-OPS 'predictions' download is timed as well.
+
+Usage:
+    python benchmarks/bench_harmonics.py [--stations 2000] [--days 30]
+                                         [--dt-min 6] [--chunk-mb 64]
+                                         [--station 8518750]
+
+@author: grapesh@gmail.com
+"""
+import os
+import sys
+import time
+import argparse
+from datetime import datetime, timedelta
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from csdllib.methods import harmonics
+
+#==============================================================================
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--stations', type=int, default=2000)
+    parser.add_argument('--days', type=float, default=30.)
+    parser.add_argument('--dt-min', type=float, default=6.)
+    parser.add_argument('--chunk-mb', type=float, default=64.)
+    parser.add_argument('--station', help='CO-OPS station to download')
+    args = parser.parse_args()
+
+    names = sorted(harmonics.CONSTITUENTS)
+    start = np.datetime64('2020-01-01T00:00')
+    times = start + np.arange(0., args.days*1440., args.dt_min).astype(
+                        'timedelta64[m]')
+    rng   = np.random.default_rng(0)
+    amp   = rng.uniform(0., 0.5, [args.stations, len(names)])
+    phase = rng.uniform(0., 360., [args.stations, len(names)])
+    chunk = int(args.chunk_mb*1024**2/8)
+    print(str(args.stations) + ' stations x ' + str(len(times)) +
+          ' times x ' + str(len(names)) + ' constituents')
+
+    t0 = time.time()
+    batch = harmonics.predict(times, names, amp, phase, chunk=chunk,
+                              verbose=0)
+    tBatch = time.time() - t0
+    print('  batched     : ' + str(round(tBatch, 2)).rjust(7) + ' s')
+
+    t0 = time.time()
+    loop = np.empty_like(batch)
+    for s in range(args.stations):
+        loop[s] = harmonics.predict(times, names, amp[s], phase[s],
+                                    chunk=chunk, verbose=0)
+    tLoop = time.time() - t0
+    print('  per station : ' + str(round(tLoop, 2)).rjust(7) + ' s')
+
+    assert np.allclose(batch, loop)
+    print('  results match; batched ' + str(round(tLoop/tBatch, 1)) +
+          'x faster')
+
+    if args.station:
+        from csdllib.data import coops
+        d0 = datetime(2020, 1, 1)
+        t0 = time.time()
+        obs = coops.getData(args.station,
+                            (d0, d0 + timedelta(days=args.days)),
+                            product='predictions')
+        tDown = time.time() - t0
+        print('  download of ' + str(len(obs['values'])) +
+              ' predictions at ' + args.station + ': ' +
+              str(round(tDown, 2)) + ' s, ' +
+              str(round(tDown*args.stations/tBatch, 0)) +
+              'x the batched time for all stations')
@@ -0,0 +1,211 @@
+"""
+Benchmarks the bulk fort.14 parser in csdllib.models.adcirc.readGrid
+against the original line-by-line loop on a synthetic mesh.
+
+Usage:
+    python benchmarks/bench_readgrid.py [--nx 1500] [--ny 1500] [--keep]
+
+@author: grapesh@gmail.com
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from csdllib.models import adcirc
+
+#==============================================================================
+def writeSyntheticGrid (gridFile, nx, ny):
+    """
+    Writes a regular triangulated nx-by-ny mesh with one elevation
+    boundary and flow boundaries of IBTYPE 0, 3, 4 and 5.
+    """
+    NP  = nx*ny
+    ids = np.arange(1, NP+1).reshape(ny, nx)
+    lon = np.tile(np.linspace(-98., -60., nx), ny)
+    lat = np.repeat(np.linspace(  8.,  46., ny), nx)
+    dep = np.linspace(-5., 5000., NP)
+
+    a = ids[:-1,:-1].ravel()
+    b = ids[:-1, 1:].ravel()
+    c = ids[ 1:, 1:].ravel()
+    d = ids[ 1:,:-1].ravel()
+    elements = np.vstack((np.column_stack((a, b, c)),
+                          np.column_stack((a, c, d))))
+    NE = len(elements)
+
+    elev  = ids[0, :]
+    land  = ids[-1, :]
+    weir  = ids[1:-1, 0]
+    half  = len(weir)//2
+    front = ids[1:1+half, 1]
+    back  = ids[1:1+half, 2]
+
+    with open(gridFile, 'w') as f:
+        f.write('synthetic mesh\n')
+        f.write(str(NE) + ' ' + str(NP) + '\n')
+        np.savetxt(f, np.column_stack((ids.ravel(), lon, lat, dep)),
+                   fmt='%d %.6f %.6f %.3f')
+        np.savetxt(f, np.column_stack((np.arange(1, NE+1),
+                                       3*np.ones(NE, dtype=int), elements)),
+                   fmt='%d')
+        f.write('1 = Number of open boundaries\n')
+        f.write(str(len(elev)) + ' = Total number of open boundary nodes\n')
+        f.write(str(len(elev)) + ' 0\n')
+        np.savetxt(f, elev, fmt='%d')
+        nvel = len(land) + len(weir) + 2*len(front)
+        f.write('4 = Number of land boundaries\n')
+        f.write(str(nvel) + ' = Total number of land boundary nodes\n')
+        f.write(str(len(land)) + ' 0\n')
+        np.savetxt(f, land, fmt='%d')
+        f.write(str(len(weir)) + ' 3\n')
+        np.savetxt(f, np.column_stack((weir, np.full(len(weir), 2.5),
+                                       np.full(len(weir), 1.0))),
+                   fmt='%d %.3f %.3f')
+        f.write(str(len(front)) + ' 4\n')
+        np.savetxt(f, np.column_stack((front, back,
+                                       np.full(len(front), 3.0),
+                                       np.full(len(front), 1.0),
+                                       np.full(len(front), 1.0))),
+                   fmt='%d %d %.3f %.3f %.3f')
+        f.write(str(len(front)) + ' 5\n')
+        np.savetxt(f, np.column_stack((front, back,
+                                       np.full(len(front), 3.0),
+                                       np.full(len(front), 1.0),
+                                       np.full(len(front), 1.0),
+                                       np.full(len(front), 0.5),
+                                       np.full(len(front), 0.02),
+                                       np.full(len(front), 0.3))),
+                   fmt='%d %d %.3f %.3f %.3f %.3f %.3f %.3f')
+    return NP, NE
+
+#==============================================================================
+def legacyReadGrid (gridFile):
+    """
+    The original line-by-line parser of readGrid, kept as a reference.
+    """
+    f  = open(gridFile)
+    myDesc     = f.readline().rstrip()
+    myNE, myNP = map(int, f.readline().split())
+    myPoints   = np.zeros([myNP,3], dtype=float)
+    myElements = np.zeros([myNE,3], dtype=int)
+    for k in range(myNP):
+        line            = f.readline().split()
+        myPoints[k,0] = float(line[1])
+        myPoints[k,1] = float(line[2])
+        myPoints[k,2] = float(line[3])
+    for k in range(myNE):
+        line              = f.readline().split()
+        myElements[k,0] = int (line[2])
+        myElements[k,1] = int (line[3])
+        myElements[k,2] = int (line[4])
+    myNOPE   = int(f.readline().split()[0])
+    myNETA   = int(f.readline().split()[0])
+    myNVDLL  = np.zeros([myNOPE], dtype=int)
+    myNBDV   = np.zeros([myNOPE, myNETA], dtype=int)
+    for k in range(myNOPE):
+        myNVDLL [k] = int(f.readline().split()[0])
+        for j in range(myNVDLL[k]):
+            myNBDV[k,j] = int(f.readline().strip())
+    myNBOU = int(f.readline().split()[0])
+    myNVEL = int(f.readline().split()[0])
+    myNVELL      = np.zeros([myNBOU], dtype=int)
+    myIBTYPE     = np.zeros([myNBOU], dtype=int)
+    names = ['NBVV', 'BARLANHT', 'BARLANCFSP', 'IBCONN', 'BARINHT',
+             'BARINCFSB', 'BARINCFSP', 'PIPEHT', 'PIPECOEF', 'PIPEDIAM']
+    ints  = ['NBVV', 'IBCONN']
+    a = {n: np.zeros([myNBOU, myNVEL], dtype=int if n in ints else float)
+         for n in names}
+    for k in range(myNBOU):
+        line = f.readline().split()
+        myNVELL[k]  = int(line[0])
+        myIBTYPE[k] = int(line[1])
+        for j in range(myNVELL[k]):
+            line = f.readline().rstrip().split()
+            if myIBTYPE[k] in   [0,1,2,10,11,12,20,21,22,30]:
+                cols = ['NBVV']
+            elif myIBTYPE[k] in [3,13,23]:
+                cols = ['NBVV', 'BARLANHT', 'BARLANCFSP']
+            elif myIBTYPE[k] in [4,24]:
+                cols = ['NBVV', 'IBCONN', 'BARINHT', 'BARINCFSB',
+                        'BARINCFSP']
+            elif myIBTYPE[k] in [5,25]:
+                cols = ['NBVV', 'IBCONN', 'BARINHT', 'BARINCFSB',
+                        'BARINCFSP', 'PIPEHT', 'PIPECOEF', 'PIPEDIAM']
+            else:
+                cols = []
+            for i, c in enumerate(cols):
+                a[c][k,j] = a[c].dtype.type(float(line[i]))
+    f.close()
+    return {'GridDescription'               : myDesc,
+            'NE'                            : myNE,
+            'NP'                            : myNP,
+            'lon'                           : np.squeeze(myPoints[:,0]),
+            'lat'                           : np.squeeze(myPoints[:,1]),
+            'depth'                         : np.squeeze(myPoints[:,2]),
+            'Elements'                      : np.squeeze(myElements),
+            'NETA'                          : myNETA,
+            'NOPE'                          : myNOPE,
+            'ElevationBoundaries'           : np.squeeze(myNBDV),
+            'NormalFlowBoundaries'          : np.squeeze(a['NBVV']),
+            'ExternalBarrierHeights'        : np.squeeze(a['BARLANHT']),
+            'ExternalBarrierCFSPs'          : np.squeeze(a['BARLANCFSP']),
+            'BackFaceNodeNormalFlow'        : np.squeeze(a['IBCONN']),
+            'InternalBarrierHeights'        : np.squeeze(a['BARINHT']),
+            'InternallBarrierCFSPs'         : np.squeeze(a['BARINCFSP']),
+            'InternallBarrierCFSBs'         : np.squeeze(a['BARINCFSB']),
+            'CrossBarrierPipeHeights'       : np.squeeze(a['PIPEHT']),
+            'BulkPipeFrictionFactors'       : np.squeeze(a['PIPECOEF']),
+            'CrossBarrierPipeDiameter'      : np.squeeze(a['PIPEDIAM'])
+            }
+
+#==============================================================================
+def compare (ref, new):
+    """
+    Checks that the new readGrid output holds all the legacy keys
+    with the same types and values.
+    """
+    for key in ref.keys():
+        if isinstance(ref[key], np.ndarray):
+            assert ref[key].dtype == new[key].dtype, key
+            assert ref[key].shape == new[key].shape, key
+            assert np.array_equal(ref[key], new[key]), key
+        else:
+            assert ref[key] == new[key], key
+
+#==============================================================================
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nx', type=int, default=1500)
+    parser.add_argument('--ny', type=int, default=1500)
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the synthetic fort.14')
+    args = parser.parse_args()
+
+    gridFile = os.path.join(tempfile.mkdtemp(), 'fort.14')
+    NP, NE = writeSyntheticGrid(gridFile, args.nx, args.ny)
+    print('Synthetic mesh: NP=' + str(NP) + ', NE=' + str(NE) + ', ' +
+          str(round(os.path.getsize(gridFile)/1e6, 1)) + ' MB')
+
+    t0  = time.time()
+    ref = legacyReadGrid(gridFile)
+    t1  = time.time()
+    # the legacy parser reads the boundaries too: compare like with like
+    new = adcirc.readGrid(gridFile, verbose=0, lazy=False)
+    t2  = time.time()
+    adcirc.readGrid(gridFile, verbose=0)
+    t3  = time.time()
+
+    compare(ref, new)
+    print('line loop  : ' + str(round(t1-t0, 2)) + ' s')
+    print('bulk parser: ' + str(round(t2-t1, 2)) + ' s')
+    print('speed-up   : ' + str(round((t1-t0)/(t2-t1), 1)) + 'x')
+    print('lazy (no boundaries): ' + str(round(t3-t2, 2)) + ' s')
+
+    if not args.keep:
+        os.remove(gridFile)
+        os.rmdir(os.path.dirname(gridFile))
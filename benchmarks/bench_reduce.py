@@ -0,0 +1,125 @@
+"""
+Benchmarks the streaming reduction csdllib.models.adcirc.reduceSurfaceField
+against reading the whole field with readSurfaceField and reducing it
+in memory, on a synthetic fort.63.nc. Each mode runs in its own process
+so that its peak resident memory can be reported.
+
+Usage:
+    python benchmarks/bench_reduce.py [--nt 240] [--np 500000]
+                                      [--chunk-mb 64] [--keep]
+
+@author: grapesh@gmail.com
+"""
+import os
+import sys
+import json
+import time
+import resource
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+import netCDF4
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+#==============================================================================
+def writeSyntheticField (ncFile, NT, NP, dryFraction=0.1):
+    """
+    Writes fort.63.nc-like file with a tide-like zeta(time, node),
+    a fraction of the nodes dry (fill value) at every time step.
+    """
+    nc = netCDF4.Dataset(ncFile, 'w')
+    nc.createDimension('time', None)
+    nc.createDimension('node', NP)
+    tim = nc.createVariable('time', 'f8', ('time',))
+    tim.base_date = '2020-01-01 00:00:00'
+    x   = nc.createVariable('x', 'f8', ('node',))
+    y   = nc.createVariable('y', 'f8', ('node',))
+    z   = nc.createVariable('zeta', 'f8', ('time', 'node'),
+                            fill_value=-99999.)
+    x[:] = np.linspace(-98., -60., NP)
+    y[:] = np.linspace(  8.,  46., NP)
+    rng   = np.random.default_rng(0)
+    amp   = rng.uniform(0.2, 2.0, NP)
+    phase = rng.uniform(0., 2*np.pi, NP)
+    dry   = rng.random(NP) < dryFraction
+    for t in range(NT):
+        tim[t] = 3600.*t
+        v = amp*np.cos(2*np.pi*t/12.42 + phase)
+        v[dry & (v < 0.)] = -99999.
+        z[t] = v
+    nc.close()
+
+#==============================================================================
+def runMode (mode, ncFile, chunkBytes):
+    """
+    Runs one reduction, returns wall time and peak RSS (MB)
+    """
+    from csdllib.models import adcirc
+    t0 = time.time()
+    if mode == 'inmemory':
+        fld = adcirc.readSurfaceField(ncFile, 'zeta', verbose=0)['value']
+        out = {'max'  : np.nanmax(fld, axis=0).filled(np.nan),
+               'min'  : np.nanmin(fld, axis=0).filled(np.nan),
+               'mean' : np.nanmean(fld, axis=0).filled(np.nan)}
+    else:
+        out = adcirc.reduceSurfaceField(ncFile, 'zeta',
+                                        chunkBytes=chunkBytes, verbose=0)
+    wall = time.time() - t0
+    rss  = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.
+    return wall, rss, out
+
+#==============================================================================
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nt', type=int, default=240)
+    parser.add_argument('--np', type=int, default=500000)
+    parser.add_argument('--chunk-mb', type=float, default=64.)
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the synthetic fort.63.nc')
+    parser.add_argument('--mode', help=argparse.SUPPRESS)
+    parser.add_argument('--file', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    chunkBytes = int(args.chunk_mb*1024**2)
+
+    if args.mode:
+        import warnings
+        warnings.simplefilter('ignore')
+        wall, rss, out = runMode(args.mode, args.file, chunkBytes)
+        np.save(args.file + '.' + args.mode + '.npy',
+                np.stack([np.asarray(out[k], dtype=float)
+                          for k in ('max', 'min', 'mean')]))
+        print(json.dumps({'wall' : wall, 'rss' : rss}))
+        sys.exit(0)
+
+    ncFile = os.path.join(tempfile.mkdtemp(), 'fort.63.nc')
+    writeSyntheticField(ncFile, args.nt, args.np)
+    print('Synthetic field: NT=' + str(args.nt) + ', NP=' + str(args.np) +
+          ', ' + str(round(os.path.getsize(ncFile)/1e6, 1)) + ' MB')
+
+    res = dict()
+    for mode in ('inmemory', 'streaming'):
+        p = subprocess.run([sys.executable, __file__, '--mode', mode,
+                            '--file', ncFile,
+                            '--chunk-mb', str(args.chunk_mb)],
+                           stdout=subprocess.PIPE, check=True)
+        res[mode] = json.loads(p.stdout.decode().strip().splitlines()[-1])
+        print('  ' + mode.ljust(10) + ': ' +
+              str(round(res[mode]['wall'], 2)).rjust(7) + ' s, peak RSS ' +
+              str(round(res[mode]['rss'], 1)).rjust(8) + ' MB')
+
+    ref = np.load(ncFile + '.inmemory.npy')
+    new = np.load(ncFile + '.streaming.npy')
+    assert np.allclose(ref, new, equal_nan=True)
+    print('  results match; memory ' +
+          str(round(res['inmemory']['rss']/res['streaming']['rss'], 1)) +
+          'x lower, ' +
+          str(round(res['inmemory']['wall']/res['streaming']['wall'], 2)) +
+          'x faster')
+
+    if not args.keep:
+        for suffix in ('', '.inmemory.npy', '.streaming.npy'):
+            os.remove(ncFile + suffix)
+        os.rmdir(os.path.dirname(ncFile))
@@ -1,5 +1,10 @@
 from . import interp
 from . import statistics
 from . import convert
-__all__ = ['interp','statistics','convert']
+from . import topology
+from . import spatial
+from . import locate
+from . import weights
+from . import harmonics
+__all__ = ['interp','statistics','convert','topology','spatial','locate','weights','harmonics']
 
@@ -0,0 +1,355 @@
+"""
+Harmonic tide prediction and analysis for many stations (or mesh nodes)
+at once.
+
+Water level is the sum over constituents c of
+    f_c(t) A_c cos(V_c(t) + u_c(t) - G_c)
+with amplitude A and Greenwich phase lag G (e.g. CO-OPS harmonic
+constituents, 'phase GMT'), equilibrium argument V and nodal factors
+f, u after Schureman (1958), evaluated at every time step.
+Expanding the cosine turns the sum for all points into two matrix
+products, [points x constituents] @ [constituents x times], evaluated
+in time chunks to bound memory. The analysis fits amplitudes and
+phases of many series by least squares against one design matrix.
+
+@author: grapesh@gmail.com
+"""
+
+import numpy as np
+from csdllib import oper
+
+# Doodson-type multipliers of the equilibrium argument on
+# (T, s, h, p, p1), phase offset (deg) and nodal correction type
+CONSTITUENTS = {
+    'M2'   : ((2,-2, 2, 0, 0),    0., 'M2'),
+    'S2'   : ((2, 0, 0, 0, 0),    0., None),
+    'N2'   : ((2,-3, 2, 1, 0),    0., 'M2'),
+    'K2'   : ((2, 0, 2, 0, 0),    0., 'K2'),
+    'K1'   : ((1, 0, 1, 0, 0),  -90., 'K1'),
+    'O1'   : ((1,-2, 1, 0, 0),   90., 'O1'),
+    'P1'   : ((1, 0,-1, 0, 0),   90., None),
+    'Q1'   : ((1,-3, 1, 1, 0),   90., 'O1'),
+    'M4'   : ((4,-4, 4, 0, 0),    0., 'M2^2'),
+    'M6'   : ((6,-6, 6, 0, 0),    0., 'M2^3'),
+    'M8'   : ((8,-8, 8, 0, 0),    0., 'M2^4'),
+    'MK3'  : ((3,-2, 3, 0, 0),  -90., 'M2*K1'),
+    '2MK3' : ((3,-4, 3, 0, 0),   90., 'M2^2/K1'),
+    'S4'   : ((4, 0, 0, 0, 0),    0., None),
+    'S6'   : ((6, 0, 0, 0, 0),    0., None),
+    'MN4'  : ((4,-5, 4, 1, 0),    0., 'M2^2'),
+    'MS4'  : ((4,-2, 2, 0, 0),    0., 'M2'),
+    'NU2'  : ((2,-3, 4,-1, 0),    0., 'M2'),
+    'MU2'  : ((2,-4, 4, 0, 0),    0., 'M2'),
+    '2N2'  : ((2,-4, 2, 2, 0),    0., 'M2'),
+    'LAM2' : ((2,-1, 0, 1, 0),  180., 'M2'),
+    'L2'   : ((2,-1, 2,-1, 0),  180., 'L2'),
+    'T2'   : ((2, 0,-1, 0, 1),    0., None),
+    'R2'   : ((2, 0, 1, 0,-1),  180., None),
+    '2SM2' : ((2, 2,-2, 0, 0),    0., '1/M2'),
+    'S1'   : ((1, 0, 0, 0, 0),    0., None),
+    'M1'   : ((1,-1, 1, 1, 0),  -90., 'O1'),
+    'J1'   : ((1, 1, 1,-1, 0),  -90., 'J1'),
+    'OO1'  : ((1, 2, 1, 0, 0),  -90., 'OO1'),
+    'RHO'  : ((1,-3, 3,-1, 0),   90., 'O1'),
+    '2Q1'  : ((1,-4, 1, 2, 0),   90., 'O1'),
+    'M3'   : ((3,-3, 3, 0, 0),    0., 'M3'),
+    'MM'   : ((0, 1, 0,-1, 0),    0., 'Mm'),
+    'MF'   : ((0, 2, 0, 0, 0),    0., 'Mf'),
+    'MSF'  : ((0, 2,-2, 0, 0),    0., '1/M2'),
+    'SA'   : ((0, 0, 1, 0, 0),    0., None),
+    'SSA'  : ((0, 0, 2, 0, 0),    0., None),
+    }
+ALIASES = {'LDA2' : 'LAM2', 'RHO1' : 'RHO', 'MSM' : 'MM', 'SIG1' : None}
+
+# rates of T, s, h, p, p1 (deg/hour)
+RATES = np.array([15., 0.5490165, 0.0410686, 0.0046418, 0.0000020])
+J2000 = np.datetime64('2000-01-01T12:00:00')
+
+#==============================================================================
+def canonical (name):
+    """
+    Returns the name of the constituent as in CONSTITUENTS
+    """
+    key = str(name).strip().upper()
+    key = ALIASES.get(key, key)
+    if key not in CONSTITUENTS:
+        raise KeyError('Unknown tidal constituent ' + str(name))
+    return key
+
+#==============================================================================
+def speeds (names):
+    """
+    Returns angular speeds (deg/hour) of the constituents
+    """
+    d = np.array([CONSTITUENTS[canonical(n)][0] for n in names], dtype=float)
+    return d.reshape(-1, 5) @ RATES
+
+#==============================================================================
+def toHours (times):
+    """
+    Converts datetime64 or datetime array to hours since J2000
+    """
+    t = np.asarray(times)
+    if not np.issubdtype(t.dtype, np.datetime64):
+        t = t.astype('datetime64[s]')
+    return (t - J2000)/np.timedelta64(1, 'h')
+
+#==============================================================================
+def astro (hours):
+    """
+    Mean astronomical arguments (deg) at hours since J2000:
+    T (hour angle of the mean sun), s (moon), h (sun), p (lunar perigee),
+    N (lunar node), p1 (solar perigee)
+    """
+    c = np.asarray(hours, dtype=float)/(24.*36525.)
+    return {'T'  : 180. + 15.*(np.asarray(hours, dtype=float) + 12.),
+            's'  : 218.3164 + 481267.8812*c,
+            'h'  : 280.4661 +  36000.7698*c,
+            'p'  :  83.3535 +   4069.0137*c,
+            'N'  : 125.0445 -   1934.1363*c,
+            'p1' : 282.9384 +      1.7195*c}
+
+#==============================================================================
+def nodal (names, a):
+    """
+    Nodal factors after Schureman (1958)
+    Args:
+        names (list) : constituent names
+        a     (dict) : astro() arguments
+    Returns:
+        f, u (np.arrays [C, len(a['N'])]) : factor and angle (deg)
+    """
+    r  = np.radians
+    N  = r(np.atleast_1d(a['N']))
+    I  = np.arccos(0.91370 - 0.03569*np.cos(N))
+    nu = np.arcsin(0.08968*np.sin(N)/np.sin(I))
+    xi = N - 2.*np.arctan(0.64412*np.tan(N/2.)) - nu
+    nu1 = np.arctan2(np.sin(2*I)*np.sin(nu), np.sin(2*I)*np.cos(nu) + 0.3347)
+    nu2 = np.arctan2(np.sin(I)**2*np.sin(2*nu),
+                     np.sin(I)**2*np.cos(2*nu) + 0.0727)
+    P   = r(np.atleast_1d(a['p'])) - xi
+    tan2 = np.tan(I/2.)**2
+    Rinv = np.sqrt(1. - 12.*tan2*np.cos(2*P) + 36.*tan2**2)
+    R    = np.arctan2(np.sin(2*P), 1./(6.*tan2) - np.cos(2*P))
+
+    base = {
+        'M2'  : (np.cos(I/2)**4/0.9154,            2*xi - 2*nu),
+        'O1'  : (np.sin(I)*np.cos(I/2)**2/0.3800,  2*xi - nu),
+        'K1'  : (np.sqrt(0.8965*np.sin(2*I)**2 +
+                         0.6001*np.sin(2*I)*np.cos(nu) + 0.1006), -nu1),
+        'K2'  : (np.sqrt(19.0444*np.sin(I)**4 +
+                         2.7702*np.sin(I)**2*np.cos(2*nu) + 0.0981), -nu2),
+        'J1'  : (np.sin(2*I)/0.7214,               -nu),
+        'OO1' : (np.sin(I)*np.sin(I/2)**2/0.01640, -2*xi - nu),
+        'Mf'  : (np.sin(I)**2/0.1578,              -2*xi),
+        'Mm'  : ((2./3. - np.sin(I)**2)/0.5021,    0.*N),
+        'M3'  : (np.cos(I/2)**6/0.8758,            3*xi - 3*nu),
+        }
+    fM2, uM2 = base['M2']
+    base['L2']      = (fM2*Rinv, uM2 - R)
+    base['M2^2']    = (fM2**2, 2*uM2)
+    base['M2^3']    = (fM2**3, 3*uM2)
+    base['M2^4']    = (fM2**4, 4*uM2)
+    base['1/M2']    = (fM2, -uM2)
+    base['M2*K1']   = (fM2*base['K1'][0], uM2 + base['K1'][1])
+    base['M2^2/K1'] = (fM2**2*base['K1'][0], 2*uM2 - base['K1'][1])
+
+    f = np.ones ([len(names), len(N)])
+    u = np.zeros([len(names), len(N)])
+    for k, name in enumerate(names):
+        kind = CONSTITUENTS[canonical(name)][2]
+        if kind is not None:
+            f[k], u[k] = base[kind]
+    return f, np.degrees(u)
+
+#==============================================================================
+def equilibrium (names, a):
+    """
+    Equilibrium arguments V (deg) of the constituents, [C, T]
+    """
+    d   = np.array([CONSTITUENTS[canonical(n)][0] for n in names],
+                   dtype=float).reshape(-1, 5)
+    off = np.array([CONSTITUENTS[canonical(n)][1] for n in names])
+    arg = np.vstack([np.atleast_1d(a[k]) for k in ('T','s','h','p','p1')])
+    return np.mod(d @ np.mod(arg, 360.) + off[:,None], 360.)
+
+#==============================================================================
+def arguments (names, times, useNodal=True):
+    """
+    Returns f*cos(V+u) and f*sin(V+u), np.arrays [C, T]
+    """
+    a = astro(toHours(times))
+    V = equilibrium(names, a)
+    if useNodal:
+        f, u = nodal(names, a)
+    else:
+        f, u = 1., 0.
+    arg = np.radians(V + u)
+    return f*np.cos(arg), f*np.sin(arg)
+
+#==============================================================================
+def predict (times, names, amplitude, phase, z0=0., useNodal=True,
+             chunk=8*1024**2, verbose=1):
+    """
+    Predicts tides at many points and times in one batched computation
+    Args:
+        times     (datetime64 or datetime np.array [T]) : UTC times
+        names     (list [C])              : constituent names, e.g. 'M2'
+        amplitude (float np.array [P, C]) : amplitudes (or [C] for one point)
+        phase     (float np.array [P, C]) : Greenwich phase lags, degrees
+        z0        (float or np.array [P]) : mean level added to the sum
+        useNodal  (bool) : apply nodal factors f and u
+        chunk     (int)  : number of (point, time) values per time chunk
+    Returns:
+        float np.array [P, T] (or [T] for one point)
+    """
+    amplitude = np.asarray(amplitude, dtype=float)
+    phase     = np.asarray(phase, dtype=float)
+    single    = amplitude.ndim == 1
+    A = np.atleast_2d(amplitude)
+    G = np.radians(np.atleast_2d(phase))
+    if A.shape != G.shape or A.shape[1] != len(names):
+        raise ValueError('Amplitude and phase must be [points, ' +
+                         str(len(names)) + ' constituents]')
+    if verbose:
+        oper.sys.msg('i', 'Predicting ' + str(len(names)) +
+                     ' constituents at ' + str(len(A)) + ' points.')
+    times = np.asarray(times)
+    out = harmonicSum(A, G, len(times), chunk,
+                      lambda a, b: arguments(names, times[a:b], useNodal))
+    out += np.asarray(z0, dtype=float).reshape(-1, 1)
+    return out[0] if single else out
+
+#==============================================================================
+def harmonicSum (A, G, NT, chunk, args):
+    """
+    Sums A f cos(arg - G) over constituents for all points, time chunk
+    by time chunk
+    Args:
+        A, G  (float np.array [P, C]) : amplitudes and phase lags (radians)
+        NT    (int) : number of time steps
+        chunk (int) : number of (point, time) values per time chunk
+        args  (function) : args(t0, t1) returns f*cos(arg), f*sin(arg),
+                           np.arrays [C, t1-t0]
+    Returns:
+        float np.array [P, NT]
+    """
+    # cos(a - G) = cos a cos G + sin a sin G
+    AC  = A*np.cos(G)
+    AS  = A*np.sin(G)
+    out = np.empty([len(A), NT])
+    step = int(max(1, chunk // max(len(A), 1)))
+    for t0 in range(0, NT, step):
+        fc, fs = args(t0, min(t0 + step, NT))
+        out[:, t0:t0+step] = AC @ fc + AS @ fs
+    return out
+
+#==============================================================================
+def predictFort15 (tides, seconds, chunk=8*1024**2):
+    """
+    Evaluates ADCIRC open boundary tidal forcing of a fort.15
+    at all boundary nodes, as ADCIRC does (FF and FACE hold the nodal
+    factors and equilibrium arguments at the start of the run)
+    Args:
+        tides   (dict) : as returned by adcirc.readFort15 (with 'EMOEFA')
+        seconds (float np.array [T]) : time since the start of the run
+    Returns:
+        float np.array [NETA, T]
+    """
+    seconds = np.asarray(seconds, dtype=float)
+    amig = np.asarray(tides['AMIG'], dtype=float)[:,None]
+    ff   = np.asarray(tides['FF'],   dtype=float)[:,None]
+    face = np.radians(np.asarray(tides['FACE'], dtype=float))[:,None]
+    emoefa = np.asarray(tides['EMOEFA'], dtype=float)
+    A = emoefa[:,:,0].T
+    G = np.radians(emoefa[:,:,1].T)
+
+    def args (t0, t1):
+        arg = amig*seconds[t0:t1] + face
+        return ff*np.cos(arg), ff*np.sin(arg)
+
+    return harmonicSum(A, G, len(seconds), chunk, args)
+
+#==============================================================================
+def designMatrix (times, names, useNodal=True):
+    """
+    Least-squares design matrix of the harmonic analysis
+    Returns:
+        float np.array [T, 1+2C] : columns 1, f*cos(V+u) and f*sin(V+u)
+                                   of every constituent
+    """
+    fc, fs = arguments(names, times, useNodal)
+    T = fc.shape[1]
+    return np.hstack((np.ones([T, 1]), np.broadcast_to(fc, (len(names), T)).T,
+                      np.broadcast_to(fs, (len(names), T)).T))
+
+#==============================================================================
+def analyze (times, values, names, useNodal=True, minPoints=None, verbose=1):
+    """
+    Harmonic analysis of many series on one time axis by least squares.
+    The design matrix is built once; stations that have the same gaps
+    (NaN or masked values) are solved together in one call.
+    Args:
+        times  (datetime64 or datetime np.array [T]) : UTC times
+        values (float np.array [S, T]) : series (or [T] for one station),
+                 e.g. adcirc.readTimeSeries(...)['zeta'].T
+        names  (list [C]) : constituents to fit, e.g. ['M2','S2','K1','O1']
+        useNodal  (bool)  : apply nodal factors f and u
+        minPoints (int)   : fewest valid values for a fit (default 2C+1);
+                            stations with fewer get NaN constants
+    Returns:
+        dict: 'names', 'amplitude' and 'phase' (Greenwich phase lag,
+              degrees) [S, C], 'z0' (mean level) [S], 'npts' [S] and
+              'rmse' [S] (root mean square of the fit residual),
+              as accepted by predict() and statistics.harmonicErrors()
+    """
+    values = np.ma.filled(np.ma.asarray(values, dtype=float), np.nan)
+    single = values.ndim == 1
+    Y      = np.atleast_2d(values)
+    S, T   = Y.shape
+    C      = len(names)
+    if T != len(times):
+        raise ValueError('Series have ' + str(T) + ' values, time axis has ' +
+                         str(len(times)))
+    if minPoints is None:
+        minPoints = 2*C + 1
+    if verbose:
+        oper.sys.msg('i', 'Harmonic analysis of ' + str(S) +
+                     ' series for ' + str(C) + ' constituents.')
+    X     = designMatrix(times, names, useNodal)
+    valid = ~np.isnan(Y)
+    coef  = np.full([S, 1 + 2*C], np.nan)
+    rmse  = np.full(S, np.nan)
+    npts  = valid.sum(axis=1)
+
+    # one least-squares solve per distinct gap pattern
+    patterns, group = np.unique(np.packbits(valid, axis=1), axis=0,
+                                return_inverse=True)
+    group = np.ravel(group)
+    for g in range(len(patterns)):
+        rows = np.flatnonzero(group == g)
+        mask = valid[rows[0]]
+        if np.count_nonzero(mask) < max(minPoints, 1):
+            continue
+        Xg = X[mask]
+        sol, res, rank, sv = np.linalg.lstsq(Xg, Y[rows][:, mask].T,
+                                             rcond=None)
+        if rank < Xg.shape[1]:
+            oper.sys.msg('w', 'Constituents are not resolved by ' +
+                         str(np.count_nonzero(mask)) + ' values of ' +
+                         str(len(rows)) + ' series.')
+        coef[rows] = sol.T
+        resid = Y[rows][:, mask] - sol.T @ Xg.T
+        rmse[rows] = np.sqrt(np.mean(resid**2, axis=1))
+
+    a, b = coef[:, 1:C+1], coef[:, C+1:]
+    out = {'names'     : list(names),
+           'amplitude' : np.hypot(a, b),
+           'phase'     : np.mod(np.degrees(np.arctan2(b, a)), 360.),
+           'z0'        : coef[:, 0],
+           'npts'      : npts,
+           'rmse'      : rmse}
+    if single:
+        for key in ('amplitude', 'phase', 'z0', 'npts', 'rmse'):
+            out[key] = out[key][0]
+    return out
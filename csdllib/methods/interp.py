@@ -4,8 +4,8 @@
 
 import numpy as np
 import datetime
-from datetime import timedelta
 from csdllib import oper
+from csdllib.methods import spatial
 
 #============================================================================== 
 def nearest(items, pivot):
@@ -22,19 +22,208 @@ def nearest(items, pivot):
 
 
 #==============================================================================
-def distanceMatrix(x0, y0, x1, y1):
+def distanceMatrix(x0, y0, x1, y1, metric='planar'):
     """
-    Computes euclidean distance matrix, fast
-    from <http://stackoverflow.com/questions/1871536>
+    Computes distance matrix [len(x0) x len(x1)], tile by tile
+    (see distanceBlock for the metrics)
     """    
     oper.sys.msg('i', 'Computing distance matrix...')
-    obs    = np.vstack((x0, y0)).T
-    interp = np.vstack((x1, y1)).T
+    dist = np.empty([len(x0), len(x1)])
+    for cols, d in distanceBlocks(x0, y0, x1, y1, metric):
+        dist[:, cols] = d
+    return dist
 
-    d0 = np.subtract.outer(obs[:,0], interp[:,0])
-    d1 = np.subtract.outer(obs[:,1], interp[:,1])
+#==============================================================================
+def distanceBlock(x0, y0, x1, y1, metric='planar'):
+    """
+    Computes distances between all points 0 and all points 1
+    Args:
+        x0, y0 (float np.array [N0]) : lon, lat of points 0, degrees
+        x1, y1 (float np.array [N1]) : lon, lat of points 1, degrees
+        metric (str) : 'planar'          - euclidean, in degrees
+                       'equirectangular' - km, longitudes scaled by the
+                                           cosine of the mean latitude
+                       'haversine'       - great-circle, km
+    Returns:
+        float np.array [N0 x N1]
+    """
+    x0 = np.asarray(x0, dtype=float)[:,None]
+    y0 = np.asarray(y0, dtype=float)[:,None]
+    x1 = np.asarray(x1, dtype=float)[None,:]
+    y1 = np.asarray(y1, dtype=float)[None,:]
+    if metric == 'planar':
+        return np.hypot(x0 - x1, y0 - y1)
+    dlon = np.radians(np.mod(x1 - x0 + 180., 360.) - 180.)
+    if metric == 'equirectangular':
+        d  = dlon*np.cos(np.radians(0.5*(y0 + y1)))
+        d  = np.hypot(d, np.radians(y1 - y0), out=d)
+        d *= spatial.R_EARTH
+        return d
+    if metric == 'haversine':
+        lat0 = np.radians(y0)
+        lat1 = np.radians(y1)
+        h  = np.sin(0.5*dlon)
+        h *= h
+        h *= np.cos(lat0)*np.cos(lat1)
+        h += np.sin(0.5*(lat1 - lat0))**2
+        np.minimum(h, 1., out=h)
+        np.sqrt(h, out=h)
+        np.arcsin(h, out=h)
+        h *= 2.*spatial.R_EARTH
+        return h
+    raise ValueError('Unknown metric ' + str(metric))
+
+#==============================================================================
+def distanceBlocks(x0, y0, x1, y1, metric='planar', blockSize=None,
+                   blockBytes=64*1024**2):
+    """
+    Yields distances to tiles of points 1, never holding the full matrix
+    Args:
+        blockSize  (int) : points 1 per tile
+                           (default: as many as fit blockBytes)
+    Yields:
+        cols (slice) : tile of points 1
+        dist (float np.array [N0 x tile])
+    """
+    N0 = max(len(x0), 1)
+    N1 = len(x1)
+    if blockSize is None:
+        # a few temporaries of the tile size are alive at once
+        blockSize = blockBytes // (4*8*N0)
+    blockSize = int(max(1, blockSize))
+    for a in range(0, N1, blockSize):
+        cols = slice(a, min(a + blockSize, N1))
+        yield cols, distanceBlock(x0, y0, x1[cols], y1[cols], metric)
+
+#==============================================================================
+def nearestPoints(x0, y0, x1, y1, k=1, metric='planar', blockSize=None):
+    """
+    Finds k nearest points 0 of every point 1, tile by tile
+    Returns:
+        dist (float np.array [N1 x k]) : distances, ascending
+        idx  (int np.array [N1 x k])   : 0-based points 0
+    """
+    x1   = np.asarray(x1, dtype=float)
+    y1   = np.asarray(y1, dtype=float)
+    k    = min(int(k), len(x0))
+    dist = np.empty([len(x1), k])
+    idx  = np.empty([len(x1), k], dtype=np.int64)
+    for cols, d in distanceBlocks(x0, y0, x1, y1, metric, blockSize):
+        d = d.T
+        if k == 1:
+            i = np.argmin(d, axis=1)[:,None]
+        else:
+            i = np.argpartition(d, k - 1, axis=1)[:, :k] if k < d.shape[1] \
+                else np.broadcast_to(np.arange(k), d.shape)
+            i = np.take_along_axis(i, np.argsort(
+                    np.take_along_axis(d, i, axis=1), axis=1), axis=1)
+        idx [cols] = i
+        dist[cols] = np.take_along_axis(d, i, axis=1)
+    return dist, idx
+
+#==============================================================================
+def weightedSum(x0, y0, v, x1, y1, weight, metric='planar', blockSize=None):
+    """
+    Sums values of points 0 weighted by a function of the distance,
+    for every point 1, tile by tile
+    Args:
+        v      (float np.array [N0] or [M, N0]) : values of points 0
+        weight (function) : maps distances [N0 x tile] to weights
+    Returns:
+        sumWV (float np.array [N1] or [M, N1]) : sum of weight*value
+        sumW  (float np.array [N1])            : sum of weights
+    """
+    v    = np.asarray(v, dtype=float)
+    N1   = len(x1)
+    sumW = np.empty(N1)
+    sumWV = np.empty(v.shape[:-1] + (N1,))
+    for cols, d in distanceBlocks(x0, y0, np.asarray(x1, dtype=float),
+                                  np.asarray(y1, dtype=float), metric,
+                                  blockSize):
+        w = weight(d)
+        sumW[cols] = w.sum(axis=0)
+        sumWV[..., cols] = v @ w
+    return sumWV, sumW
+
+#==============================================================================
+def inverseDistance(dist, p=2):
+    """
+    Normalized inverse distance weights of neighbor tables
+    Args:
+        dist (float np.array [Q,k]) : distances to the neighbors, inf where
+                                      there is none; exact hits are 0
+        p    (float) : power
+    Returns:
+        float np.array [Q,k] : weights summing to 1 (0 where no neighbors);
+                               a target on top of sources takes their mean
+    """
+    with np.errstate(divide='ignore'):
+        w = np.where(np.isfinite(dist), 1.0/np.power(dist, p), 0.)
+    exact = np.any(dist == 0., axis=1)
+    w[exact] = dist[exact] == 0.
+    s = w.sum(axis=1)[:,None]
+    return np.divide(w, s, out=np.zeros_like(w), where=s > 0)
 
-    return np.hypot(d0, d1)
+#==============================================================================
+def idw(x, y, v, xi, yi, p=2, k=8, maxDist=np.inf, metric='planar',
+        chunk=2**16, workers=1, backend='auto'):
+    """
+    Inverse distance weighted interpolation over the k nearest data
+    points, processed in chunks of targets
+    Args:
+        x, y, v (float) : arrays for data coordinates and values
+                          (v may be [M, N] for M fields at once)
+        xi,  yi (float) : arrays for grid coordinates
+        p     (float)   : power (default=2)
+        k       (int)   : number of nearest data points used
+                          (all of them if None, as in shepardIDW)
+        maxDist (float) : search radius, data points farther away are
+                          ignored (degrees, or km for 'greatcircle')
+        metric  (str)   : 'planar' (degrees) or 'greatcircle' (km)
+        chunk   (int)   : targets per chunk (k-nearest) or tile (all)
+        workers (int)   : threads processing the chunks
+    Returns:
+        vi      (float) : array of v interpolated onto xi and yi;
+                          grid points on top of data points take their
+                          values, NaN where no data point is within maxDist
+    """
+    v  = np.asarray(v, dtype=float)
+    xi = np.asarray(xi, dtype=float)
+    yi = np.asarray(yi, dtype=float)
+    vi = np.full(v.shape[:-1] + (len(xi),), np.nan)
+    if k is None:
+        index = None
+    else:
+        index = spatial.NodeIndex(x, y, metric, backend)
+
+    def run (cols):
+        if index is not None:
+            dist, idx = index.query(xi[cols], yi[cols], k, maxDist)
+            w = inverseDistance(dist, p)
+            vals = v[..., np.maximum(idx, 0)]
+            vi[..., cols] = np.einsum('...qk,qk->...q', vals, w)
+        else:
+            dist = distanceBlock(x, y, xi[cols], yi[cols],
+                                 'haversine' if metric == 'greatcircle'
+                                 else metric).T
+            dist[dist > maxDist] = np.inf
+            w = inverseDistance(dist, p)
+            vi[..., cols] = v @ w.T
+        vi[..., cols][..., w.sum(axis=1) == 0] = np.nan
+
+    if k is None:
+        # a tile holds distances to all data points
+        chunk = max(1, min(chunk, (16*1024**2) // max(len(v.T), 1)))
+    parts = [slice(a, min(a + chunk, len(xi)))
+             for a in range(0, len(xi), int(chunk))]
+    if workers > 1 and len(parts) > 1:
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            list(pool.map(run, parts))
+    else:
+        for cols in parts:
+            run(cols)
+    return vi
 
 #==============================================================================
 def shepardIDW(x, y, v, xi, yi, p=2):
@@ -47,25 +236,122 @@ def shepardIDW(x, y, v, xi, yi, p=2):
     Returns:
         vi      (float) : array of v interpolated onto xi and yi
     """       
-    dist = distanceMatrix(x, y, xi, yi)    
-
     oper.sys.msg( 'i','Computing IDW...')
-    vi = np.zeros(len(xi), dtype=float)
-    weights = 1.0/np.power(dist, p)
-    
-    #TODO: Optimize!
-    for n in range(len(xi)):
-        A = 0.
-        B = 0.
-        for j in range(len(x)):
-            A = A + weights[j,n]*v[j]
-            B = B + weights[j,n]
-        vi[n] = A/B
-    return vi
+    return idw(x, y, v, xi, yi, p=p, k=None)
+
+
+#==============================================================================
+def linearWeight (z_full, z_zero, z, out):
+    """
+    Linear taper weights of depths z, written to out:
+    1 at z_full, 0 at z_zero and beyond
+    """
+    np.subtract(z, z_zero, out=out)
+    out *= 1.0/(z_full - z_zero)
+    return np.clip(out, 0., 1., out=out)
 
+#==============================================================================
+def expWeight (z_full, z_zero, z, out):
+    """
+    Exponential taper weights of depths z, written to out:
+    1 up to z_full, z_zero/(z_zero-z_full)*(z_full/z-1)+1 deeper,
+    0 beyond z_zero
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        np.divide(z_full, z, out=out)
+    out -= 1.0
+    out *= z_zero/(z_zero - z_full)
+    out += 1.0
+    np.copyto(out, 1., where=~(z > z_full))
+    return np.clip(out, 0., 1., out=out)
+
+#==============================================================================
+def cosineWeight (z_full, z_zero, z, out):
+    """
+    Cosine taper weights of depths z, written to out:
+    1 at z_full, 0 at z_zero and beyond, smooth at both ends
+    """
+    np.subtract(z, z_full, out=out)
+    out *= 1.0/(z_zero - z_full)
+    np.clip(out, 0., 1., out=out)
+    out *= np.pi
+    np.cos(out, out=out)
+    out += 1.0
+    out *= 0.5
+    return out
+
+TAPERS = {'linear' : linearWeight,
+          'exp'    : expWeight,
+          'cosine' : cosineWeight}
 
 #==============================================================================
-def taperLinear (z_full, z_zero, zg, vg):
+def taper (profiles, zg, vg, out=None, blockSize=2**16):
+    """
+    Tapers the values of the field by the product of several taper
+    profiles, in one pass over the depths, block by block
+    (no temporaries larger than blockSize)
+    Args:
+        profiles (list) : of (kind, z_full, z_zero), kind is 'linear',
+                          'exp' or 'cosine'; weights are clipped to [0, 1]
+                          outside of the [z_full, z_zero] band
+        zg     (float) : array of depths (larger numbers are deeper)
+        vg     (float) : array of values to taper
+        out    (float) : array for the result, may be vg (default: new);
+                         integer out gets the tapered values truncated,
+                         as element assignment would
+    Returns:
+        out    (float) : tapered array
+    """
+    for kind, z_full, z_zero in profiles:
+        if kind not in TAPERS:
+            raise ValueError('Unknown taper ' + str(kind))
+    zg = np.asarray(zg)
+    vg = np.asarray(vg)
+    if out is None:
+        out = np.empty(vg.shape, dtype=np.result_type(vg, float))
+    elif not out.flags.c_contiguous:
+        # blocks are written through a flat view, which needs C order
+        tmp = taper(profiles, zg, vg,
+                    np.empty(out.shape, dtype=out.dtype), blockSize)
+        np.copyto(out, tmp)
+        return out
+    zf = zg.reshape(-1)
+    vf = vg.reshape(-1)
+    of = out.reshape(-1)
+    w  = np.empty(min(blockSize, len(zf)))
+    b  = np.empty_like(w)
+    cast = not np.issubdtype(out.dtype, np.inexact)
+    if cast:
+        oper.sys.msg('w', 'Tapered values are truncated to ' +
+                     str(out.dtype) + '.')
+    for a in range(0, len(zf), blockSize):
+        z = zf[a:a+blockSize]
+        n = len(z)
+        w[:n] = 1.0
+        for kind, z_full, z_zero in profiles:
+            w[:n] *= TAPERS[kind](z_full, z_zero, z, b[:n])
+        if cast:
+            np.multiply(vf[a:a+n], w[:n], out=b[:n])
+            np.copyto(of[a:a+n], b[:n], casting='unsafe')
+        else:
+            np.multiply(vf[a:a+n], w[:n], out=of[a:a+n])
+    return out
+
+#==============================================================================
+def taperInPlace (profiles, zg, vg, out=None):
+    """
+    Tapers vg in place (or into out) as the element by element loops did:
+    a list vg has its items replaced, the tapered array is returned
+    """
+    if out is not None or isinstance(vg, np.ndarray):
+        return taper(profiles, zg, vg, vg if out is None else out)
+    res = taper(profiles, zg, vg)
+    if isinstance(vg, list):
+        vg[:] = res.tolist()
+    return res
+
+#==============================================================================
+def taperLinear (z_full, z_zero, zg, vg, out=None):
     """
     Tapers the values of the field to zero in between the two specified depths
     Args:
@@ -73,19 +359,16 @@ def taperLinear (z_full, z_zero, zg, vg):
         z_zero (float) : depth at which the field fully tapers to zero
         zg     (float) : array of depths (larger numbers are deeper)
         vg     (float) : array of values to taper        
+        out    (float) : array for the result (default: vg, in place;
+                         a list vg is updated and an array returned)
     Returns:
         vg     (float) : tapered array
     """
     oper.sys.msg( 'i','Computing linear taper...')
-    
-    #TODO: Optimize
-    for n in range(len(vg)):
-        w = (zg[n]-z_zero)/(z_full-z_zero)
-        vg[n] = w*vg[n]
-    return vg
+    return taperInPlace([('linear', z_full, z_zero)], zg, vg, out)
 
 #==============================================================================
-def taperExp (z_full, z_zero, zg, vg):
+def taperExp (z_full, z_zero, zg, vg, out=None):
     """
     Tapers the values of the field to zero in between the two specified depths
     Args:
@@ -93,19 +376,117 @@ def taperExp (z_full, z_zero, zg, vg):
         z_zero (float) : depth at which the field fully tapers to zero
         zg     (float) : array of depths (larger numbers are deeper)
         vg     (float) : array of values to taper        
+        out    (float) : array for the result (default: vg, in place;
+                         a list vg is updated and an array returned)
     Returns:
         vg     (float) : tapered array
     """
     oper.sys.msg( 'i','Computing exponential taper...')
-    
-    #TODO: Optimize
-    for n in range(len(vg)):
-        #w = (zg[n]-z_zero)/(z_full-z_zero)
-        if zg[n]>z_full:
-            w     = z_zero/(z_zero-z_full)*(z_full/zg[n]-1.0) + 1.0
-            vg[n] = w*vg[n]
-    return vg
+    return taperInPlace([('exp', z_full, z_zero)], zg, vg, out)
+
+
+#==============================================================================
+def toDatetime64 (dates):
+    """
+    Converts datetime or datetime64 array to datetime64[us]
+    """
+    return np.asarray(dates).astype('datetime64[us]')
+
+#==============================================================================
+def snap (dates, values, refDates, tolerance):
+    """
+    Projects series onto reference dates: every reference date takes the
+    valid value nearest in time (the earlier one on ties, the first one
+    of equal dates in input order), or NaN if there is none closer than
+    tolerance.
+    O((N + T) log N), all series in one vectorized pass.
+    Args:
+        dates    (datetime or datetime64 np.array [N]) : series dates
+        values   (np.array [N] or [S, N]) : one or S series on these dates,
+                                            NaN or masked where missing
+        refDates (datetime or datetime64 np.array [T]) : reference dates
+        tolerance (np.timedelta64 or timedelta)
+    Returns:
+        float np.array [T] or [S, T]
+    """
+    d   = toDatetime64(dates).astype(np.int64)
+    ref = toDatetime64(refDates).astype(np.int64)
+    tol = np.timedelta64(tolerance).astype('timedelta64[us]').astype(np.int64)
+    val = np.ma.filled(np.ma.asarray(values, dtype=float), np.nan)
+    order = np.argsort(d, kind='stable')
+    d   = d[order]
+    val = val[..., order]
+    N   = len(d)
+    out = np.full(val.shape[:-1] + (len(ref),), np.nan)
+    if N == 0:
+        return out
+
+    # previous and next valid sample of every sample
+    valid = ~np.isnan(val)
+    idx   = np.arange(N)
+    prev  = np.maximum.accumulate(np.where(valid, idx, -1), axis=-1)
+    nxt   = np.minimum.accumulate(np.where(valid, idx, N)[..., ::-1],
+                                  axis=-1)[..., ::-1]
+    nxt   = np.concatenate((nxt, np.full(nxt.shape[:-1] + (1,), N)), axis=-1)
 
+    i = np.searchsorted(d, ref, 'left')
+    L = np.where(i > 0, prev[..., np.maximum(i - 1, 0)], -1)
+    # first valid sample of the same date
+    L = np.where(L >= 0, np.take_along_axis(nxt, np.searchsorted(
+                 d, d[np.maximum(L, 0)], 'left'), axis=-1), -1)
+    R = nxt[..., i]
+    dL = np.where(L >= 0, ref - d[np.maximum(L, 0)], np.iinfo(np.int64).max)
+    dR = np.where(R <  N, d[np.minimum(R, N - 1)] - ref,
+                  np.iinfo(np.int64).max)
+    pick = np.where(dL <= dR, L, R)
+    near = np.minimum(dL, dR) < tol
+    out[...] = np.where(near, np.take_along_axis(
+                   val, np.clip(pick, 0, N - 1), axis=-1), np.nan)
+    return out
+
+#==============================================================================
+def align (obsDates, obsVals, modDates, modVals, refStepMinutes=6,
+           refDates=None):
+    """
+    Projects observed and modeled series onto a common reference time
+    scale with a resolution of refStepMinutes (see retime), for one or
+    many stations at once. Tolerance is half of refStepMinutes.
+    Args:
+        obsDates (datetime or datetime64 np.array [Lobs])
+        obsVals  (np.array [Lobs] or [S, Lobs])
+        modDates (datetime or datetime64 np.array [Lmod])
+        modVals  (np.array [Lmod] or [S, Lmod])
+        refStepMinutes (float, default=6) : projection time step
+        refDates (datetime64 np.array) : projection dates to use instead;
+                  by default they span the time when both have valid
+                  values (for any of the stations)
+    Returns:
+        refDates    (datetime64[us] np.array [T])
+        obsValsProj (np.array [T] or [S, T])
+        modValsProj (np.array [T] or [S, T])
+    """
+    obsDates = toDatetime64(obsDates)
+    modDates = toDatetime64(modDates)
+    obsVals  = np.ma.filled(np.ma.asarray(obsVals, dtype=float), np.nan)
+    modVals  = np.ma.filled(np.ma.asarray(modVals, dtype=float), np.nan)
+    refStep  = np.timedelta64(int(round(refStepMinutes*60e6)), 'us')
+    prec     = np.timedelta64(int(round(refStepMinutes*30e6)), 'us')
+
+    if refDates is None:
+        obsValid = obsDates[~np.all(np.isnan(obsVals.reshape(
+                                    -1, len(obsDates))), axis=0)]
+        modValid = modDates[~np.all(np.isnan(modVals.reshape(
+                                    -1, len(modDates))), axis=0)]
+        if not len(obsValid) or not len(modValid):
+            refDates = np.array([], dtype='datetime64[us]')
+        else:
+            refStart = max(obsValid.min(), modValid.min())
+            refEnd   = min(obsValid.max(), modValid.max())
+            refDates = np.arange(refStart, refEnd, refStep)
+    refDates = toDatetime64(refDates)
+
+    return (refDates, snap(obsDates, obsVals, refDates, prec),
+                      snap(modDates, modVals, refDates, prec))
 
 #============================================================================== 
 def retime (obsDates, obsVals, modDates, modVals, refStepMinutes=6):
@@ -125,64 +506,7 @@ def retime (obsDates, obsVals, modDates, modVals, refStepMinutes=6):
         obsValsProj (np.array)           : projected values of timeseries 1
         modValsProj (np.array)           : projected values of timeseries 2
     """
-    refDates    = []
-    obsValsProj = []
-    modValsProj = []
-
-    #Sort by date
-    obsDates  = np.array(obsDates)
-    obsVals   = np.array(obsVals)
-    ind       = np.argsort(obsDates)
-    obsDates  = obsDates[ind]
-    obsVals   = obsVals[ind]
-    # Remove nans
-    ind       = np.logical_not(np.isnan(obsVals))
-    obsDates  = obsDates[ind]
-    obsVals   = obsVals[ind]
-        
-    #Sort by date
-    #modVals   = np.ma.filled(modValsMasked, np.nan)
-    modDates  = np.array(modDates)
-    modVals   = np.array(modVals)
-    ind       = np.argsort(modDates)
-    modDates  = modDates[ind]
-    modVals   = modVals[ind]
-    # Remove nans
-    #Rid of mask
-    if hasattr(modVals,'mask'):
-        np.ma.set_fill_value(modVals, np.nan)   
-    
-    ind       = np.logical_not(np.isnan(modVals))
-    modDates  = modDates[ind]
-    modVals   = modVals[ind]
-
-    # Create reference time line
-    refStart = np.maximum(np.min(obsDates), np.min(modDates))
-    refEnd   = np.minimum(np.max(obsDates), np.max(modDates))
-    refStep  = timedelta(minutes=refStepMinutes)
-    prec     = timedelta(minutes=0.5*refStepMinutes)
-   
-    refDates = np.arange(refStart, refEnd, refStep).astype(datetime.datetime)
-
-    # Project obs and model onto reference time line
-    obsValsProj  = []    
-    modValsProj  = []
-
-    for t in refDates:
-        #find t in obsDates within refStep
-        nearestObsDate, idx = nearest(obsDates, t)
-        if abs(nearestObsDate - t) < prec:
-            nearestObsVal   = obsVals[idx]
-            obsValsProj.append (nearestObsVal)
-        else:
-            obsValsProj.append (np.nan)
-
-        nearestModDate, idx = nearest(modDates, t)
-        if abs(nearestModDate - t) < prec:
-            nearestModVal   = modVals[idx]
-            modValsProj.append (nearestModVal)
-        else:
-            modValsProj.append (np.nan)
-
-    return refDates, np.array(obsValsProj), np.array(modValsProj)
-
+    refDates, obsValsProj, modValsProj = align(obsDates, obsVals,
+                                               modDates, modVals,
+                                               refStepMinutes)
+    return refDates.astype(datetime.datetime), obsValsProj, modValsProj
@@ -0,0 +1,243 @@
+"""
+Point location on the triangular mesh and sparse interpolation weights.
+
+Locator finds the element containing each query point in one vectorized
+pass: candidate elements are the ones with the nearest centroids (from
+spatial.NodeIndex), tested all at once with barycentric coordinates.
+The resulting weights form a sparse (points x nodes) matrix, so that
+interpolating a field onto the points is one sparse mat-vec:
+
+    W = locate.barycentricWeights(grid, stationLon, stationLat)
+    zeta = adcirc.readSurfaceField(fort63, 'zeta')
+    series = W.apply(zeta['value'])          # [NT, nStations]
+
+@author: grapesh@gmail.com
+"""
+
+import numpy as np
+from csdllib import oper
+from csdllib.methods import spatial
+
+#==============================================================================
+class SparseWeights (object):
+    """
+    Sparse (targets x sources) weight matrix in CSR form:
+    row i holds weights vals[offsets[i]:offsets[i+1]] of the source
+    points cols[offsets[i]:offsets[i+1]] (0-based).
+    """
+    ARRAYS = ('offsets', 'cols', 'vals', 'shape')
+
+    def __init__ (self, offsets, cols, vals, shape):
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.cols    = np.asarray(cols, dtype=np.int64)
+        self.vals    = np.asarray(vals, dtype=float)
+        self.shape   = tuple(int(s) for s in shape)
+
+    def __repr__ (self):
+        return ('SparseWeights(' + str(self.shape[0]) + 'x' +
+                str(self.shape[1]) + ', nnz=' + str(len(self.cols)) + ')')
+
+    @classmethod
+    def fromDense (cls, idx, w, nSources):
+        """
+        Builds the matrix from per-target neighbor tables
+        Args:
+            idx (int np.array [Q,k])   : 0-based sources, -1 for none
+            w   (float np.array [Q,k]) : weights
+            nSources (int)             : number of source points
+        """
+        idx  = np.asarray(idx).reshape(len(idx), -1)
+        w    = np.asarray(w, dtype=float).reshape(idx.shape)
+        keep = idx >= 0
+        offsets = np.concatenate(([0], np.cumsum(keep.sum(axis=1))))
+        return cls(offsets, idx[keep], w[keep], (len(idx), nSources))
+
+    def rows (self):
+        """
+        Returns 0-based target (row) number of each stored weight
+        """
+        return np.repeat(np.arange(self.shape[0]), np.diff(self.offsets))
+
+    def empty (self):
+        """
+        Returns boolean mask of the targets that have no weights
+        """
+        return np.diff(self.offsets) == 0
+
+    def apply (self, field):
+        """
+        Interpolates the field onto the targets
+        Args:
+            field (np.array [..., nSources]) : e.g. one time slice [NP]
+                   or all of them [NT, NP]; masked values count as NaN
+        Returns:
+            np.array [..., nTargets] : NaN where the target has no weights
+        """
+        if np.ma.isMaskedArray(field):
+            field = field.astype(float).filled(np.nan)
+        field = np.asarray(field)
+        if field.shape[-1] != self.shape[1]:
+            raise ValueError('Field has ' + str(field.shape[-1]) +
+                             ' points, weights expect ' + str(self.shape[1]))
+        out = np.full(field.shape[:-1] + (self.shape[0],), np.nan)
+        nz = ~self.empty()
+        if np.any(nz):
+            # reduceat over the non-empty rows only: an empty row would
+            # cut the sum of the row before it
+            prod = field[..., self.cols]*self.vals
+            out[..., nz] = np.add.reduceat(prod, self.offsets[:-1][nz],
+                                           axis=-1)
+        return out
+
+    def __matmul__ (self, field):
+        return self.apply(field)
+
+    def transpose (self):
+        """
+        Returns the transposed matrix
+        """
+        order   = np.argsort(self.cols, kind='stable')
+        counts  = np.bincount(self.cols, minlength=self.shape[1])
+        offsets = np.concatenate(([0], np.cumsum(counts)))
+        return SparseWeights(offsets, self.rows()[order], self.vals[order],
+                             (self.shape[1], self.shape[0]))
+
+    def toScipy (self):
+        """
+        Returns the matrix as scipy.sparse.csr_matrix
+        """
+        from scipy.sparse import csr_matrix
+        return csr_matrix((self.vals, self.cols, self.offsets),
+                          shape=self.shape)
+
+    def toArrays (self):
+        """
+        Returns the matrix as flat arrays (for caching)
+        """
+        return dict([(a, np.asarray(getattr(self, a))) for a in self.ARRAYS])
+
+    @classmethod
+    def fromArrays (cls, arrays):
+        """
+        Inverse of toArrays()
+        """
+        return cls(*[arrays[a] for a in cls.ARRAYS])
+
+#==============================================================================
+def barycentric (px, py, x, y):
+    """
+    Barycentric coordinates of points in triangles
+    Args:
+        px, py (float np.array [...])   : points
+        x, y   (float np.array [...,3]) : triangle vertices
+    Returns:
+        float np.array [...,3] : weights of the vertices, summing to 1;
+                                 all are >= 0 inside the triangle
+    """
+    x1, x2, x3 = x[...,0], x[...,1], x[...,2]
+    y1, y2, y3 = y[...,0], y[...,1], y[...,2]
+    det = (y2 - y3)*(x1 - x3) + (x3 - x2)*(y1 - y3)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        w1 = ((y2 - y3)*(px - x3) + (x3 - x2)*(py - y3))/det
+        w2 = ((y3 - y1)*(px - x3) + (x1 - x3)*(py - y3))/det
+    return np.stack((w1, w2, 1. - w1 - w2), axis=-1)
+
+#==============================================================================
+class Locator (object):
+    """
+    Finds mesh elements containing query points
+    Args:
+        grid (dict or adcirc.Grid) : as returned by adcirc.readGrid
+        backend (str) : search backend of spatial.NodeIndex
+    """
+    def __init__ (self, grid, backend='auto'):
+        self.lon      = np.asarray(grid['lon'], dtype=float).ravel()
+        self.lat      = np.asarray(grid['lat'], dtype=float).ravel()
+        self.elements = np.asarray(grid['Elements']).reshape(-1, 3) - 1
+        self.NP       = len(self.lon)
+        cx = self.lon[self.elements].mean(axis=1)
+        cy = self.lat[self.elements].mean(axis=1)
+        self.centroids = spatial.NodeIndex(cx, cy, 'planar', backend)
+        # no containing element has its centroid farther than that
+        self.reach = np.max(np.hypot(self.lon[self.elements] - cx[:,None],
+                                     self.lat[self.elements] - cy[:,None])) \
+                     if len(cx) else 0.
+
+    def find (self, lon, lat, k=8, kMax=128, tol=1e-9):
+        """
+        Finds containing elements
+        Args:
+            lon, lat (float np.array [Q]) : query points, degrees
+            k    (int)   : candidate elements (nearest centroids) per point
+            kMax (int)   : candidates are doubled up to kMax for points
+                           not found among the first k
+            tol  (float) : tolerance on the barycentric weights
+        Returns:
+            elem (int np.array [Q])      : 0-based element, -1 if outside
+            w    (float np.array [Q,3])  : barycentric weights of its nodes
+        """
+        q    = self.centroids.toQuery(lon, lat)
+        Q    = len(q)
+        elem = np.full(Q, -1, dtype=int)
+        w    = np.full([Q, 3], np.nan)
+        todo = np.arange(Q)
+        kMax = min(kMax, len(self.elements))
+        k    = min(k, kMax)
+        while len(todo) and k > 0:
+            cand = self.centroids.query(q[todo,0], q[todo,1], k=k,
+                                        maxDist=self.reach)[1]
+            tri  = self.elements[np.maximum(cand, 0)]
+            bw   = barycentric(q[todo,0][:,None], q[todo,1][:,None],
+                               self.lon[tri], self.lat[tri])
+            inside = (bw.min(axis=2) >= -tol) & (cand >= 0)
+            found  = inside.any(axis=1)
+            first  = np.argmax(inside, axis=1)[found]
+            hit    = todo[found]
+            elem[hit] = cand[found, first]
+            w[hit]    = bw[found, first]
+            # points with fewer than k candidates in reach are outside
+            todo = todo[~found & (cand[:,-1] >= 0)]
+            if k >= kMax:
+                break
+            k = min(2*k, kMax)
+        return elem, w
+
+    def weights (self, lon, lat, fallback=None, **kwargs):
+        """
+        Builds barycentric interpolation weights
+        Args:
+            lon, lat (float np.array [Q]) : query points, degrees
+            fallback (str) : None - points outside the mesh get no weights
+                                    (NaN after apply),
+                             'nearest' - they take the nearest node value
+        Returns:
+            SparseWeights [Q x NP]
+        """
+        elem, w = self.find(lon, lat, **kwargs)
+        idx = np.where(elem[:,None] >= 0, self.elements[np.maximum(elem, 0)],
+                       -1)
+        outside = elem < 0
+        if np.any(outside):
+            oper.sys.msg('w', str(np.count_nonzero(outside)) +
+                         ' point(s) are outside of the mesh.')
+            if fallback == 'nearest':
+                nodes = spatial.NodeIndex(self.lon, self.lat, 'planar',
+                                          self.centroids.backend)
+                q = self.centroids.toQuery(lon, lat)[outside]
+                idx[outside] = -1
+                idx[outside, 0] = nodes.nearest(q[:,0], q[:,1])[1]
+                w[outside] = [1., 0., 0.]
+        return SparseWeights.fromDense(idx, w, self.NP)
+
+#==============================================================================
+def barycentricWeights (grid, lon, lat, fallback=None, backend='auto'):
+    """
+    Builds the sparse (points x nodes) barycentric interpolation matrix
+    Args:
+        grid (dict or adcirc.Grid)    : as returned by adcirc.readGrid
+        lon, lat (float np.array [Q]) : query points, degrees
+        fallback (str) : None or 'nearest', see Locator.weights()
+    Returns:
+        SparseWeights [Q x NP]
+    """
+    return Locator(grid, backend).weights(lon, lat, fallback)
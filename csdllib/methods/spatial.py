@@ -0,0 +1,440 @@
+"""
+Spatial index over mesh nodes (or any lon/lat points) for batched
+k-nearest and radius queries.
+
+Two metrics are supported:
+    'planar'      : euclidean distance in degrees, as in
+                    interp.distanceMatrix
+    'greatcircle' : great-circle distance in km; points are indexed as
+                    unit vectors, so 0/360 longitudes and the dateline
+                    need no special care
+Queries go through scipy.spatial.cKDTree when scipy is installed.
+The pure NumPy backend sorts the points along a Z-order (Morton) curve,
+so that every cell of the implied quadtree (octree in 3D) is a contiguous
+range of the sorted codes; each query then searches the 3x3(x3) cells
+around it on the finest level that holds enough points, which keeps
+the work bounded on meshes with strongly varying resolution.
+Queries far outside the indexed points degrade to a scan there; pass
+maxDist to cut them short.
+
+@author: grapesh@gmail.com
+"""
+
+import numpy as np
+from csdllib import oper
+
+R_EARTH = 6371.0   # km
+BITS    = {2: 31, 3: 21}   # Morton code bits per dimension
+
+#==============================================================================
+def lonLatToXYZ (lon, lat):
+    """
+    Converts lon/lat (degrees) to unit vectors [N,3]
+    """
+    lon = np.radians(np.asarray(lon, dtype=float))
+    lat = np.radians(np.asarray(lat, dtype=float))
+    coslat = np.cos(lat)
+    return np.column_stack((coslat*np.cos(lon),
+                            coslat*np.sin(lon),
+                            np.sin(lat)))
+
+#==============================================================================
+def wrapLon (lon, lon360):
+    """
+    Brings longitudes to [0,360) if lon360, else to [-180,180)
+    """
+    lon = np.asarray(lon, dtype=float)
+    if lon360:
+        return np.mod(lon, 360.)
+    return np.mod(lon + 180., 360.) - 180.
+
+#==============================================================================
+def kmToChord (d):
+    """
+    Converts great-circle distance (km) to unit sphere chord length
+    """
+    return 2.*np.sin(np.minimum(np.asarray(d, dtype=float)/R_EARTH, np.pi)/2.)
+
+#==============================================================================
+def chordToKm (c):
+    """
+    Converts unit sphere chord length to great-circle distance (km)
+    """
+    c = np.asarray(c, dtype=float)
+    return np.where(np.isfinite(c),
+                    2.*R_EARTH*np.arcsin(np.minimum(c/2., 1.)), np.inf)
+
+#==============================================================================
+def spreadBits (x, D):
+    """
+    Inserts D-1 zero bits between the bits of integers x
+    """
+    x = np.asarray(x).astype(np.uint64)
+    if D == 2:
+        x &= np.uint64(0x00000000FFFFFFFF)
+        masks = [(16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF),
+                 (4,  0x0F0F0F0F0F0F0F0F), (2, 0x3333333333333333),
+                 (1,  0x5555555555555555)]
+    else:
+        x &= np.uint64(0x1FFFFF)
+        masks = [(32, 0x001F00000000FFFF), (16, 0x001F0000FF0000FF),
+                 (8,  0x100F00F00F00F00F), (4,  0x10C30C30C30C30C3),
+                 (2,  0x1249249249249249)]
+    for shift, mask in masks:
+        x = (x | (x << np.uint64(shift))) & np.uint64(mask)
+    return x
+
+#==============================================================================
+def morton (cells):
+    """
+    Returns Z-order codes (uint64) of integer cell coordinates [..., D]
+    """
+    D    = cells.shape[-1]
+    code = np.zeros(cells.shape[:-1], dtype=np.uint64)
+    for d in range(D):
+        code |= spreadBits(cells[...,d], D) << np.uint64(d)
+    return code
+
+#==============================================================================
+def haveScipy ():
+    try:
+        import scipy.spatial
+        return True
+    except ImportError:
+        return False
+
+#==============================================================================
+class NodeIndex (object):
+    """
+    Spatial index of lon/lat points
+    Args:
+        lon, lat (float np.array [N])  : indexed points, degrees
+        metric   (str)   : 'planar' (degrees) or 'greatcircle' (km)
+        backend  (str)   : 'auto', 'kdtree' (scipy) or 'numpy'
+    """
+    ARRAYS = ('points', 'origin', 'extent', 'codes', 'order')
+
+    def __init__ (self, lon=None, lat=None, metric='planar', backend='auto'):
+        if metric not in ('planar', 'greatcircle'):
+            raise ValueError('Unknown metric ' + str(metric))
+        self.metric  = metric
+        self.backend = backend
+        self.tree    = None
+        self.codes   = None
+        if lon is None:
+            return
+        lon = np.asarray(lon, dtype=float).ravel()
+        lat = np.asarray(lat, dtype=float).ravel()
+        self.lon360 = bool(len(lon) and np.nanmax(lon) > 180.)
+        if metric == 'planar':
+            self.points = np.column_stack((lon, lat))
+        else:
+            self.points = lonLatToXYZ(lon, lat)
+        self.setBackend(backend)
+
+    def __len__ (self):
+        return len(self.points)
+
+    #--------------------------------------------------------------------------
+    def setBackend (self, backend='auto'):
+        """
+        Builds the search structure of the chosen backend
+        """
+        if backend == 'auto':
+            backend = 'kdtree' if haveScipy() else 'numpy'
+        self.backend = backend
+        if backend == 'kdtree':
+            from scipy.spatial import cKDTree
+            self.tree = cKDTree(self.points)
+        elif backend == 'numpy':
+            if self.codes is None:
+                self.buildCodes()
+        else:
+            raise ValueError('Unknown backend ' + str(backend))
+
+    def buildCodes (self):
+        """
+        Sorts the points along the Z-order curve of their bounding cube
+        """
+        N, D = self.points.shape
+        if N:
+            self.origin = self.points.min(axis=0)
+            self.extent = np.float64(1.000001*max(
+                np.max(self.points.max(axis=0) - self.origin), 1e-9))
+        else:
+            self.origin = np.zeros(D)
+            self.extent = np.float64(1.)
+        codes = morton(self.cellOf(self.points, np.array(BITS[D])))
+        self.order = np.argsort(codes, kind='stable')
+        self.codes = codes[self.order]
+
+    #--------------------------------------------------------------------------
+    def cellOf (self, pts, levels):
+        """
+        Integer cell coordinates of points on quadtree level(s)
+        """
+        n = (2**levels).reshape(-1, 1)
+        c = np.floor((pts - self.origin)/self.extent*n).astype(np.int64)
+        return np.clip(c, 0, n-1)
+
+    def ranges (self, q, levels):
+        """
+        Start positions and counts (in the sorted codes) of the 3^D cells
+        around each query on its quadtree level
+        Returns:
+            start, count (int np.arrays [Q, 3^D])
+        """
+        D     = q.shape[1]
+        offs  = np.stack(np.meshgrid(*([np.arange(-1, 2)]*D),
+                                     indexing='ij'), axis=-1).reshape(-1, D)
+        n     = (2**levels)[:,None,None]
+        cells = self.cellOf(q, levels)[:,None,:] + offs[None,:,:]
+        valid = np.all((cells >= 0) & (cells < n), axis=2)
+        shift = (D*(BITS[D] - levels))[:,None].astype(np.uint64)
+        lo    = morton(np.clip(cells, 0, n-1)) << shift
+        hi    = lo + (np.uint64(1) << shift)
+        start = np.searchsorted(self.codes, lo)
+        # the last cell ends at 2^(D*BITS), which wraps to 0 in 3D
+        stop  = np.where(hi > lo, np.searchsorted(self.codes, hi),
+                         len(self.codes))
+        count = np.where(valid, stop - start, 0)
+        return start, count
+
+    def bound (self, q, levels):
+        """
+        Lower bound of the distance from each query to the indexed points
+        lying outside of the 3^D cells around it
+        """
+        n     = (2**levels)[:,None]
+        cell  = self.extent/n
+        c     = self.cellOf(q, levels)
+        top   = self.origin + self.extent
+        blkLo = self.origin + (c - 1)*cell
+        blkHi = self.origin + (c + 2)*cell
+        out2  = np.maximum(np.maximum(self.origin - q, q - top), 0.)**2
+        rest  = out2.sum(axis=1)[:,None] - out2
+        # slabs of the bounding cube beyond each face of the block
+        lo2   = np.where(c > 1,   (q - blkLo)**2 + rest, np.inf)
+        hi2   = np.where(c < n-2, (blkHi - q)**2 + rest, np.inf)
+        return np.sqrt(np.minimum(lo2, hi2).min(axis=1))
+
+    def gather (self, q, start, count):
+        """
+        Expands cell ranges into (query, point, distance) triplets
+        """
+        start = start.ravel()
+        count = count.ravel()
+        C     = len(start)//max(len(q), 1)
+        qq    = np.repeat(np.repeat(np.arange(len(q)), C), count)
+        first = np.repeat(np.cumsum(count) - count, count)
+        pidx  = self.order[np.repeat(start, count) +
+                           np.arange(count.sum()) - first]
+        dist  = np.sqrt(np.sum((self.points[pidx] - q[qq])**2, axis=1))
+        return qq, pidx, dist
+
+    def groups (self, total, maxPairs):
+        """
+        Splits queries into consecutive groups of bounded candidate count
+        """
+        cum = np.cumsum(total)
+        cut = np.searchsorted(cum, np.arange(maxPairs, cum[-1], maxPairs),
+                              side='right') if len(cum) else []
+        return [g for g in np.split(np.arange(len(total)), np.unique(cut))
+                if len(g)]
+
+    def numpyKnn (self, q, k, maxDist, maxPairs=2**22):
+        """
+        k nearest points by the Z-order quadtree search
+        """
+        Q    = len(q)
+        D    = q.shape[1]
+        dist = np.full([Q, k], np.inf)
+        idx  = np.full([Q, k], -1, dtype=int)
+        # finest level whose 3^D neighborhood still holds k points
+        lo = np.zeros(Q, dtype=int)
+        hi = np.full(Q, BITS[D], dtype=int)
+        while np.any(lo < hi):
+            mid = (lo + hi + 1)//2
+            ok  = self.ranges(q, mid)[1].sum(axis=1) >= k
+            lo  = np.where(ok, mid, lo)
+            hi  = np.where(ok, hi, mid - 1)
+        levels = lo
+        todo   = np.arange(Q)
+        while len(todo):
+            start, count = self.ranges(q[todo], levels[todo])
+            for g in self.groups(count.sum(axis=1), maxPairs):
+                sub = todo[g]
+                qq, pidx, d = self.gather(q[sub], start[g], count[g])
+                order = np.lexsort((d, qq))
+                qq, pidx, d = qq[order], pidx[order], d[order]
+                first = np.searchsorted(qq, np.arange(len(sub)))
+                rank  = np.arange(len(qq)) - first[qq]
+                keep  = rank < k
+                dist[sub[qq[keep]], rank[keep]] = d[keep]
+                idx [sub[qq[keep]], rank[keep]] = pidx[keep]
+            # hits closer than the bound are final
+            kth  = dist[todo, k-1]
+            b    = self.bound(q[todo], levels[todo])
+            done = (kth <= b) | (b >= maxDist) | (levels[todo] == 0)
+            # the current k-th distance bounds the true one: jump to
+            # the level whose cells are at least that large
+            jump = np.floor(np.log2(self.extent/np.maximum(kth, 1e-300)))
+            levels[todo] = np.clip(np.minimum(levels[todo] - 1, jump),
+                                   0, None).astype(int)
+            todo = todo[~done]
+        return dist, idx
+
+    def numpyRadius (self, q, radius, maxPairs=2**22):
+        """
+        All points within radius by the Z-order quadtree search
+        """
+        D     = q.shape[1]
+        level = np.log2(self.extent/radius) if radius > 0 else BITS[D]
+        level = int(np.clip(np.floor(level), 0, BITS[D]))
+        start, count = self.ranges(q, np.full(len(q), level, dtype=int))
+        QQ, PP, DD = [np.zeros(0, dtype=int)], [np.zeros(0, dtype=int)], \
+                     [np.zeros(0)]
+        for g in self.groups(count.sum(axis=1), maxPairs):
+            qq, pidx, d = self.gather(q[g], start[g], count[g])
+            keep = d <= radius
+            QQ.append(g[qq[keep]])
+            PP.append(pidx[keep])
+            DD.append(d[keep])
+        return np.concatenate(QQ), np.concatenate(PP), np.concatenate(DD)
+
+    #--------------------------------------------------------------------------
+    def toQuery (self, lon, lat):
+        """
+        Converts query lon/lat to internal coordinates
+        """
+        lat = np.asarray(lat, dtype=float).ravel()
+        if self.metric == 'planar':
+            return np.column_stack((wrapLon(lon, self.lon360).ravel(), lat))
+        return lonLatToXYZ(np.asarray(lon, dtype=float).ravel(), lat)
+
+    def toInternal (self, d):
+        return kmToChord(d) if self.metric == 'greatcircle' else d
+
+    def toExternal (self, d):
+        return chordToKm(d) if self.metric == 'greatcircle' else d
+
+    #--------------------------------------------------------------------------
+    def query (self, lon, lat, k=1, maxDist=np.inf):
+        """
+        Finds k nearest indexed points for each query point
+        Args:
+            lon, lat (float np.array [Q]) : query points, degrees
+            k        (int)   : number of neighbors
+            maxDist  (float) : ignore points farther than that
+                               (degrees or km, per metric)
+        Returns:
+            dist (float np.array [Q,k]) : sorted distances, inf if not found
+            idx  (int np.array [Q,k])   : 0-based point indices, -1 if not found
+        """
+        q = self.toQuery(lon, lat)
+        k = int(min(k, len(self.points)))
+        if k < 1 or len(q) == 0:
+            return (np.full([len(q), max(k, 0)], np.inf),
+                    np.full([len(q), max(k, 0)], -1, dtype=int))
+        m = self.toInternal(maxDist)
+        if self.tree is not None:
+            dist, idx = self.tree.query(q, k=k, distance_upper_bound=m)
+            dist = np.asarray(dist, dtype=float).reshape(len(q), k)
+            idx  = np.asarray(idx).reshape(len(q), k)
+        else:
+            dist, idx = self.numpyKnn(q, k, m)
+        miss = ~(dist <= m)
+        dist[miss] = np.inf
+        idx [miss] = -1
+        return self.toExternal(dist), idx
+
+    def nearest (self, lon, lat, maxDist=np.inf):
+        """
+        Returns distance and 0-based index (np.arrays [Q]) of the
+        nearest indexed point for each query point
+        """
+        dist, idx = self.query(lon, lat, 1, maxDist)
+        return dist[:,0], idx[:,0]
+
+    def queryRadius (self, lon, lat, radius):
+        """
+        Finds all indexed points within radius of each query point
+        Returns:
+            offsets (int np.array [Q+1]), idx, dist (np.arrays):
+                hits of query j, sorted by distance, are
+                idx[offsets[j]:offsets[j+1]]
+        """
+        q = self.toQuery(lon, lat)
+        m = self.toInternal(radius)
+        if self.tree is not None:
+            lists = self.tree.query_ball_point(q, m)
+            count = np.array([len(l) for l in lists], dtype=int)
+            qq    = np.repeat(np.arange(len(q)), count)
+            pidx  = np.concatenate([np.asarray(l, dtype=int) for l in lists]
+                                   + [np.zeros(0, dtype=int)])
+            d     = np.sqrt(np.sum((self.points[pidx] - q[qq])**2, axis=1))
+        else:
+            qq, pidx, d = self.numpyRadius(q, m)
+        order   = np.lexsort((d, qq))
+        counts  = np.bincount(qq, minlength=len(q))
+        offsets = np.concatenate(([0], np.cumsum(counts)))
+        return offsets, pidx[order], self.toExternal(d[order])
+
+    #--------------------------------------------------------------------------
+    def toArrays (self):
+        """
+        Returns the index as flat arrays and metadata (for caching)
+        """
+        if self.codes is None:
+            self.buildCodes()
+        arrays = dict([(a, np.asarray(getattr(self, a))) for a in self.ARRAYS])
+        meta   = {'metric' : self.metric, 'lon360' : self.lon360}
+        return arrays, meta
+
+    @classmethod
+    def fromArrays (cls, arrays, meta, backend='auto'):
+        """
+        Inverse of toArrays(); the sorted codes are used as is,
+        a KD-tree is rebuilt from the stored points
+        """
+        index = cls(metric=meta['metric'])
+        index.lon360 = meta['lon360']
+        for a in cls.ARRAYS:
+            setattr(index, a, arrays[a])
+        index.extent = np.float64(index.extent)
+        index.setBackend(backend)
+        return index
+
+#==============================================================================
+def build (grid, metric='planar', backend='auto', gridFile=None, cache=False):
+    """
+    Builds spatial index of the grid nodes
+    Args:
+        grid (dict or adcirc.Grid) : as returned by adcirc.readGrid
+        metric (str)        : 'planar' or 'greatcircle'
+        backend (str)       : 'auto', 'kdtree' or 'numpy'
+        gridFile (str)      : cache key (default: grid.path)
+        cache (bool or str) : if True, or a path to the cache directory,
+                              the index is kept next to the grid in
+                              models.gridcache
+    Returns:
+        NodeIndex
+    """
+    from csdllib.models import gridcache
+
+    if gridFile is None:
+        gridFile = getattr(grid, 'path', None)
+    cacheDir = cache if isinstance(cache, str) else None
+    product  = 'spatial.' + metric
+    if cache and gridFile is not None:
+        hit = gridcache.fetch(gridFile, product, cacheDir)
+        if hit is not None:
+            return NodeIndex.fromArrays(hit[0], hit[1], backend)
+
+    oper.sys.msg('i', 'Building spatial index of ' + str(grid['NP']) +
+                 ' nodes...')
+    index = NodeIndex(grid['lon'], grid['lat'], metric, backend)
+    if cache and gridFile is not None:
+        arrays, meta = index.toArrays()
+        gridcache.store(gridFile, product, arrays, meta, cacheDir=cacheDir)
+    return index
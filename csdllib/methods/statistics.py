@@ -3,6 +3,7 @@
 """
 
 import numpy as np
+from csdllib import oper
 
 #==============================================================================
 def rms(V):
@@ -36,8 +37,11 @@ def peak(m, d):
 def plag(dates, m, d):
     """
     Returns m peak lag occurrence with respect to peak in d, in minutes
+    (dates are datetime or datetime64)
     """    
-    return (dates[np.nanargmax(m)] - dates[np.nanargmax(d)]).total_seconds()/60.
+    dates = np.asarray(dates).astype('datetime64[us]')
+    return (dates[np.nanargmax(m)] - dates[np.nanargmax(d)]) / \
+           np.timedelta64(1, 'm')
 
 #==============================================================================
 def varExplained(m, d):
@@ -74,7 +78,7 @@ def rValue(m, d):
 def metrics (data, model, dates):
     """    
     data and model (np.arrays) projected on the 
-    same time scale 'dates' (datetime)
+    same time scale 'dates' (datetime or datetime64)
     Computes: 
         rmsd - root mean square difference, in data units 
         peak - difference in max values in data and model, in data units
@@ -96,8 +100,9 @@ def metrics (data, model, dates):
     if npts:
         rmsd = rms(model-data)
         peak = np.nanmax(model) - np.nanmax(data)
-        plag = (dates[np.nanargmax(model)] - dates[np.nanargmax(data)]).total_seconds() 
-        plag = plag/60. #in minutes
+        dates = np.asarray(dates).astype('datetime64[us]')
+        plag = (dates[np.nanargmax(model)] - dates[np.nanargmax(data)]) / \
+               np.timedelta64(1, 'm') #in minutes
         bias = np.nanmean(model) - np.nanmean(data)
         vexp = varExplained (model, data)
         skil = skill (model, data)
@@ -111,3 +116,323 @@ def metrics (data, model, dates):
             'skil': skil,
             'rval': rval,
             'npts': npts}
+
+#==============================================================================
+def harmonicErrors (model, data):
+    """
+    Compares harmonic constants of model and data,
+    as returned by harmonics.analyze, over their common constituents.
+    Computes, per station and constituent:
+        amp   - amplitude difference, in data units
+        phase - phase difference, in degrees within [-180, 180)
+        vdif  - magnitude of the vector (complex) difference, in data units
+    and per station:
+        rss   - root sum of squares of the constituent differences,
+                sqrt(sum(vdif**2)/2), in data units
+    """
+    names = [n for n in data['names'] if n in model['names']]
+    im = [model['names'].index(n) for n in names]
+    idd = [data['names'].index(n) for n in names]
+    Am = np.asarray(model['amplitude'])[..., im]
+    Gm = np.asarray(model['phase'])[..., im]
+    Ad = np.asarray(data['amplitude'])[..., idd]
+    Gd = np.asarray(data['phase'])[..., idd]
+    vdif = np.abs(Am*np.exp(1j*np.radians(Gm)) - Ad*np.exp(1j*np.radians(Gd)))
+    return {'names': names,
+            'amp'  : Am - Ad,
+            'phase': np.mod(Gm - Gd + 180., 360.) - 180.,
+            'vdif' : vdif,
+            'rss'  : np.sqrt(np.sum(vdif**2, axis=-1)/2.)}
+
+METRICS = ('rmsd', 'peak', 'plag', 'bias', 'vexp', 'skil', 'rval', 'npts')
+
+#==============================================================================
+def batchMetrics (data, model, dates):
+    """    
+    Computes metrics() for many stations at once, with masked reductions
+    along the time axis (same results as metrics() station by station)
+    Args:
+        data and model (np.arrays [stations x time]) projected on the
+        same time scale 'dates' (datetime or datetime64 np.array [time]),
+        NaN (or masked) where missing
+    Returns:
+        structured np.array [stations] with fields 'rmsd', 'peak', 'plag',
+        'bias', 'vexp', 'skil', 'rval' (float) and 'npts' (int),
+        see metrics(); NaN metrics where a station has no valid pairs
+    """
+    d  = np.atleast_2d(np.ma.filled(np.ma.asarray(data,  dtype=float), np.nan))
+    m  = np.atleast_2d(np.ma.filled(np.ma.asarray(model, dtype=float), np.nan))
+    dv = ~np.isnan(d)
+    mv = ~np.isnan(m)
+    pv = dv & mv
+    nd = dv.sum(axis=1)
+    nm = mv.sum(axis=1)
+    n  = pv.sum(axis=1)
+
+    out = np.zeros(len(d), dtype=[(k, 'i8' if k == 'npts' else 'f8')
+                                  for k in METRICS])
+    for k in METRICS[:-1]:
+        out[k] = np.nan
+    out['npts'] = n
+    ok = n > 0
+    if not np.any(ok):
+        return out
+    d, m, dv, mv, pv, nd, nm, n = (a[ok] for a in (d, m, dv, mv, pv,
+                                                   nd, nm, n))
+
+    # means of each series over its own valid values
+    meanD = np.where(dv, d, 0.).sum(axis=1)/nd
+    meanM = np.where(mv, m, 0.).sum(axis=1)/nm
+    dd    = np.where(dv, d - meanD[:,None], 0.)
+    dm    = np.where(mv, m - meanM[:,None], 0.)
+    diff  = np.where(pv, m - d, 0.)
+    sumD2 = np.sum(dd**2, axis=1)
+    sumM2 = np.sum(dm**2, axis=1)
+    sumE2 = np.sum(diff**2, axis=1)
+
+    imax = np.argmax(np.where(mv, m, -np.inf), axis=1)
+    jmax = np.argmax(np.where(dv, d, -np.inf), axis=1)
+    rows = np.arange(len(d))
+    dates = np.asarray(dates).astype('datetime64[us]')
+
+    meanE = diff.sum(axis=1)/n
+    stdE  = np.sqrt(np.sum(np.where(pv, diff - meanE[:,None], 0.)**2,
+                           axis=1)/n)
+    stdD  = np.sqrt(sumD2/nd)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        vexp = np.clip(100.*(stdD - stdE)/stdD, 0., 100.)
+        pot  = np.where(pv, (np.abs(m - meanD[:,None]) +
+                             np.abs(d - meanD[:,None]))**2, 0.)
+        skil = 1. - sumE2/pot.sum(axis=1)
+        rval = np.sum(dd*dm*pv, axis=1)/(np.sqrt(sumD2)*np.sqrt(sumM2))
+
+    res = out[ok]
+    res['rmsd'] = np.sqrt(sumE2/n)
+    res['peak'] = m[rows, imax] - d[rows, jmax]
+    res['plag'] = (dates[imax] - dates[jmax])/np.timedelta64(1, 'm')
+    res['bias'] = meanM - meanD
+    res['vexp'] = vexp
+    res['skil'] = skil
+    res['rval'] = rval
+    out[ok] = res
+    return out
+
+#==============================================================================
+def chanMerge (nA, meanA, m2A, nB, meanB, m2B):
+    """
+    Merges count, mean and sum of squared deviations of two parts
+    (Chan et al. pairwise update)
+    Returns:
+        mean, m2 of the union (0 where it is empty)
+    """
+    n = nA + nB
+    with np.errstate(invalid='ignore', divide='ignore'):
+        delta = meanB - meanA
+        frac  = np.where(n > 0, nB/np.maximum(n, 1), 0.)
+        mean  = meanA + delta*frac
+        m2    = m2A + m2B + delta**2*nA*frac
+    return mean, m2
+
+#==============================================================================
+class MetricAccumulator (object):
+    """
+    Running sums behind metrics() for many stations, updated one time
+    chunk at a time and mergeable across time periods (e.g. computed in
+    different processes): counts, means and sums of squared deviations
+    of data, model and their difference, the data-model co-moment,
+    peaks with their times and the terms of the skill denominator.
+    result() gives the same numbers as batchMetrics() on the whole
+    series, up to floating point round-off.
+    The skill denominator sum((|m-c| + |d-c|)**2) needs c, the data mean
+    over the whole series, before the sums start, so skill takes a second
+    pass over the data:
+
+        acc = MetricAccumulator(S)                    # pass 1 (any parts)
+        ...acc.update(data, model, dates) / acc.merge(part)...
+        acc2 = MetricAccumulator(S, center=acc.dataMean())   # pass 2
+        ...same updates and merges...
+        stats = acc2.result()
+
+    The center must be the exact data mean from the first pass: without
+    a center, or with any other one, result() gives NaN skill (and a
+    warning); all other metrics are exact after the first pass.
+    Args:
+        S      (int) : number of stations
+        center (float or np.array [S]) : data mean per station from the
+                     first pass (parts to merge must have the same centers)
+    """
+    def __init__ (self, S, center=None):
+        self.S = S
+        self.center = np.full(S, np.nan) if center is None else \
+                      np.array(np.broadcast_to(np.asarray(center, dtype=float),
+                                               (S,)))
+        for name in ('nd', 'nm', 'n'):
+            setattr(self, name, np.zeros(S, dtype=np.int64))
+        for name in ('meanD', 'm2D', 'meanM', 'm2M', 'pd', 'pm',
+                     'm2PD', 'm2PM', 'cDM', 'meanE', 'm2E', 'sUW'):
+            setattr(self, name, np.zeros(S))
+        self.nSkill = np.zeros(S, dtype=np.int64)
+        self.maxD  = np.full(S, -np.inf)
+        self.maxM  = np.full(S, -np.inf)
+        self.tmaxD = np.full(S, np.datetime64('NaT'), dtype='datetime64[us]')
+        self.tmaxM = np.full(S, np.datetime64('NaT'), dtype='datetime64[us]')
+
+    @classmethod
+    def fromChunk (cls, data, model, dates, center):
+        """
+        Sums of one chunk of data and model (np.arrays [S x time] on dates)
+        about center (None, or NaN where skill sums are not kept)
+        """
+        d  = np.atleast_2d(np.ma.filled(np.ma.asarray(data,  dtype=float),
+                                        np.nan))
+        m  = np.atleast_2d(np.ma.filled(np.ma.asarray(model, dtype=float),
+                                        np.nan))
+        dates = np.asarray(dates).astype('datetime64[us]')
+        acc = cls(len(d), center)
+        dv = ~np.isnan(d)
+        mv = ~np.isnan(m)
+        pv = dv & mv
+        acc.nd = dv.sum(axis=1)
+        acc.nm = mv.sum(axis=1)
+        acc.n  = pv.sum(axis=1)
+
+        acc.meanD = np.where(dv, d, 0.).sum(axis=1)/np.maximum(acc.nd, 1)
+        acc.meanM = np.where(mv, m, 0.).sum(axis=1)/np.maximum(acc.nm, 1)
+        acc.m2D   = np.sum(np.where(dv, d - acc.meanD[:,None], 0.)**2, axis=1)
+        acc.m2M   = np.sum(np.where(mv, m - acc.meanM[:,None], 0.)**2, axis=1)
+
+        # moments over the valid pairs
+        n = np.maximum(acc.n, 1)
+        acc.pd = np.where(pv, d, 0.).sum(axis=1)/n
+        acc.pm = np.where(pv, m, 0.).sum(axis=1)/n
+        ed = np.where(pv, d - acc.pd[:,None], 0.)
+        em = np.where(pv, m - acc.pm[:,None], 0.)
+        acc.m2PD = np.sum(ed**2, axis=1)
+        acc.m2PM = np.sum(em**2, axis=1)
+        acc.cDM  = np.sum(ed*em, axis=1)
+        e = np.where(pv, m - d, 0.)
+        acc.meanE = e.sum(axis=1)/n
+        acc.m2E   = np.sum(np.where(pv, e - acc.meanE[:,None], 0.)**2, axis=1)
+
+        # cross term of the skill denominator about the center
+        sv = pv & ~np.isnan(acc.center)[:,None]
+        c  = np.nan_to_num(acc.center)[:,None]
+        u  = np.where(sv, m - c, 0.)
+        w  = np.where(sv, d - c, 0.)
+        s  = np.where(u*w >= 0., 1., -1.)*sv
+        acc.nSkill = sv.sum(axis=1)
+        acc.sUW = np.sum(s*u*w, axis=1)
+
+        rows = np.arange(len(d))
+        if len(dates):
+            for x, valid, name in ((d, dv, 'D'), (m, mv, 'M')):
+                arg = np.argmax(np.where(valid, x, -np.inf), axis=1)
+                has = valid.any(axis=1)
+                getattr(acc, 'max'  + name)[has] = x[rows, arg][has]
+                getattr(acc, 'tmax' + name)[has] = dates[arg][has]
+        return acc
+
+    def update (self, data, model, dates):
+        """
+        Adds a time chunk of data and model (np.arrays [S x time],
+        NaN or masked where missing) on dates (datetime or datetime64)
+        """
+        return self.merge(self.fromChunk(data, model, dates, self.center))
+
+    def merge (self, other):
+        """
+        Merges sums of the same stations over other times
+        """
+        both = (self.nSkill > 0) & (other.nSkill > 0)
+        if np.any(both & (self.center != other.center)):
+            raise ValueError('Parts are summed about different centers, '
+                             'pass the same center to all of them.')
+        take = (self.nSkill == 0) & (other.nSkill > 0)
+        self.center[take] = other.center[take]
+        self.nSkill += other.nSkill
+
+        self.meanD, self.m2D = chanMerge(self.nd, self.meanD, self.m2D,
+                                         other.nd, other.meanD, other.m2D)
+        self.meanM, self.m2M = chanMerge(self.nm, self.meanM, self.m2M,
+                                         other.nm, other.meanM, other.m2M)
+        self.meanE, self.m2E = chanMerge(self.n, self.meanE, self.m2E,
+                                         other.n, other.meanE, other.m2E)
+        # co-moment of the pairs, as in chanMerge
+        n = self.n + other.n
+        with np.errstate(invalid='ignore', divide='ignore'):
+            frac = np.where(n > 0, other.n/np.maximum(n, 1), 0.)
+            self.cDM += other.cDM + (other.pd - self.pd)*(other.pm - self.pm)*\
+                        self.n*frac
+        self.pd, self.m2PD = chanMerge(self.n, self.pd, self.m2PD,
+                                       other.n, other.pd, other.m2PD)
+        self.pm, self.m2PM = chanMerge(self.n, self.pm, self.m2PM,
+                                       other.n, other.pm, other.m2PM)
+        self.sUW += other.sUW
+
+        for name in ('D', 'M'):
+            mx, omx = getattr(self, 'max' + name), getattr(other, 'max' + name)
+            t,  ot  = getattr(self, 'tmax' + name), getattr(other, 'tmax' + name)
+            # the first occurrence wins ties
+            upd = (omx > mx) | ((omx == mx) & (ot < t))
+            mx[upd] = omx[upd]
+            t [upd] = ot [upd]
+
+        self.nd += other.nd
+        self.nm += other.nm
+        self.n  += other.n
+        return self
+
+    def dataMean (self):
+        """
+        Returns data mean per station (NaN if no data), the center
+        of the second pass
+        """
+        return np.where(self.nd > 0, self.meanD, np.nan)
+
+    def result (self):
+        """
+        Returns:
+            structured np.array [S], as batchMetrics(); skill is NaN
+            unless the skill sums are about the data mean (second pass)
+        """
+        out = np.zeros(self.S, dtype=[(k, 'i8' if k == 'npts' else 'f8')
+                                      for k in METRICS])
+        for k in METRICS[:-1]:
+            out[k] = np.nan
+        out['npts'] = self.n
+        ok = self.n > 0
+        n, nd = self.n[ok], self.nd[ok]
+        meanD, meanM = self.meanD[ok], self.meanM[ok]
+        pd, pm = self.pd[ok], self.pm[ok]
+        sumE2 = self.m2E[ok] + n*self.meanE[ok]**2
+
+        # skill denominator at the data mean, the sign of each cross
+        # term depends on the center, so sUW holds only if it was summed
+        # over all pairs about the data mean itself
+        c     = meanD
+        pot   = self.m2PM[ok] + n*(pm - c)**2 + \
+                self.m2PD[ok] + n*(pd - c)**2 + 2.*self.sUW[ok]
+        exact = (self.nSkill[ok] == n) & \
+                (np.abs(c - self.center[ok]) <= 1e-9*np.maximum(1., np.abs(c)))
+        if not np.all(exact):
+            oper.sys.msg('w', 'Skill of ' + str(np.count_nonzero(~exact)) +
+                         ' station(s) needs a second pass about the data '
+                         'mean, see MetricAccumulator.')
+        stdD  = np.sqrt(self.m2D[ok]/nd)
+        stdE  = np.sqrt(self.m2E[ok]/n)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            vexp = np.clip(100.*(stdD - stdE)/stdD, 0., 100.)
+            skil = np.where(exact, 1. - sumE2/pot, np.nan)
+            rval = (self.cDM[ok] + n*(pd - meanD)*(pm - meanM)) / \
+                   (np.sqrt(self.m2D[ok])*np.sqrt(self.m2M[ok]))
+
+        res = out[ok]
+        res['rmsd'] = np.sqrt(sumE2/n)
+        res['peak'] = self.maxM[ok] - self.maxD[ok]
+        res['plag'] = (self.tmaxM[ok] - self.tmaxD[ok])/np.timedelta64(1, 'm')
+        res['bias'] = meanM - meanD
+        res['vexp'] = vexp
+        res['skil'] = skil
+        res['rval'] = rval
+        out[ok] = res
+        return out
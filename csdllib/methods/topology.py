@@ -0,0 +1,156 @@
+"""
+Unstructured mesh topology: node-to-element adjacency, unique edges
+with their elements, element and node neighbors.
+All tables are built with vectorized sort/unique over grid['Elements']
+(1-based node numbers, as in fort.14). Returned node and element
+indices are 0-based; -1 marks a missing neighbor.
+Ragged tables are stored as CSR pairs (offsets, values): the entries
+of row i are values[offsets[i]:offsets[i+1]].
+
+@author: grapesh@gmail.com
+"""
+
+import numpy as np
+from csdllib import oper
+
+#==============================================================================
+def row (offsets, values, i):
+    """
+    Returns i-th row of a CSR table
+    """
+    return values[offsets[i]:offsets[i+1]]
+
+#==============================================================================
+def csrFromPairs (rows, cols, nRows):
+    """
+    Groups cols by rows into CSR table (offsets, values),
+    keeping the original order within each row
+    """
+    order   = np.argsort(rows, kind='stable')
+    counts  = np.bincount(rows, minlength=nRows)
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    return offsets, cols[order]
+
+#==============================================================================
+def nodeElements (elements, NP=None):
+    """
+    Builds node-to-element adjacency
+    Args:
+        elements (int np.array [NE,3]) : 1-based node numbers
+        NP       (int)                 : number of nodes (default=max node)
+    Returns:
+        offsets (int np.array [NP+1]), elems (int np.array [3*NE]):
+            elements around node n (1-based) are
+            elems[offsets[n-1]:offsets[n]]
+    """
+    nodes = np.asarray(elements).ravel() - 1
+    if NP is None:
+        NP = nodes.max() + 1
+    elems = np.arange(len(nodes)) // 3
+    return csrFromPairs(nodes, elems, NP)
+
+#==============================================================================
+def edges (elements, NP=None):
+    """
+    Builds unique edge list of the mesh
+    Args:
+        elements (int np.array [NE,3]) : 1-based node numbers
+    Returns:
+        edges        (int np.array [NED,2]) : 0-based node pairs, a < b
+        edgeElements (int np.array [NED,2]) : elements sharing the edge,
+                                              second is -1 on the boundary
+        elementEdges (int np.array [NE,3])  : edge numbers of the element
+                                              sides (n0,n1),(n1,n2),(n2,n0)
+    """
+    e  = np.asarray(elements).reshape(-1, 3) - 1
+    NE = len(e)
+    if NP is None:
+        NP = e.max() + 1 if NE else 0
+    half = np.stack((e, np.roll(e, -1, axis=1)), axis=2).reshape(-1, 2)
+    half.sort(axis=1)
+    key  = half[:,0].astype(np.int64)*NP + half[:,1]
+    ukey, first, inverse, counts = np.unique(key, return_index=True,
+                                             return_inverse=True,
+                                             return_counts=True)
+    myEdges = half[first]
+
+    order  = np.argsort(inverse, kind='stable')
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    myEdgeElements = np.full([len(ukey), 2], -1, dtype=int)
+    myEdgeElements[:,0] = order[starts] // 3
+    shared = counts > 1
+    myEdgeElements[shared,1] = order[starts[shared]+1] // 3
+    if np.any(counts > 2):
+        oper.sys.msg('w', 'Mesh has ' + str(np.count_nonzero(counts > 2)) +
+                     ' edges shared by more than two elements.')
+
+    return myEdges, myEdgeElements, inverse.reshape(NE, 3)
+
+#==============================================================================
+def elementNeighbors (edgeElements, elementEdges):
+    """
+    Returns neighbors (int np.array [NE,3]) across the element edges
+    (n0,n1),(n1,n2),(n2,n0); -1 on the boundary
+    """
+    pairs = edgeElements[elementEdges]
+    me    = np.arange(len(elementEdges))[:,None]
+    return np.where(pairs[:,:,0] == me, pairs[:,:,1], pairs[:,:,0])
+
+#==============================================================================
+def nodeNeighbors (edges, NP):
+    """
+    Builds node-to-node adjacency from the edge list
+    Returns:
+        offsets (int np.array [NP+1]), neighbors (int np.array [2*NED]):
+            0-based neighbors of node n (1-based) are
+            neighbors[offsets[n-1]:offsets[n]]
+    """
+    a = np.concatenate((edges[:,0], edges[:,1]))
+    b = np.concatenate((edges[:,1], edges[:,0]))
+    return csrFromPairs(a, b, NP)
+
+#==============================================================================
+def build (grid, gridFile=None, cache=False):
+    """
+    Computes mesh topology of the grid
+    Args:
+        grid (dict or adcirc.Grid) : as returned by adcirc.readGrid
+        gridFile (str)  : fort.14 the grid was read from, used as the
+                          cache key (default: grid.path)
+        cache (bool or str) : if True, or a path to the cache directory,
+                          the topology is kept next to the grid in
+                          models.gridcache
+    Returns:
+        dict:
+        'nodeElementOffsets', 'nodeElements'   : node-to-element CSR
+        'edges', 'edgeElements', 'elementEdges': see edges()
+        'elementNeighbors'                     : see elementNeighbors()
+        'nodeNeighborOffsets', 'nodeNeighbors' : node-to-node CSR
+        'boundaryEdges'                        : indices of boundary edges
+    """
+    from csdllib.models import gridcache
+
+    if gridFile is None:
+        gridFile = getattr(grid, 'path', None)
+    cacheDir = cache if isinstance(cache, str) else None
+    if cache and gridFile is not None:
+        hit = gridcache.fetch(gridFile, 'topology', cacheDir)
+        if hit is not None:
+            return hit[0]
+
+    oper.sys.msg('i', 'Computing mesh topology...')
+    NP = grid['NP']
+    topo = dict()
+    topo['nodeElementOffsets'], topo['nodeElements'] = \
+        nodeElements(grid['Elements'], NP)
+    topo['edges'], topo['edgeElements'], topo['elementEdges'] = \
+        edges(grid['Elements'], NP)
+    topo['elementNeighbors'] = \
+        elementNeighbors(topo['edgeElements'], topo['elementEdges'])
+    topo['nodeNeighborOffsets'], topo['nodeNeighbors'] = \
+        nodeNeighbors(topo['edges'], NP)
+    topo['boundaryEdges'] = np.flatnonzero(topo['edgeElements'][:,1] < 0)
+
+    if cache and gridFile is not None:
+        gridcache.store(gridFile, 'topology', topo, cacheDir=cacheDir)
+    return topo
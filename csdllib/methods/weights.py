@@ -0,0 +1,234 @@
+"""
+Persistent interpolation operators.
+
+An Operator holds the sparse (targets x sources) weight matrix of an
+interpolation from one point set to another, built once by inverse
+distance weighting, nearest-node matching or barycentric interpolation
+on the mesh. Operators are saved to disk keyed by hashes of the source
+and target coordinates (and of the method), so a forecast cycle on the
+same mesh and station list reuses the weights of the previous one and
+interpolating a new field is a single sparse product:
+
+    op = weights.build(grid['lon'], grid['lat'], stLon, stLat,
+                       method='barycentric', grid=grid, cache=True)
+    values = op.apply(field)
+
+@author: grapesh@gmail.com
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+import numpy as np
+from csdllib import oper
+from csdllib.methods import spatial, interp
+from csdllib.methods.locate import SparseWeights, Locator
+
+FORMAT    = 1
+META_FILE = 'meta.json'
+METHODS   = ('idw', 'nearest', 'barycentric')
+
+#==============================================================================
+def coordKey (lon, lat, *extra):
+    """
+    Returns hex digest of point coordinates (and of any extra arrays)
+    """
+    h = hashlib.blake2b(digest_size=20)
+    for a in (lon, lat) + extra:
+        a = np.ascontiguousarray(a, dtype=np.float64).ravel()
+        h.update(str(len(a)).encode())
+        h.update(a.tobytes())
+    return h.hexdigest()
+
+#==============================================================================
+def idwWeights (srcLon, srcLat, dstLon, dstLat, k=8, p=2,
+                metric='planar', maxDist=np.inf, backend='auto'):
+    """
+    Inverse distance weights over k nearest sources
+    (as interp.shepardIDW over all sources when k is None)
+    Returns:
+        SparseWeights [Q x N]
+    """
+    N = len(np.ravel(srcLon))
+    index = spatial.NodeIndex(srcLon, srcLat, metric, backend)
+    dist, idx = index.query(dstLon, dstLat, k=N if k is None else k,
+                            maxDist=maxDist)
+    return SparseWeights.fromDense(idx, interp.inverseDistance(dist, p), N)
+
+#==============================================================================
+def nearestWeights (srcLon, srcLat, dstLon, dstLat,
+                    metric='planar', maxDist=np.inf, backend='auto'):
+    """
+    Nearest source weights (one weight of 1 per target)
+    Returns:
+        SparseWeights [Q x N]
+    """
+    N = len(np.ravel(srcLon))
+    index = spatial.NodeIndex(srcLon, srcLat, metric, backend)
+    dist, idx = index.query(dstLon, dstLat, k=1, maxDist=maxDist)
+    return SparseWeights.fromDense(idx, np.ones(idx.shape), N)
+
+#==============================================================================
+class Operator (object):
+    """
+    Interpolation operator from source to target points
+    Args:
+        weights (SparseWeights) : [targets x sources]
+        method  (str)  : 'idw', 'nearest' or 'barycentric'
+        params  (dict) : parameters the weights were built with
+        key     (str)  : hash of the sources, targets, method and params
+    """
+    def __init__ (self, weights, method, params=None, key=None):
+        self.weights = weights
+        self.method  = method
+        self.params  = params or {}
+        self.key     = key
+
+    def __repr__ (self):
+        return ('Operator(' + self.method + ', ' + str(self.shape[1]) +
+                ' -> ' + str(self.shape[0]) + ' points)')
+
+    @property
+    def shape (self):
+        return self.weights.shape
+
+    def apply (self, field):
+        """
+        Interpolates field (np.array [..., nSources]) onto the targets
+        Returns:
+            np.array [..., nTargets]
+        """
+        return self.weights.apply(field)
+
+    def __matmul__ (self, field):
+        return self.apply(field)
+
+    def save (self, path, replace=True):
+        """
+        Saves the operator to directory path. An existing operator
+        is replaced, or kept if not replace (the new one is discarded).
+        """
+        from csdllib.models import gridcache
+        parent = os.path.dirname(os.path.abspath(path))
+        os.makedirs(parent, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=parent, prefix='.op.')
+        arrays = self.weights.toArrays()
+        for name, value in arrays.items():
+            np.save(os.path.join(tmp, name + '.npy'), value,
+                    allow_pickle=False)
+        with open(os.path.join(tmp, META_FILE), 'w') as f:
+            json.dump({'format' : FORMAT,
+                       'method' : self.method,
+                       'params' : self.params,
+                       'key'    : self.key}, f)
+        return gridcache.publish(tmp, path, keep=not replace and
+                                 Operator.load(path) is not None)
+
+    @classmethod
+    def load (cls, path):
+        """
+        Opens operator saved by save(), arrays are memory-mapped.
+        Returns None if there is no (valid) operator at path.
+        """
+        try:
+            with open(os.path.join(path, META_FILE)) as f:
+                info = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if info.get('format') != FORMAT:
+            return None
+        arrays = dict()
+        try:
+            for name in SparseWeights.ARRAYS:
+                arrays[name] = np.load(os.path.join(path, name + '.npy'),
+                                       mmap_mode='r', allow_pickle=False)
+        except (IOError, OSError, ValueError):
+            # replaced or evicted by another process meanwhile
+            return None
+        return cls(SparseWeights.fromArrays(arrays), info['method'],
+                   info['params'], info['key'])
+
+#==============================================================================
+def operatorDir (cacheDir=None):
+    """
+    Returns directory of the saved operators in the csdllib cache
+    """
+    from csdllib.models import gridcache
+    return os.path.join(gridcache.getCacheDir(cacheDir), gridcache.OPERATORS)
+
+#==============================================================================
+def build (srcLon, srcLat, dstLon, dstLat, method='idw', grid=None,
+           k=8, p=2, metric='planar', maxDist=np.inf, fallback=None,
+           backend='auto', cache=False, maxBytes=None):
+    """
+    Builds (or opens the saved) interpolation operator
+    Args:
+        srcLon, srcLat (float np.array [N]) : source points, e.g. grid nodes
+        dstLon, dstLat (float np.array [Q]) : target points, e.g. stations
+        method (str)   : 'idw'         - inverse distance weighting over
+                                         k nearest sources (all if None)
+                                         with power p
+                         'nearest'     - nearest source
+                         'barycentric' - linear on the mesh elements,
+                                         needs grid (sources are its nodes)
+        metric (str)   : 'planar' or 'greatcircle' (idw and nearest)
+        maxDist (float): ignore sources farther than that (idw and nearest)
+        fallback (str) : None or 'nearest' for targets outside the mesh
+                         (barycentric)
+        cache (bool or str) : if True, or a path to the cache directory,
+                         the operator is saved to and reused from it
+        maxBytes (int) : cache size limit enforced after saving
+                         (default gridcache.MAX_BYTES)
+    Returns:
+        Operator
+    """
+    if method not in METHODS:
+        oper.sys.msg('e', 'Unknown interpolation method ' + str(method))
+        return
+    if method == 'barycentric':
+        if grid is None:
+            oper.sys.msg('e', 'Barycentric interpolation needs the grid.')
+            return
+        srcLon, srcLat = grid['lon'], grid['lat']
+        params = {'fallback' : fallback}
+        extra  = (grid['Elements'],)
+    elif method == 'idw':
+        params = {'k' : k, 'p' : p, 'metric' : metric,
+                  'maxDist' : float(maxDist)}
+        extra  = ()
+    else:
+        params = {'metric' : metric, 'maxDist' : float(maxDist)}
+        extra  = ()
+
+    key = hashlib.blake2b(digest_size=20)
+    key.update((coordKey(srcLon, srcLat, *extra) + '|' +
+                coordKey(dstLon, dstLat) + '|' + method + '|' +
+                json.dumps(params, sort_keys=True)).encode())
+    key = key.hexdigest()
+
+    from csdllib.models import gridcache
+    path     = None
+    cacheDir = cache if isinstance(cache, str) else None
+    if cache:
+        path = os.path.join(operatorDir(cacheDir), key)
+        op = Operator.load(path)
+        if op is not None:
+            gridcache.touch(path, META_FILE)
+            return op
+
+    oper.sys.msg('i', 'Computing ' + method + ' interpolation weights...')
+    if method == 'barycentric':
+        w = Locator(grid, backend).weights(dstLon, dstLat, fallback)
+    elif method == 'idw':
+        w = idwWeights(srcLon, srcLat, dstLon, dstLat, k, p,
+                       metric, maxDist, backend)
+    else:
+        w = nearestWeights(srcLon, srcLat, dstLon, dstLat,
+                           metric, maxDist, backend)
+    op = Operator(w, method, params, key)
+    if path is not None:
+        op.save(path, replace=False)
+        gridcache.evict(cacheDir, gridcache.MAX_BYTES if maxBytes is None
+                        else maxBytes, keep=path)
+    return op
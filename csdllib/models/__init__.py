@@ -2,4 +2,6 @@ from . import adcirc
 from . import etss
 from . import estofs
 from . import nyhops
-__all__ = ['adcirc','etss','estofs','nyhops']
+from . import gridcache
+from . import ensemble
+__all__ = ['adcirc','etss','estofs','nyhops','gridcache','ensemble']
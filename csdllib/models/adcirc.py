@@ -2,149 +2,552 @@
 @author: grapesh@gmail.com
 """
 
+import io
 import os
+import re
+import itertools
+import functools
+from collections.abc import Mapping
 import numpy as np
 from datetime import datetime
-from datetime import timedelta
 import netCDF4
-from csdllib.oper.sys import msg
+from csdllib.oper.sys import msg, parseBaseDate, decodeTime
 
 #==============================================================================
-def readGrid ( gridFile, verbose=1):
+def readBlock (f, nRows, nCols, dtype=float):
+    """
+    Reads a whitespace-delimited table of nRows lines from the open file
+    in one bulk pass, instead of splitting it line by line.
+    Args:
+        f      (file) : file object positioned at the first row of the table
+        nRows  (int)  : number of lines to read
+        nCols  (int)  : number of leading columns to keep
+        dtype         : type of the returned array (default=float)
+    Returns:
+        block (np.array [nRows, nCols])
+    Note:
+        Lines that the bulk parser rejects (e.g. trailing text comments)
+        are handled by a slower per-line fallback that keeps the first
+        nCols tokens of each line.
+    """
+    lines = list(itertools.islice(f, nRows))
+    if len(lines) < nRows:
+        raise ValueError('Expected ' + str(nRows) + ' lines, got ' +
+                         str(len(lines)) + '.')
+    if nRows == 0:
+        return np.zeros([0, nCols], dtype=dtype)
+    block = None
+    try:
+        block = np.loadtxt(lines, dtype=dtype, usecols=range(nCols),
+                           comments='!', ndmin=2)
+    except ValueError:
+        pass
+    if block is None or block.shape != (nRows, nCols):
+        block = np.array([line.split()[:nCols] for line in lines],
+                         dtype=float).reshape(nRows, nCols)
+    return block.astype(dtype, copy=False)
+
+# Per-node columns of the flow boundary lines, after the node number,
+# by IBTYPE. Lines of other types are stored with their node numbers only.
+FLOW_COLUMNS = dict(
+    [(t, ()) for t in [0,1,2,10,11,12,20,21,22,30]] +
+    [(t, ('BARLANHT','BARLANCFSP')) for t in [3,13,23]] +
+    [(t, ('IBCONN','BARINHT','BARINCFSB','BARINCFSP')) for t in [4,24]] +
+    [(t, ('IBCONN','BARINHT','BARINCFSB','BARINCFSP',
+          'PIPEHT','PIPECOEF','PIPEDIAM')) for t in [5,25]])
+
+# Legacy dense readGrid keys: (boundary table, attribute)
+BOUNDARY_VIEWS = {
+    'ElevationBoundaries'      : ('ElevationBoundaryTable', None),
+    'NormalFlowBoundaries'     : ('FlowBoundaryTable', None),
+    'ExternalBarrierHeights'   : ('FlowBoundaryTable', 'BARLANHT'),
+    'ExternalBarrierCFSPs'     : ('FlowBoundaryTable', 'BARLANCFSP'),
+    'BackFaceNodeNormalFlow'   : ('FlowBoundaryTable', 'IBCONN'),
+    'InternalBarrierHeights'   : ('FlowBoundaryTable', 'BARINHT'),
+    'InternallBarrierCFSPs'    : ('FlowBoundaryTable', 'BARINCFSP'),
+    'InternallBarrierCFSBs'    : ('FlowBoundaryTable', 'BARINCFSB'),
+    'CrossBarrierPipeHeights'  : ('FlowBoundaryTable', 'PIPEHT'),
+    'BulkPipeFrictionFactors'  : ('FlowBoundaryTable', 'PIPECOEF'),
+    'CrossBarrierPipeDiameter' : ('FlowBoundaryTable', 'PIPEDIAM'),
+    }
+
+#==============================================================================
+class BoundaryTable (object):
+    """
+    Ragged (CSR) storage of ADCIRC boundary segments.
+    Nodes of segment k are nodes[offsets[k]:offsets[k+1]], its type is
+    ibtype[k]. Per-node attributes (IBCONN, BARLANHT, BARINHT, ...) are
+    arrays aligned with 'nodes', zero on the segments that do not have them.
+    """
+    __slots__ = ('ibtype', 'offsets', 'nodes', 'attrs')
+
+    def __init__ (self, ibtype, offsets, nodes, attrs=None):
+        self.ibtype  = np.asarray(ibtype,  dtype=int)
+        self.offsets = np.asarray(offsets, dtype=int)
+        self.nodes   = np.asarray(nodes,   dtype=int)
+        self.attrs   = dict(attrs or {})
+
+    def __len__ (self):
+        return len(self.ibtype)
+
+    def __repr__ (self):
+        return ('BoundaryTable(' + str(len(self)) + ' segments, ' +
+                str(len(self.nodes)) + ' nodes)')
+
+    @property
+    def lengths (self):
+        """
+        Number of nodes in each segment
+        """
+        return np.diff(self.offsets)
+
+    def segment (self, k, name=None):
+        """
+        Returns nodes (or attribute 'name') of the k-th segment
+        """
+        values = self.nodes if name is None else self.attr(name)
+        return values[self.offsets[k]:self.offsets[k+1]]
+
+    def segmentIndex (self):
+        """
+        Returns the segment number of each stored node
+        """
+        return np.repeat(np.arange(len(self)), self.lengths)
+
+    def attr (self, name):
+        """
+        Returns per-node attribute aligned with 'nodes'
+        """
+        if name in self.attrs:
+            return self.attrs[name]
+        dtype = int if name == 'IBCONN' else float
+        return np.zeros(len(self.nodes), dtype=dtype)
+
+    def ofType (self, types):
+        """
+        Returns BoundaryTable with the segments of given IBTYPE(s) only
+        """
+        keep  = np.isin(self.ibtype, np.atleast_1d(types))
+        lens  = self.lengths[keep]
+        take  = np.repeat(keep, self.lengths)
+        offsets = np.concatenate(([0], np.cumsum(lens)))
+        attrs = dict([(n, v[take]) for n, v in self.attrs.items()])
+        return BoundaryTable(self.ibtype[keep], offsets,
+                             self.nodes[take], attrs)
+
+    def dense (self, name=None, width=None, types=None):
+        """
+        Materializes nodes (or attribute 'name') as the legacy
+        [segments, width] zero-padded matrix.
+        Args:
+            width (int) : number of columns (default: longest segment)
+            types (list): fill only segments of these IBTYPEs
+        """
+        values = self.nodes if name is None else self.attr(name)
+        lens   = self.lengths
+        if width is None:
+            width = lens.max() if len(lens) else 0
+        out  = np.zeros([len(self), width], dtype=values.dtype)
+        rows = self.segmentIndex()
+        cols = np.arange(len(values)) - self.offsets[rows]
+        if types is not None:
+            keep = np.isin(self.ibtype[rows], types)
+            rows, cols, values = rows[keep], cols[keep], values[keep]
+        out[rows, cols] = values
+        return out
+
+    def toArrays (self, prefix=''):
+        """
+        Returns the table as a flat dict of arrays (e.g. for caching)
+        """
+        arrays = {prefix + 'ibtype'  : self.ibtype,
+                  prefix + 'offsets' : self.offsets,
+                  prefix + 'nodes'   : self.nodes}
+        for name, value in self.attrs.items():
+            arrays[prefix + name] = value
+        return arrays
+
+    @classmethod
+    def fromArrays (cls, arrays, prefix=''):
+        """
+        Inverse of toArrays()
+        """
+        attrs = dict()
+        for key, value in arrays.items():
+            if key.startswith(prefix):
+                name = key[len(prefix):]
+                if name not in ('ibtype', 'offsets', 'nodes'):
+                    attrs[name] = value
+        return cls(arrays[prefix + 'ibtype'], arrays[prefix + 'offsets'],
+                   arrays[prefix + 'nodes'], attrs)
+
+#==============================================================================
+def readBoundaries (f, nSegments, columns=None):
+    """
+    Reads nSegments boundary segments (header line 'NVDLL IBTYPE' followed
+    by one line per node) from the open fort.14 into BoundaryTable.
+    Args:
+        columns (dict): IBTYPE -> names of the columns following the node
+                        number (e.g. FLOW_COLUMNS); None for node only
+    """
+    ibtype  = np.zeros([nSegments], dtype=int)
+    lengths = np.zeros([nSegments], dtype=int)
+    blocks  = []
+    for k in range(nSegments):
+        line = f.readline().split()
+        lengths[k] = int(line[0])
+        if len(line) > 1:
+            try:
+                ibtype[k] = int(line[1])
+            except ValueError:
+                pass
+        names = () if columns is None else columns.get(ibtype[k], ())
+        blocks.append((names, readBlock(f, lengths[k], 1+len(names))))
+
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    nodes   = np.zeros([offsets[-1]], dtype=int)
+    attrs   = dict()
+    for k, (names, block) in enumerate(blocks):
+        nodes[offsets[k]:offsets[k+1]] = block[:,0]
+        for j, name in enumerate(names):
+            if name not in attrs:
+                attrs[name] = np.zeros([offsets[-1]],
+                                dtype=int if name == 'IBCONN' else float)
+            attrs[name][offsets[k]:offsets[k+1]] = block[:,j+1]
+    return BoundaryTable(ibtype, offsets, nodes, attrs)
+
+#==============================================================================
+def boundaryView (grid, key):
+    """
+    Materializes the legacy dense boundary matrix 'key' of the grid
+    (e.g. 'NormalFlowBoundaries') from its ragged BoundaryTable.
+    """
+    tableKey, name = BOUNDARY_VIEWS[key]
+    table = grid[tableKey]
+    if tableKey == 'ElevationBoundaryTable':
+        return np.squeeze(table.dense(name, grid['NETA']))
+    return np.squeeze(table.dense(name, grid['NVEL'],
+                                  types=list(FLOW_COLUMNS.keys())))
+
+#==============================================================================
+def readBoundarySections (f, verbose=1):
+    """
+    Reads elevation and normal flow boundary sections of fort.14
+    from the open file positioned right after the elements table.
+    Returns:
+        dict: 'NETA', 'NOPE', 'NBOU', 'NVEL',
+              'ElevationBoundaryTable', 'FlowBoundaryTable'
+    """
+    myNOPE   = int(f.readline().split()[0])
+    myNETA   = int(f.readline().split()[0])
+    if verbose:
+        msg('i', 'Reading elevation-specified boundaries...')
+    myElev   = readBoundaries(f, myNOPE)
+
+    myNBOU   = int(f.readline().split()[0])
+    myNVEL   = int(f.readline().split()[0])
+    if verbose:
+        msg('i', 'Reading normal flow-specified boundaries...')
+    myFlow   = readBoundaries(f, myNBOU, FLOW_COLUMNS)
+
+    return {'NETA'                   : myNETA,
+            'NOPE'                   : myNOPE,
+            'NBOU'                   : myNBOU,
+            'NVEL'                   : myNVEL,
+            'ElevationBoundaryTable' : myElev,
+            'FlowBoundaryTable'      : myFlow}
+
+#==============================================================================
+def loadBoundarySections (gridFile, offset, stamp=None, verbose=1):
+    """
+    Reopens fort.14 and reads its boundary sections starting at
+    byte offset. Warns if the file changed since stamp=(size, mtime).
+    """
+    if stamp is not None:
+        st = os.stat(gridFile)
+        if (st.st_size, st.st_mtime_ns) != tuple(stamp):
+            msg('w', 'File ' + gridFile + ' changed since it was read.')
+    with open(gridFile, 'rb') as f:
+        f.seek(offset)
+        return readBoundarySections(f, verbose)
+
+#==============================================================================
+def boundarySectionsFromArrays (arrays, meta):
+    """
+    Builds boundary sections from packGrid() arrays
+    """
+    sections = dict([(k, meta[k]) for k in ['NETA','NOPE','NBOU','NVEL']])
+    sections['ElevationBoundaryTable'] = \
+        BoundaryTable.fromArrays(arrays, 'elev.')
+    sections['FlowBoundaryTable'] = \
+        BoundaryTable.fromArrays(arrays, 'flow.')
+    return sections
+
+#==============================================================================
+class Grid (Mapping):
+    """
+    ADCIRC grid returned by readGrid.
+    Nodes and elements are held from the start, the boundary sections are
+    decoded by 'loader' (a callable returning readBoundarySections() dict)
+    on first access to any of BOUNDARY_KEYS, and the legacy dense boundary
+    matrices (BOUNDARY_VIEWS) are built from them on first access.
+    Supports dict-style access: grid['lon'], grid.get('NETA'), 'NE' in grid.
+    """
+    NODE_KEYS     = ('GridDescription', 'NE', 'NP',
+                     'lon', 'lat', 'depth', 'Elements')
+    BOUNDARY_KEYS = ('NETA', 'NOPE', 'NBOU', 'NVEL',
+                     'ElevationBoundaryTable', 'FlowBoundaryTable')
+
+    __slots__ = NODE_KEYS + ('path', '_loader', '_sections',
+                             '_views', '_extra')
+
+    def __init__ (self, desc, lon, lat, depth, elements, NE=None, NP=None,
+                  loader=None, sections=None, path=None):
+        self.GridDescription = desc
+        self.lon       = lon
+        self.lat       = lat
+        self.depth     = depth
+        self.Elements  = elements
+        self.NP        = np.size(lon) if NP is None else NP
+        self.NE        = np.size(elements)//3 if NE is None else NE
+        self.path      = path
+        self._loader   = loader
+        self._sections = sections
+        self._views    = dict()
+        self._extra    = dict()
+
+    def __repr__ (self):
+        return ('Grid(' + repr(self.GridDescription) + ', NE=' +
+                str(self.NE) + ', NP=' + str(self.NP) + ')')
+
+    @property
+    def loaded (self):
+        """
+        True if the boundary sections are decoded
+        """
+        return self._sections is not None
+
+    def boundaries (self):
+        """
+        Returns boundary sections, decoding them on first call
+        """
+        if self._sections is None:
+            if self._loader is None:
+                raise KeyError('Boundary sections are not available.')
+            self._sections = self._loader()
+            self._loader   = None
+        return self._sections
+
+    def __getitem__ (self, key):
+        if key in self.NODE_KEYS:
+            return getattr(self, key)
+        if key in self.BOUNDARY_KEYS:
+            return self.boundaries()[key]
+        if key in BOUNDARY_VIEWS:
+            if key not in self._views:
+                self._views[key] = boundaryView(self, key)
+            return self._views[key]
+        return self._extra[key]
+
+    def __setitem__ (self, key, value):
+        if key in self.NODE_KEYS:
+            setattr(self, key, value)
+        elif key in self.BOUNDARY_KEYS:
+            self.boundaries()[key] = value
+            self._views.clear()
+        elif key in BOUNDARY_VIEWS:
+            self._views[key] = value
+        else:
+            self._extra[key] = value
+
+    def __iter__ (self):
+        for key in self.NODE_KEYS + self.BOUNDARY_KEYS:
+            yield key
+        for key in BOUNDARY_VIEWS:
+            yield key
+        for key in self._extra:
+            yield key
+
+    def __len__ (self):
+        return (len(self.NODE_KEYS) + len(self.BOUNDARY_KEYS) +
+                len(BOUNDARY_VIEWS) + len(self._extra))
+
+    def __contains__ (self, key):
+        return (key in self.NODE_KEYS or key in self.BOUNDARY_KEYS or
+                key in BOUNDARY_VIEWS or key in self._extra)
+
+#==============================================================================
+def packGrid (grid):
+    """
+    Splits readGrid output into flat arrays and json-serializable scalars
+    (legacy dense boundary matrices are left out)
+    """
+    arrays = dict()
+    meta   = dict()
+    for key in ['GridDescription','NE','NP','NETA','NOPE','NBOU','NVEL']:
+        meta[key] = grid[key]
+    for key in ['lon','lat','depth','Elements']:
+        arrays[key] = grid[key]
+    arrays.update(grid['ElevationBoundaryTable'].toArrays('elev.'))
+    arrays.update(grid['FlowBoundaryTable'].toArrays('flow.'))
+    return arrays, meta
+
+#==============================================================================
+def unpackGrid (arrays, meta, path=None):
+    """
+    Inverse of packGrid(), boundary tables are built on first access
+    """
+    return Grid(meta['GridDescription'], arrays['lon'], arrays['lat'],
+                arrays['depth'], arrays['Elements'],
+                NE=meta['NE'], NP=meta['NP'],
+                loader=functools.partial(boundarySectionsFromArrays,
+                                         arrays, meta),
+                path=path)
+
+#==============================================================================
+def readGrid ( gridFile, verbose=1, cache=False, lazy=True):
     """
     Reads ADCIRC grid file
     
     Args:
         gridFile (str): full path to fort.14 file
+        cache (bool or str): if True, or a path to the cache directory,
+            reads the grid through models.gridcache (arrays are then
+            read-only memory maps)
+        lazy (bool): if True (default), the boundary sections are read
+            from the file on first access
     Returns:
-        grid (dict): field names according to ADCIRC internal variables:
+        grid (Grid): dict-like, field names according to ADCIRC internal
+        variables:
     http://adcirc.org/home/documentation/users-manual-v50/
     input-file-descriptions/adcirc-grid-and-boundary-information-file-fort-14/
+        Boundaries are kept as ragged tables 'ElevationBoundaryTable' and
+        'FlowBoundaryTable' (see BoundaryTable); the legacy dense matrices
+        ('ElevationBoundaries', 'NormalFlowBoundaries', ...) are built
+        from them on first access.
     """
     if verbose:
         msg( 'info', 'Reading the grid from ' + gridFile)
     if not os.path.exists (gridFile):
         msg( 'error', 'File ' + gridFile + ' does not exist.')
         return
+    if cache:
+        from csdllib.models import gridcache
+        cacheDir = cache if isinstance(cache, str) else None
+        return gridcache.readGrid(gridFile, cacheDir, verbose=verbose)
         
-    f  = open(gridFile)
+    f  = open(gridFile, 'rb')
     
-    myDesc     = f.readline().rstrip()
-    myNE, myNP = map(int, f.readline().split())    
+    myDesc     = f.readline().decode('utf-8', 'replace').rstrip()
+    myNE, myNP = map(int, f.readline().split()[:2])
     if verbose:
         msg( 'i','Grid description ' + myDesc + '.')
         msg( 'i','Grid size: NE= '   + str(myNE) + ', NP=' + str(myNP) + '.')
 
-    myPoints   = np.zeros([myNP,3], dtype=float)
-    myElements = np.zeros([myNE,3], dtype=int)
-    
     if verbose:
         msg( 'i','Reading grid points...')
-
-    for k in range(myNP):
-        line            = f.readline().split()
-        myPoints[k,0] = float(line[1])
-        myPoints[k,1] = float(line[2])
-        myPoints[k,2] = float(line[3])
+    myPoints   = np.array(readBlock(f, myNP, 4, float)[:,1:])
 
     if verbose:
         msg( 'i','Reading grid elements...')
+    myElements = np.array(readBlock(f, myNE, 5, int)[:,2:])
 
-    for k in range(myNE):
-        line              = f.readline().split()
-        #myElements[k,0:2] = map(int, line[2:4])
-        myElements[k,0] = int (line[2])
-        myElements[k,1] = int (line[3])
-        myElements[k,2] = int (line[4])
-    
-    myNOPE   = int(f.readline().split()[0])
-    myNETA   = int(f.readline().split()[0])   
-    myNVDLL  = np.zeros([myNOPE], dtype=int)
-    myNBDV   = np.zeros([myNOPE, myNETA], dtype=int)
-    
-    if verbose:
-        msg('i', 'Reading elevation-specified boundaries...')
-
-    for k in range(myNOPE):
-        myNVDLL [k] = int(f.readline().split()[0])
-        for j in range(myNVDLL[k]):
-            myNBDV[k,j] = int(f.readline().strip())
-
-    myNBOU = int(f.readline().split()[0])
-    myNVEL = int(f.readline().split()[0])   
-    myNVELL      = np.zeros([myNBOU], dtype=int)
-    myIBTYPE     = np.zeros([myNBOU], dtype=int)
-    myNBVV       = np.zeros([myNBOU, myNVEL], dtype=int)
-    myBARLANHT   = np.zeros([myNBOU, myNVEL], dtype=float)
-    myBARLANCFSP = np.zeros([myNBOU, myNVEL], dtype=float)
-    myIBCONN     = np.zeros([myNBOU, myNVEL], dtype=int)
-    myBARINHT    = np.zeros([myNBOU, myNVEL], dtype=float)
-    myBARINCFSB  = np.zeros([myNBOU, myNVEL], dtype=float)
-    myBARINCFSP  = np.zeros([myNBOU, myNVEL], dtype=float)
-    myPIPEHT     = np.zeros([myNBOU, myNVEL], dtype=float)
-    myPIPECOEF   = np.zeros([myNBOU, myNVEL], dtype=float)
-    myPIPEDIAM   = np.zeros([myNBOU, myNVEL], dtype=float)
-    
-    if verbose:
-        msg('i', 'Reading normal flow-specified boundaries...')
-    for k in range(myNBOU):
-        line = f.readline().split()
-        myNVELL[k]  = int(line[0])
-        myIBTYPE[k] = int(line[1])
-        
-        for j in range(myNVELL[k]):
-            line = f.readline().rstrip().split()            
-            if myIBTYPE[k] in   [0,1,2,10,11,12,20,21,22,30]:
-                myNBVV      [k,j] = int(line[0])
-            elif myIBTYPE[k] in [3,13,23]:
-                myNBVV      [k,j] = int  (line[0])
-                myBARLANHT  [k,j] = float(line[1])
-                myBARLANCFSP[k,j] = float(line[2])
-            elif myIBTYPE[k] in [4,24]:
-                myNBVV      [k,j] = int  (line[0])
-                myIBCONN    [k,j] = int  (line[1])
-                myBARINHT   [k,j] = float(line[2])
-                myBARINCFSB [k,j] = float(line[3])
-                myBARINCFSP [k,j] = float(line[4])
-            elif myIBTYPE[k] in [5,25]:
-                myNBVV      [k,j] = int  (line[0])
-                myIBCONN    [k,j] = int  (line[1])
-                myBARINHT   [k,j] = float(line[2])
-                myBARINCFSB [k,j] = float(line[3])
-                myBARINCFSP [k,j] = float(line[4])
-                myPIPEHT    [k,j] = float(line[5])
-                myPIPECOEF  [k,j] = float(line[6])
-                myPIPEDIAM  [k,j] = float(line[7])
-
+    if lazy:
+        st       = os.stat(gridFile)
+        loader   = functools.partial(loadBoundarySections, gridFile,
+                                     f.tell(), (st.st_size, st.st_mtime_ns),
+                                     verbose)
+        sections = None
+    else:
+        loader   = None
+        sections = readBoundarySections(f, verbose)
     f.close()
         
-    return {'GridDescription'               : myDesc, 
-            'NE'                            : myNE, 
-            'NP'                            : myNP, 
-            'lon'                           : np.squeeze(myPoints[:,0]),
-            'lat'                           : np.squeeze(myPoints[:,1]), 
-            'depth'                         : np.squeeze(myPoints[:,2]), 
-            'Elements'                      : np.squeeze(myElements),
-            'NETA'                          : myNETA, 
-            'NOPE'                          : myNOPE,
-            'ElevationBoundaries'           : np.squeeze(myNBDV), 
-            'NormalFlowBoundaries'          : np.squeeze(myNBVV),
-            'ExternalBarrierHeights'        : np.squeeze(myBARLANHT),
-            'ExternalBarrierCFSPs'          : np.squeeze(myBARLANCFSP),
-            'BackFaceNodeNormalFlow'        : np.squeeze(myIBCONN),
-            'InternalBarrierHeights'        : np.squeeze(myBARINHT),
-            'InternallBarrierCFSPs'         : np.squeeze(myBARINCFSP),
-            'InternallBarrierCFSBs'         : np.squeeze(myBARINCFSB),            
-            'CrossBarrierPipeHeights'       : np.squeeze(myPIPEHT),
-            'BulkPipeFrictionFactors'       : np.squeeze(myPIPECOEF),            
-            'CrossBarrierPipeDiameter'      : np.squeeze(myPIPEDIAM)
-            }
+    return Grid(myDesc,
+                np.squeeze(myPoints[:,0]),
+                np.squeeze(myPoints[:,1]),
+                np.squeeze(myPoints[:,2]),
+                np.squeeze(myElements),
+                NE=myNE, NP=myNP, loader=loader, sections=sections, path=gridFile)
+
 
+#==============================================================================
+def stationIndex (names, stations):
+    """
+    Resolves station selection into indices
+    Args:
+        names    (str np.array [NS]) : station names of the file
+        stations (list)              : 0-based indices and/or names
+    Returns:
+        int np.array of indices in the order of the selection,
+        or None if a station is not found
+    """
+    lookup = dict()
+    for n, name in enumerate(names):
+        lookup.setdefault(str(name).strip(), n)
+    if isinstance(stations, (str, bytes, int, np.integer)):
+        stations = [stations]
+    index = []
+    for s in stations:
+        if isinstance(s, (str, np.str_, bytes)):
+            if isinstance(s, bytes):
+                s = s.decode()
+            if s.strip() not in lookup:
+                msg( 'e','Station ' + s + ' is not found.')
+                return
+            index.append(lookup[s.strip()])
+        else:
+            n = int(s)
+            if n < -len(names) or n >= len(names):
+                msg( 'e','Station index ' + str(n) + ' is out of range.')
+                return
+            index.append(n % len(names))
+    return np.array(index, dtype=int)
+
+#==============================================================================
+def timeSlice (tim, baseDate, timeRange):
+    """
+    Returns slice of the time steps within timeRange = (start, end),
+    datetimes or datetime64 (either may be None);
+    tim are seconds since baseDate
+    """
+    if timeRange is None:
+        return slice(None)
+    start, end = timeRange
+    tim  = np.asarray(tim, dtype=float)
+    base = np.datetime64(baseDate, 's')
+    sec  = lambda d: (np.datetime64(d, 's') - base)/np.timedelta64(1, 's')
+    i0   = 0
+    i1   = len(tim)
+    if start is not None:
+        i0 = np.searchsorted(tim, sec(start), side='left')
+    if end is not None:
+        i1 = np.searchsorted(tim, sec(end), side='right')
+    return slice(int(i0), int(max(i0, i1)))
 
 #==============================================================================
-def readTimeSeries (ncFile, ncVar = 'zeta', verbose=1):
+def readTimeSeries (ncFile, ncVar = 'zeta', verbose=1,
+                    stations=None, timeRange=None, dtype=None, masked=True,
+                    legacyTime=False):
     """
     Reads fort.61.nc-like file
+    Args:
+        ncFile    (str)   : full path to netCDF file
+        ncVar     (str)   : name of netCDF field (default='zeta')
+        stations  (list)  : 0-based station indices and/or station names
+                            to read (default: all)
+        timeRange (tuple) : (start, end) datetimes of the time steps
+                            to read, either may be None (default: all)
+        dtype             : type of the returned field, e.g. np.float32
+                            (default: as stored)
+        masked    (bool)  : if False, the field is a plain np.array
+                            with NaN for missing values
+        legacyTime (bool) : return 'time' as datetime objects
+                            instead of datetime64[s]
+    Returns:
+        dict: 'lat', 'lon', 'time', 'base_date', 'zeta', 'stations', 'title'
+        (field is under 'zeta' whatever ncVar is); with stations or
+        timeRange only the selected hyperslab is read from the file.
     """
     if verbose:
         msg( 'i','Reading [' + ncVar + '] from ' + ncFile)
@@ -153,31 +556,52 @@ def readTimeSeries (ncFile, ncVar = 'zeta', verbose=1):
         return
     
     nc    = netCDF4.Dataset( ncFile )
-    fld        = nc.variables[ncVar][:]
-    missingVal = nc.variables[ncVar]._FillValue
-    try:
-        fld.unshare_mask()
-    except:
-        pass
-    fld [np.where(fld == missingVal)] = np.nan
-                          
-    lon  = nc.variables['x'][:]
-    lat  = nc.variables['y'][:]    
-    tim  = nc.variables['time'][:]    
-    nam  = nc.variables['station_name'][:]
-    stations = netCDF4.chartostring(nam)  # Python3 requirement?
+    var   = nc.variables[ncVar]
+    tim   = nc.variables['time'][:]
+    nam   = nc.variables['station_name'][:]
+    names = netCDF4.chartostring(nam)  # Python3 requirement?
 
     ncTitle  = nc.getncattr('title')
-    try:
-        baseDate = datetime.strptime(nc.variables['time'].base_date[0:19], 
-                                 '%Y-%m-%d %H:%M:%S')
-    except: # when 00 sec is not written at all
-        baseDate = datetime.strptime(nc.variables['time'].base_date[0:19], 
-                                 '%Y-%m-%d %H:%M  ')
+    baseDate = parseBaseDate(nc.variables['time'].base_date)
+
+    ts = timeSlice(tim, baseDate, timeRange)
+    ss = slice(None)
+    if stations is not None:
+        ss = stationIndex(names, stations)
+        if ss is None:
+            nc.close()
+            return
+    missingVal = getattr(var, '_FillValue', None)
+
+    if not masked:
+        var.set_auto_mask(False)
+    if isinstance(ss, slice):
+        fld = var[ts, ss]
+    else:
+        # read sorted unique columns, then restore the requested order
+        cols, inverse = np.unique(ss, return_inverse=True)
+        fld = var[ts, cols]
+        if not np.array_equal(cols, ss):
+            fld = fld[:, inverse]
+    if dtype is not None:
+        fld = fld.astype(dtype, copy=False)
+
+    if masked:
+        try:
+            fld.unshare_mask()
+        except:
+            pass
+        fld [np.where(fld == missingVal)] = np.nan
+    elif missingVal is not None and np.issubdtype(fld.dtype, np.floating):
+        fld [fld == np.asarray(missingVal).astype(fld.dtype)] = np.nan
+                          
+    lon  = nc.variables['x'][:][ss]
+    lat  = nc.variables['y'][:][ss]
+    tim  = tim[ts]
+    stations = names[ss]
+    nc.close()
 
-    realtime = np.array([baseDate + 
-                         timedelta(seconds=int(tim[i])) 
-                         for i in range(len(tim))])
+    realtime = decodeTime(tim, baseDate, legacyTime)
 
     return  {'lat'       : lat, 
              'lon'       : lon, 
@@ -188,13 +612,16 @@ def readTimeSeries (ncFile, ncVar = 'zeta', verbose=1):
              'title'     : ncTitle}        
     
 #==============================================================================
-def readSurfaceField ( ncFile, ncVar = 'zeta_max', verbose=1 ):  
+def readSurfaceField ( ncFile, ncVar = 'zeta_max', verbose=1,
+                       legacyTime=False ):
     """
     Reads specified variable from the ADCIRC 2D netCDF output
     and grid points along with validation time.
     Args:
         'ncFile' (str): full path to netCDF file
         'ncVar'  (str): name of netCDF field
+        'legacyTime' (bool): return 'time' as datetime objects
+                             instead of datetime64[s]
     Returns:
         dict: 'lon', 'lat', 'time', 'base_date', 'value', 'path', 'variable'
     """
@@ -219,15 +646,8 @@ def readSurfaceField ( ncFile, ncVar = 'zeta_max', verbose=1 ):
         pass
     fld [fld==missingVal] = np.nan
 
-    d = nc.variables['time'].base_date[0:19].strip()
-    if len(d)==19:
-        baseDate = datetime.strptime(d,'%Y-%m-%d %H:%M:%S')
-    if len(d)==16:
-        baseDate = datetime.strptime(d,'%Y-%m-%d %H:%M')
-
-    realtime = np.array([baseDate +
-                         timedelta(seconds=int(tim[i]))
-                         for i in range(len(tim))])
+    baseDate = parseBaseDate(nc.variables['time'].base_date)
+    realtime = decodeTime(tim, baseDate, legacyTime)
 
     return { 'lon'      : lon, 
              'lat'      : lat, 
@@ -237,6 +657,68 @@ def readSurfaceField ( ncFile, ncVar = 'zeta_max', verbose=1 ):
              'path'     : ncFile,              
              'variable' : ncVar}
 
+#==============================================================================
+def readAsciiHeader ( f ):
+    """
+    Reads the two header lines of ADCIRC 2D ASCII output
+    (fort.63, fort.64, maxele.63, ...) from file opened in 'rb' mode
+    Returns:
+        dict: 'description', 'NDSETSE', 'NP', 'DT' (DTDP*NSPOOLGE),
+              'NSPOOLGE', 'IRTYPE' (values per node)
+    """
+    desc = f.readline().decode(errors='replace').strip()
+    line = f.readline().split()
+    return {'description' : desc,
+            'NDSETSE'     : int(line[0]),
+            'NP'          : int(line[1]),
+            'DT'          : float(line[2]) if len(line) > 2 else np.nan,
+            'NSPOOLGE'    : int(line[3]) if len(line) > 3 else 0,
+            'IRTYPE'      : int(line[4]) if len(line) > 4 else 1}
+
+#==============================================================================
+def iterSurfaceField_ascii ( asciiFile, verbose=1, fillValue=-99999.0 ):
+    """
+    Streams ADCIRC 2D ASCII output one dataset at a time, each one
+    parsed in a single bulk pass. Full and sparse (TIME IT NNONDEF
+    DEFVAL) dataset formats are supported.
+    Args:
+        'asciiFile' (str)  : full path to ADCIRC 2D file in ASCII format
+        'fillValue' (float): replaced by NaN (None to keep)
+    Yields:
+        (time (float), it (int), values (np.array [NP] or [NP, IRTYPE]))
+    """
+    if not os.path.exists (asciiFile):
+        msg( 'e','File ' + asciiFile + ' does not exist.')
+        return
+    with open(asciiFile, 'rb') as f:
+        header = readAsciiHeader(f)
+        if verbose:
+            msg( 'i','Field description [' + header['description'] + '].')
+        NP, IRTYPE = header['NP'], header['IRTYPE']
+        while True:
+            line = f.readline().split()
+            if not line:
+                break
+            time, it = float(line[0]), int(float(line[1]))
+            if len(line) >= 4:
+                nRows  = int(line[2])
+                values = np.full([NP, IRTYPE], float(line[3]))
+            else:
+                nRows  = NP
+                values = None
+            try:
+                block = readBlock(f, nRows, 1 + IRTYPE)
+            except ValueError:
+                msg( 'w','Dataset at IT=' + str(it) + ' is incomplete.')
+                break
+            if values is None:
+                values = block[:,1:]
+            else:
+                values[block[:,0].astype(int) - 1] = block[:,1:]
+            if fillValue is not None:
+                values[values == fillValue] = np.nan
+            yield time, it, (values[:,0] if IRTYPE == 1 else values)
+
 #==============================================================================
 def readSurfaceField_ascii ( asciiFile, verbose=1 ):
     """
@@ -246,34 +728,146 @@ def readSurfaceField_ascii ( asciiFile, verbose=1 ):
     Returns:
         value (np.array [NP, NS]), where NP - number of grid points, 
                                      and NS - number of datasets
+        ([NP, NS, IRTYPE] for vector output, e.g. fort.64), squeezed;
+        use iterSurfaceField_ascii to stream long files.
     """
     if verbose:
         msg( 'i','Reading ASCII file ' + asciiFile + '.')
 
-    f  = open(asciiFile)
-    
-    myDesc = f.readline().strip()
-    msg( 'i','Field description [' + myDesc + '].')
-    line          = f.readline().split()    
-    myNDSETSE     = int(line[0])
-    myNP          = int(line[1])
-#    myNSPOOLGE    = int(line[3])
-#    myIRTYPE      = int(line[4])
-#    dtdpXnspoolge = float(line[2])   
-    line          = f.readline().split()
-#    myTIME        = float(line[0])
-#    myIT          = float(line[1])
-    value = np.zeros([myNP,myNDSETSE], dtype=float)
-    for s in range(myNDSETSE):
-        for n in range(myNP):
-            value[n,s] = float(f.readline().split()[1])    
+    if not os.path.exists (asciiFile):
+        msg( 'e','File ' + asciiFile + ' does not exist.')
+        return
+    with open(asciiFile, 'rb') as f:
+        header = readAsciiHeader(f)
+    msg( 'i','Field description [' + header['description'] + '].')
+
+    shape = (header['NP'], max(header['NDSETSE'], 0))
+    if header['IRTYPE'] > 1:
+        shape += (header['IRTYPE'],)
+    value = np.zeros(shape, dtype=float)
+    extra = []   # datasets beyond NDSETSE of the header
+    n = 0
+    for time, it, values in iterSurfaceField_ascii(asciiFile, verbose=0):
+        if n < value.shape[1]:
+            value[:,n] = values
+        else:
+            extra.append(values)
+        n += 1
+    value = value[:,:n]
+    if extra:
+        value = np.concatenate((value, np.stack(extra, axis=1)), axis=1)
     value = np.squeeze(value)
     
-    fill_value = -99999.0
-    value[value==fill_value]=np.nan
-    
     return value 
 
+#==============================================================================
+def asciiToNetCDF ( asciiFile, ncFile, baseDate, ncVar=None, grid=None,
+                    stations=None, title=None, dtype='f8', complevel=4,
+                    chunks=None, verbose=1 ):
+    """
+    Converts ADCIRC ASCII output (fort.61, fort.63, fort.64, maxele.63...)
+    to compressed netCDF with the layout readSurfaceField and
+    readTimeSeries expect: x, y, time (with base_date) and the field
+    on (time, node), or (time, station) plus station_name for station
+    files. Datasets are streamed, so memory holds one chunk of time
+    steps only.
+    Args:
+        'asciiFile' (str)   : ADCIRC ASCII output
+        'ncFile'    (str)   : netCDF file to write
+        'baseDate'  (datetime or str) : model cold start date
+        'ncVar'     (str or list) : field name(s), default 'zeta', or
+                                    ['u-vel', 'v-vel'] for vector output
+        'grid'      (dict)  : readGrid output, for x/y of node files
+        'stations'  (dict)  : readStationsList output ('lon', 'lat',
+                              'name'), for station files
+        'title'     (str)   : title attribute (default: file description)
+        'dtype'     (str)   : stored type of the field ('f8' or 'f4')
+        'complevel' (int)   : zlib compression level
+        'chunks'    (tuple) : (time steps, points) of a chunk; the default
+                              keeps a chunk about 4 MB with 32 time steps,
+                              a fair balance of map and time series reads
+    Returns:
+        ncFile (str), or None on error
+    """
+    if not os.path.exists (asciiFile):
+        msg( 'e','File ' + asciiFile + ' does not exist.')
+        return
+    if verbose:
+        msg( 'i','Converting ' + asciiFile + ' to ' + ncFile)
+    with open(asciiFile, 'rb') as f:
+        header = readAsciiHeader(f)
+    NP, IRTYPE = header['NP'], header['IRTYPE']
+    if ncVar is None:
+        ncVar = 'zeta' if IRTYPE == 1 else ['u-vel', 'v-vel', 'w-vel'][:IRTYPE]
+    names = [ncVar] if isinstance(ncVar, str) else list(ncVar)
+    if len(names) != IRTYPE:
+        msg( 'e','File has ' + str(IRTYPE) + ' values per point, got ' +
+             str(len(names)) + ' variable names.')
+        return
+    if not isinstance(baseDate, datetime):
+        baseDate = parseBaseDate(baseDate)
+    if chunks is None:
+        itemSize = np.dtype(dtype).itemsize
+        chunks   = (32, int(max(1, min(NP, 4*1024**2 // (32*itemSize)))))
+    chunks = (int(chunks[0]), int(min(chunks[1], max(NP, 1))))
+
+    fillValue = -99999.0
+    nc  = netCDF4.Dataset(ncFile, 'w', format='NETCDF4')
+    nc.title = title if title is not None else header['description']
+    nc.source = os.path.basename(asciiFile)
+    dim = 'station' if stations is not None else 'node'
+    nc.createDimension('time', None)
+    nc.createDimension(dim, NP)
+    tim = nc.createVariable('time', 'f8', ('time',))
+    tim.long_name = 'model time'
+    tim.base_date = baseDate.strftime('%Y-%m-%d %H:%M:%S')
+    tim.units     = 'seconds since ' + tim.base_date
+    x = nc.createVariable('x', 'f8', (dim,), fill_value=fillValue)
+    y = nc.createVariable('y', 'f8', (dim,), fill_value=fillValue)
+    x.long_name, y.long_name = 'longitude', 'latitude'
+    if stations is not None:
+        x[:] = np.asarray(stations['lon'], dtype=float)
+        y[:] = np.asarray(stations['lat'], dtype=float)
+        namelen = 50
+        nc.createDimension('namelen', namelen)
+        nam = nc.createVariable('station_name', 'S1', (dim, 'namelen'))
+        nam[:] = np.array([list(str(s).strip()[:namelen].ljust(namelen))
+                           for s in stations['name']], dtype='S1')
+    elif grid is not None:
+        x[:] = np.asarray(grid['lon'], dtype=float)
+        y[:] = np.asarray(grid['lat'], dtype=float)
+        if 'depth' in grid:
+            depth = nc.createVariable('depth', 'f8', (dim,))
+            depth[:] = np.asarray(grid['depth'], dtype=float)
+    else:
+        msg( 'w','No grid or stations given, x and y are left empty.')
+    fields = [nc.createVariable(name, dtype, ('time', dim), zlib=True,
+                                complevel=complevel, shuffle=True,
+                                chunksizes=chunks, fill_value=fillValue)
+              for name in names]
+
+    # one chunk of time steps is buffered, so writes fill whole chunks
+    buf   = np.empty([chunks[0], NP, IRTYPE], dtype=dtype)
+    times = []
+    n = 0
+    def flush (n0, n):
+        tim[n0:n0+n] = times[n0:n0+n]
+        for k, var in enumerate(fields):
+            var[n0:n0+n] = buf[:n,:,k]
+    for t, it, values in iterSurfaceField_ascii(asciiFile, 0, None):
+        values = values.reshape(NP, IRTYPE)
+        buf[n % chunks[0]] = np.where(np.isnan(values), fillValue, values)
+        times.append(t)
+        n += 1
+        if n % chunks[0] == 0:
+            flush(n - chunks[0], chunks[0])
+    if n % chunks[0]:
+        flush(n - n % chunks[0], n % chunks[0])
+    nc.close()
+    if verbose:
+        msg( 'i','Wrote ' + str(n) + ' datasets of ' + str(NP) + ' points.')
+    return ncFile
+
 #==============================================================================
 def computeMax (fields):
     return np.amax(fields, axis=0)
@@ -291,11 +885,289 @@ def computeMax (ncFile, ncVar='zeta'):
 """
 
 #==============================================================================
-def readFort14 ( fort14file ):
+class FieldStats (object):
+    """
+    Running per-node statistics of a time-dependent surface field,
+    updated in place one time chunk at a time.
+    Missing values (fill value or NaN) are skipped.
+    Args:
+        NP    (int) : number of nodes
+        stats (tuple) : any of 'max', 'min', 'mean', 'std';
+                        time of max/min are kept along with max/min
+    Attributes:
+        count (int np.array [NP])   : number of valid values
+        max, min (float np.array [NP]) : running extremes (NaN if none)
+        tmax, tmin (int np.array [NP]) : time step of the extremes (-1)
+        mean, m2 (float np.array [NP]) : running mean and sum of squared
+                                         deviations from it
+    """
+    STATS = ('max', 'min', 'mean', 'std')
+
+    def __init__ (self, NP, stats=STATS):
+        unknown = set(stats) - set(self.STATS)
+        if unknown:
+            raise ValueError('Unknown statistics ' + str(sorted(unknown)))
+        self.NP    = NP
+        self.stats = tuple(stats)
+        self.count = np.zeros(NP, dtype=np.int64)
+        if 'max' in stats:
+            self.max  = np.full(NP, -np.inf)
+            self.tmax = np.full(NP, -1, dtype=np.int64)
+        if 'min' in stats:
+            self.min  = np.full(NP,  np.inf)
+            self.tmin = np.full(NP, -1, dtype=np.int64)
+        if 'mean' in stats or 'std' in stats:
+            self.mean = np.zeros(NP)
+            self.m2   = np.zeros(NP)
+
+    def update (self, chunk, t0=0, fillValue=None):
+        """
+        Adds time steps t0, t0+1, ... of the field
+        Args:
+            chunk (float np.array [nt, NP]) : overwritten (used as work space)
+            t0    (int)   : time step number of the first row
+            fillValue     : missing value marker, besides NaN
+        """
+        chunk = np.asarray(chunk)
+        if chunk.dtype != np.float64:
+            chunk = chunk.astype(np.float64)
+        nt  = len(chunk)
+        if nt == 0:
+            return
+        bad = np.isnan(chunk)
+        if fillValue is not None:
+            bad |= chunk == fillValue
+        n   = nt - np.count_nonzero(bad, axis=0)
+        col = np.arange(self.NP)
+
+        if 'max' in self.stats:
+            chunk[bad] = -np.inf
+            arg = np.argmax(chunk, axis=0)
+            val = chunk[arg, col]
+            # strict comparison keeps the first occurrence
+            upd = val > self.max
+            self.max [upd] = val[upd]
+            self.tmax[upd] = t0 + arg[upd]
+        if 'min' in self.stats:
+            chunk[bad] = np.inf
+            arg = np.argmin(chunk, axis=0)
+            val = chunk[arg, col]
+            upd = val < self.min
+            self.min [upd] = val[upd]
+            self.tmin[upd] = t0 + arg[upd]
+        if hasattr(self, 'mean'):
+            chunk[bad] = 0.
+            mean = np.sum(chunk, axis=0)/np.maximum(n, 1)
+            chunk -= mean
+            chunk[bad] = 0.
+            m2 = np.einsum('ij,ij->j', chunk, chunk)
+            self.combine(n, mean, m2)
+        self.count += n
+
+    def combine (self, n, mean, m2):
+        """
+        Merges running mean and m2 with those of n other values
+        (Chan et al. pairwise update)
+        """
+        total = self.count + n
+        with np.errstate(invalid='ignore', divide='ignore'):
+            delta = mean - self.mean
+            frac  = np.where(total > 0, n/np.maximum(total, 1), 0.)
+            self.mean += delta*frac
+            self.m2   += m2 + delta**2*self.count*frac
+
+    def merge (self, other):
+        """
+        Merges statistics of the same nodes over other time steps
+        """
+        if 'max' in self.stats:
+            upd = (other.max > self.max) | \
+                  ((other.max == self.max) & (other.tmax >= 0) &
+                   ((self.tmax < 0) | (other.tmax < self.tmax)))
+            self.max [upd] = other.max [upd]
+            self.tmax[upd] = other.tmax[upd]
+        if 'min' in self.stats:
+            upd = (other.min < self.min) | \
+                  ((other.min == self.min) & (other.tmin >= 0) &
+                   ((self.tmin < 0) | (other.tmin < self.tmin)))
+            self.min [upd] = other.min [upd]
+            self.tmin[upd] = other.tmin[upd]
+        if hasattr(self, 'mean'):
+            self.combine(other.count, other.mean, other.m2)
+        self.count += other.count
+        return self
+
+    @classmethod
+    def concat (cls, parts):
+        """
+        Joins statistics of consecutive node ranges
+        """
+        out = cls(0, parts[0].stats)
+        out.NP = sum(p.NP for p in parts)
+        for name in ('count', 'max', 'tmax', 'min', 'tmin', 'mean', 'm2'):
+            if hasattr(out, name):
+                setattr(out, name,
+                        np.concatenate([getattr(p, name) for p in parts]))
+        return out
+
+    def result (self, time=None):
+        """
+        Returns:
+            dict: 'count' and, as requested, 'max', 'time_of_max',
+            'min', 'time_of_min', 'mean', 'std'; NaN where no valid values.
+            Times are time step numbers, or entries of time if given.
+        """
+        none = self.count == 0
+        out  = {'count' : self.count}
+        for name in ('max', 'min'):
+            if name in self.stats:
+                val  = np.where(none, np.nan, getattr(self, name))
+                step = getattr(self, 't' + name)
+                out[name] = val
+                if time is None:
+                    out['time_of_' + name] = step
+                else:
+                    t = np.asarray(time)[np.maximum(step, 0)]
+                    if np.issubdtype(t.dtype, np.datetime64):
+                        t[none] = np.datetime64('NaT')
+                    out['time_of_' + name] = t
+        if 'mean' in self.stats:
+            out['mean'] = np.where(none, np.nan, self.mean)
+        if 'std' in self.stats:
+            out['std']  = np.where(none, np.nan,
+                                   np.sqrt(self.m2/np.maximum(self.count, 1)))
+        return out
+
+#==============================================================================
+def chunkSteps (NP, chunkBytes):
+    """
+    Returns number of time steps of NP float64 values that fit in chunkBytes
+    """
+    return int(max(1, chunkBytes // (8*max(NP, 1))))
+
+#==============================================================================
+def reducePart ( ncFile, ncVar, stats, times, nodes, step ):
+    """
+    Reduces time steps times[0]:times[1] of nodes nodes[0]:nodes[1]
+    of the field in chunks of step time steps, opening the file itself
+    (runs in worker processes of reduceSurfaceField)
+    Returns:
+        FieldStats
+    """
+    nc  = netCDF4.Dataset (ncFile)
+    var = nc.variables[ncVar]
+    var.set_auto_mask(False)
+    missingVal = getattr(var, '_FillValue', None)
+    acc = FieldStats(nodes[1] - nodes[0], stats)
+    for t0 in range(times[0], times[1], step):
+        t1 = min(t0 + step, times[1])
+        acc.update(var[t0:t1, nodes[0]:nodes[1]], t0, missingVal)
+    nc.close()
+    return acc
+
+#==============================================================================
+def splitRange (n, parts, align=1):
+    """
+    Splits range(n) into up to 'parts' consecutive (start, end) pairs
+    with starts on multiples of align
+    """
+    blocks = -(-n // align)
+    edges  = np.unique(np.linspace(0, blocks, max(1, parts) + 1).astype(int))
+    edges  = np.minimum(edges*align, n)
+    return [(int(a), int(b)) for a, b in zip(edges[:-1], edges[1:]) if b > a]
+
+#==============================================================================
+def reduceSurfaceField ( ncFile, ncVar='zeta', stats=FieldStats.STATS,
+                         chunkBytes=256*1024**2, verbose=1,
+                         legacyTime=False, workers=1, split='node' ):
+    """
+    Computes per-node max, min, mean, std and time of max/min of the
+    time-dependent field in ADCIRC 2D netCDF output (e.g. fort.63.nc)
+    by streaming it in time chunks, so memory is bounded by the chunk
+    size instead of NT x NP.
+    Args:
+        'ncFile'     (str)  : full path to netCDF file
+        'ncVar'      (str)  : name of netCDF field (default='zeta')
+        'stats'      (tuple): statistics to compute, see FieldStats
+        'chunkBytes' (int)  : size of one time chunk in memory
+        'legacyTime' (bool) : times as datetime objects, not datetime64[s]
+        'workers'    (int)  : number of worker processes, each opening
+                              the file on its own (default=1, serial)
+        'split'      (str)  : how the work is shared between workers:
+                              'node' - node ranges; results are identical
+                                       to the serial ones and the chunk
+                                       memory is shared,
+                              'time' - time ranges, merged in time order;
+                                       mean and std may differ from the
+                                       serial ones by round-off, every
+                                       worker holds a full chunk,
+                              'both' - node and time ranges
+    Returns:
+        dict: 'lon', 'lat', 'base_date', 'path', 'variable', 'count'
+              and the requested statistics ('max', 'time_of_max', ...)
+    """
+    if verbose:
+        msg( 'i','Reducing [' + ncVar + '] from ' + ncFile)
+
+    if not os.path.exists (ncFile):
+        msg( 'e','File ' + ncFile + ' does not exist.')
+        return
+    if split not in ('node', 'time', 'both'):
+        msg( 'e','Unknown split ' + str(split))
+        return
+
+    nc   = netCDF4.Dataset (ncFile)
+    NT, NP = nc.variables[ncVar].shape[0], nc.variables[ncVar].shape[-1]
+    lon  = nc.variables['x'][:]
+    lat  = nc.variables['y'][:]
+    tim  = nc.variables['time'][:]
+    baseDate = parseBaseDate(nc.variables['time'].base_date)
+    nc.close()
+    step = chunkSteps(NP, chunkBytes)
+
+    workers = max(1, int(workers))
+    if workers == 1:
+        acc = reducePart(ncFile, ncVar, stats, (0, NT), (0, NP), step)
+    else:
+        nTime = {'node' : 1, 'time' : workers,
+                 'both' : max(1, int(np.sqrt(workers)))}[split]
+        nNode = max(1, workers // nTime)
+        # time ranges start on chunk boundaries of the serial pass
+        times = splitRange(NT, nTime, step) or [(0, 0)]
+        nodes = splitRange(NP, nNode) or [(0, 0)]
+        if verbose:
+            msg( 'i','Using ' + str(workers) + ' workers on ' +
+                 str(len(times)) + ' time x ' + str(len(nodes)) +
+                 ' node ranges.')
+        import concurrent.futures
+        with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+            jobs = [[pool.submit(reducePart, ncFile, ncVar, stats,
+                                 t, n, step)
+                     for n in nodes] for t in times]
+            parts = [FieldStats.concat([j.result() for j in row])
+                     for row in jobs]
+        acc = parts[0]
+        for part in parts[1:]:
+            acc.merge(part)
+
+    out = acc.result(decodeTime(tim, baseDate))
+    if legacyTime:
+        for key in ('time_of_max', 'time_of_min'):
+            if key in out:
+                out[key] = out[key].astype(object)
+    out.update({'lon'      : lon,
+                'lat'      : lat,
+                'base_date': baseDate,
+                'path'     : ncFile,
+                'variable' : ncVar})
+    return out
+
+#==============================================================================
+def readFort14 ( fort14file, cache=False ):
     """
     Reads ADCIRC fort.14 file
     """
-    return readGrid (fort14file)
+    return readGrid (fort14file, cache=cache)
 
 #==============================================================================
 def readStationsList (fileName):
@@ -306,8 +1178,11 @@ def readStationsList (fileName):
     -92.5 32.11          9999992
     -91.8 31.12          9999993
     -90.3 32.45          9999994
+    Args:
+        fileName (str or file) : file name, or open file positioned
+                                 at the block
     """
-    f = open(fileName, 'r')
+    f = open(fileName, 'r') if isinstance(fileName, str) else fileName
     nstations  = int(f.readline().split()[0])    
     stations = dict()
     
@@ -319,16 +1194,50 @@ def readStationsList (fileName):
         stations['lon'].append(float(line.split()[0]))
         stations['lat'].append(float(line.split()[1]))
         stations['name'].append(line[20:])
-    f.close()
+    if f is not fileName:
+        f.close()
     return stations
 
 #==============================================================================
-def readFort15 ( fort15file, verbose=1 ):
+def countForcingRows (f):
+    """
+    Counts 'amplitude phase' lines of the periodic boundary forcing
+    block that starts at the current line of f (text mode), and
+    rewinds f to it. Used when NETA is not given.
+    """
+    start = f.tell()
+    f.readline() # constituent name
+    count = 0
+    while True:
+        line = f.readline().split('!')[0].split()
+        if len(line) != 2:
+            break
+        try:
+            float(line[0]), float(line[1])
+        except ValueError:
+            break
+        count += 1
+    f.seek(start)
+    return count
+
+#==============================================================================
+def readFort15 ( fort15file, NETA=None, verbose=1 ):
     """
     Reads ADCIRC fort.15 file according to: 
     http://adcirc.org/home/documentation/users-manual-v50/
     input-file-descriptions/
     model-parameter-and-periodic-boundary-condition-file-fort-15/
+    Args:
+        fort15file (str) : full path to fort.15
+        NETA       (int) : number of elevation boundary nodes (e.g. from
+                           readGrid); counted from the file if not given
+    Returns:
+        dict: 'config', 'tides', 'stations', 'coldstart', 'tail'
+        tides['ALPHA']  : names of the NBFR boundary forcing constituents
+        tides['EMOEFA'] : np.array [NBFR, NETA, 2] of amplitude (EMO)
+                          and phase (EFA) at the elevation boundary nodes
+        tail            : lines following the boundary forcing, as read
+                          (written back verbatim by writeFort15)
     """
     config = dict()
     tides  = dict()
@@ -417,76 +1326,190 @@ def readFort15 ( fort15file, verbose=1 ):
         tides['AMIG'].append(float(line[0]))
         tides['FF'].append(float(line[1]))
         tides['FACE'].append(float(line[2]))
-        
-    config['NETA'] = 0 # is undefined thank you very much!    
-    # Finding NETA...
-    f.readline() # k1
-    count = 0
-    stopReading = False
-    while not stopReading:
-        line = f.readline().split()
-        if len(line)==2:
-            count += 1
-        else:  #o1
-            config['NETA'] = count
-            for m in range(config['NETA']): #o1
-                f.readline()    
-            stopReading = True                        
-        
-    for n in range(config['NBFR']-2): #p1
-        f.readline()
-        for m in range(config['NETA']): 
-            f.readline()    
-                
-    config['ANGINN']    = float(f.readline().split()[0])    
-    line = f.readline().split()    
+
+    if NETA is None:
+        NETA = countForcingRows(f) if config['NBFR'] else 0
+    config['NETA'] = int(NETA)
+
+    tides['ALPHA']  = []
+    tides['EMOEFA'] = np.zeros([config['NBFR'], config['NETA'], 2])
+    for n in range(config['NBFR']):
+        tides['ALPHA'].append(f.readline().strip())
+        tides['EMOEFA'][n] = readBlock(f, config['NETA'], 2)
+
+    tail = f.readlines()
+    f.close()
+
+    rest = io.StringIO(''.join(tail))
+    config['ANGINN']    = float(rest.readline().split()[0])    
+    line = rest.readline().split()    
     config['NOUTE']     = float(line[0])    
     config['TOUTSE']    = float(line[1])    
     config['TOUTFE']    = float(line[2])    
     config['NSPOOLE']   = int(line[3])    
     
-    stations = readStationsList (f)
+    stations = readStationsList (rest)
     
     config['NSTATIONS'] = len(stations['lon'])
     
-    linelist = f.readlines()
-    coldstart = linelist[len(linelist)-1].strip()
-    f.close()
+    coldstart = tail[len(tail)-1].strip()
     
     return {'config' : config,
             'tides'  : tides,
             'stations' : stations,
-            'coldstart' : coldstart
+            'coldstart' : coldstart,
+            'tail'   : tail
             }
 
 #==============================================================================
-def writeOffset63 ( val, offset63file, note=None):
+def writeFort15 ( fort15, fort15file, fmt='%s', verbose=1 ):
+    """
+    Writes ADCIRC fort.15 file from the dict returned by readFort15,
+    e.g. after perturbing the tidal potential or the boundary forcing
+    for an ensemble. Lines following the boundary forcing are written
+    as read ('tail').
+    Args:
+        fort15     (dict) : as returned by readFort15
+        fort15file (str)  : full path to the output file
+        fmt        (str)  : format of the forcing amplitudes and phases
+                            (default: shortest repr)
+    """
+    if verbose:
+        msg( 'i','Writing fort.15 file ' + fort15file)
+    c = fort15['config']
+    t = fort15['tides']
+
+    def val (key):
+        return str(c[key]) + '  ! ' + key + '\n'
+    def row (*keys):
+        return (' '.join(str(c[k]) for k in keys) + '  ! ' +
+                ', '.join(keys) + '\n')
+
+    out = [c['mesh'] + '\n', c['description'] + '\n']
+    for key in ('NFOVER', 'NABOUT', 'NSCREEN', 'IHOT', 'ICS', 'IM',
+                'NOLIBF', 'NOLIFA', 'NOLICA', 'NOLICAT'):
+        out.append(val(key))
+    out.append(str(len(c['node attrib'])) + '  ! NWP\n')
+    out += [a + '\n' for a in c['node attrib']]
+    for key in ('NCOR', 'NTIP', 'NWS', 'NRAMP', 'G', 'TAU0', 'DT',
+                'STATIM', 'REFTIM'):
+        out.append(val(key))
+    out.append(row('WTIMINC_Year', 'WTIMINC_Month', 'WTIMINC_Day',
+                   'WTIMINC_Param1', 'WTIMINC_Param2', 'WTIMINC_Param3'))
+    out += [val('RNDAY'), val('DRAMP'),
+            row('TWF_GWCE_Param1', 'TWF_GWCE_Param2', 'TWF_GWCE_Param3'),
+            row('H0', 'NODEDRYMIN', 'NODEWETRMP', 'VELMIN'),
+            row('SLAM0', 'SFEA0'),
+            val('FFACTOR'), val('ESL'), val('CORI')]
+
+    out.append(str(len(t['TIPOTAG_name'])) + '  ! NTIF\n')
+    for n, name in enumerate(t['TIPOTAG_name']):
+        out.append(name + '\n')
+        out.append(' '.join(str(t[k][n]) for k in
+                            ('TPK', 'AMIGT', 'ETRF', 'FFT', 'FACET')) + '\n')
+    out.append(str(len(t['BOUNDTAG_name'])) + '  ! NBFR\n')
+    for n, name in enumerate(t['BOUNDTAG_name']):
+        out.append(name + '\n')
+        out.append(' '.join(str(t[k][n]) for k in
+                            ('AMIG', 'FF', 'FACE')) + '\n')
+
+    forcing = np.asarray(t['EMOEFA'], dtype=float)
+    line    = fmt + ' ' + fmt + '\n'
+    for n, name in enumerate(t['ALPHA']):
+        out.append(name + '\n')
+        out.append((line*forcing.shape[1]) % tuple(forcing[n].ravel().tolist()))
+
+    with open(fort15file, 'w') as f:
+        f.writelines(out)
+        f.writelines(fort15['tail'])
+    return None
+
+#==============================================================================
+def writeOffset63 ( val, offset63file, note=None, precision=None,
+                    timeInc=1.0, default=1.0, verbose=1 ):
     """
     Writes ADCIRC offset.63 file in ASCII format
     for use with pseudo pressure loading option
     Args:
-        val (float)        : Array of gridded values 
+        val (float)        : Array of gridded values [NP], or of several
+                             offset records [NR, NP]
         offset63file (str) : Full path to the output file
+        note (str)         : header comment
+        precision (int)    : decimals to write (default: shortest repr,
+                             as str(value))
+        timeInc (float)    : time increment between records (s)
+        default (float)    : default value
     Note:
-        val should be the same size and order as your grid vectors
+        val should be the same size and order as your grid vectors;
+        records are separated by '##' lines
     """
-    msg( 'i','Writing Offset63 file...')
-    f = open(offset63file,'w')
-    if note is None:
-        f.write("# ADCIRC Offset file\n")
-    else:
-        f.write("# " + note + "\n")
-    f.write("1.0\n")  # ADCIRC Version 55
-    f.write("1.0\n")    
-    for n in range(len(val)):
-        f.write(str(n+1) + ' ' + str(val[n]) + '\n')
-    f.close()
+    if verbose:
+        msg( 'i','Writing Offset63 file...')
+    # values keep their own type, so that they print as str(val[n]) did
+    val = np.asarray(val)
+    records = val.reshape(1, -1) if val.ndim < 2 else val
+    vfmt = '%s' if precision is None else '%.' + str(int(precision)) + 'f'
+    rows = 65536
+    with open(offset63file, 'w', buffering=8*1024**2) as f:
+        if note is None:
+            f.write("# ADCIRC Offset file\n")
+        else:
+            f.write("# " + note + "\n")
+        f.write(str(timeInc) + "\n")  # ADCIRC Version 55
+        f.write(str(default) + "\n")
+        for r, rec in enumerate(records):
+            if r:
+                f.write("##\n")
+            NP = len(rec)
+            for n0 in range(0, NP, rows):
+                n1   = min(n0 + rows, NP)
+                node = np.arange(n0 + 1, n1 + 1)
+                pairs = np.empty(2*(n1 - n0), dtype=object)
+                pairs[0::2] = node.tolist()
+                pairs[1::2] = rec[n0:n1].astype(str).tolist() \
+                              if precision is None else rec[n0:n1].tolist()
+                f.write((('%d ' + vfmt + '\n')*(n1 - n0)) % tuple(pairs))
     return None
 
 #==============================================================================
-def readOffset63 ( offset63file):
-    msg( 'e','readOffset63() is not yet implemented.')
-    return None
+def readOffset63 ( offset63file, NP=None, verbose=1 ):
+    """
+    Reads ADCIRC offset.63 file (as written by writeOffset63)
+    Args:
+        offset63file (str) : Full path to the file
+        NP (int)           : number of grid nodes (default: largest node
+                             number in the file); nodes missing from
+                             a record take the default value
+    Returns:
+        dict: 'note', 'timeInc', 'default',
+              'value' (np.array [NP] in node order, or [NR, NP]
+              for several records)
+    """
+    if verbose:
+        msg( 'i','Reading Offset63 file ' + offset63file)
+    if not os.path.exists (offset63file):
+        msg( 'e','File ' + offset63file + ' does not exist.')
+        return
+    with open(offset63file, 'rb') as f:
+        note    = f.readline().decode(errors='replace').strip().lstrip('#')
+        timeInc = float(f.readline().split()[0])
+        default = float(f.readline().split()[0])
+        data    = f.read()
+
+    # records are separated by comment lines
+    records = [r for r in re.split(rb'(?m)^[ \t]*#.*$', data) if r.strip()]
+    blocks  = [np.loadtxt(io.BytesIO(r), usecols=(0, 1), ndmin=2)
+               for r in records]
+    if NP is None:
+        NP = int(max([b[:,0].max() for b in blocks] + [0]))
+    value = np.full([len(blocks), NP], default)
+    for r, block in enumerate(blocks):
+        value[r, block[:,0].astype(int) - 1] = block[:,1]
+    NR = len(blocks)
+    return {'note'    : note.strip(),
+            'timeInc' : timeInc,
+            'default' : default,
+            'value'   : value[0] if NR == 1 else value}
 
 
 
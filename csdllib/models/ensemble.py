@@ -0,0 +1,207 @@
+"""
+Ensemble statistics of ADCIRC surface fields (e.g. zeta_max from
+maxele.63.nc) across many runs.
+
+Members are consumed one at a time: per-node mean, spread (std),
+min/max (with the member they come from) are kept as running moments
+(adcirc.FieldStats), exceedance probabilities as running counts, so
+memory does not grow with the number of members. Exact percentiles
+take a second pass over the members, node chunk by node chunk, each
+chunk holding all members of a bounded number of nodes.
+
+@author: grapesh@gmail.com
+"""
+
+import os
+import numpy as np
+import netCDF4
+from csdllib.oper.sys import msg
+from csdllib.models.adcirc import FieldStats, splitRange
+
+#==============================================================================
+def readMember (ncFile, ncVar='zeta_max', nodes=None):
+    """
+    Reads member field as a plain float np.array [NP] (or the node range
+    nodes=(start, end)), NaN for missing values. For fields with a time
+    dimension the last record is used.
+    """
+    nc  = netCDF4.Dataset (ncFile)
+    var = nc.variables[ncVar]
+    var.set_auto_mask(False)
+    n0, n1 = nodes if nodes is not None else (0, var.shape[-1])
+    if var.ndim > 1:
+        val = var[-1, n0:n1]
+    else:
+        val = var[n0:n1]
+    missingVal = getattr(var, '_FillValue', None)
+    nc.close()
+    val = np.array(val, dtype=float)
+    if missingVal is not None:
+        val[val == missingVal] = np.nan
+    return val
+
+#==============================================================================
+class Ensemble (object):
+    """
+    Running ensemble statistics over members added one at a time
+    Args:
+        NP         (int)   : number of nodes
+        thresholds (list)  : levels for the exceedance probabilities
+        stats      (tuple) : statistics of FieldStats to keep
+    """
+    def __init__ (self, NP, thresholds=(), stats=FieldStats.STATS):
+        self.NP         = NP
+        self.thresholds = np.asarray(thresholds, dtype=float).ravel()
+        self.members    = 0
+        self.moments    = FieldStats(NP, stats)
+        self.exceed     = np.zeros([len(self.thresholds), NP], dtype=np.int64)
+
+    def add (self, values, member=None):
+        """
+        Adds one member field (np.array [NP], NaN where missing)
+        member is its number, recorded for the member of max/min
+        (default: the order of addition)
+        """
+        values = np.array(values, dtype=float).ravel()
+        if len(values) != self.NP:
+            raise ValueError('Member has ' + str(len(values)) +
+                             ' nodes, ensemble has ' + str(self.NP))
+        if member is None:
+            member = self.members
+        with np.errstate(invalid='ignore'):
+            for k, level in enumerate(self.thresholds):
+                self.exceed[k] += values > level
+        self.moments.update(values[None,:], member)
+        self.members += 1
+
+    def merge (self, other):
+        """
+        Merges ensemble statistics of other members of the same nodes
+        """
+        self.moments.merge(other.moments)
+        self.exceed  += other.exceed
+        self.members += other.members
+        return self
+
+    def result (self):
+        """
+        Returns:
+            dict: 'members', 'count' (members valid at the node) and
+            'mean', 'std' (spread), 'max', 'member_of_max', 'min',
+            'member_of_min' as kept; with thresholds, 'thresholds' and
+            'exceedance' (np.array [len(thresholds), NP]) - fraction of
+            all members above the level (missing counts as not above)
+        """
+        out = self.moments.result()
+        for name in ('max', 'min'):
+            if 'time_of_' + name in out:
+                out['member_of_' + name] = out.pop('time_of_' + name)
+        out['members'] = self.members
+        if len(self.thresholds):
+            out['thresholds'] = self.thresholds
+            out['exceedance'] = self.exceed/float(max(self.members, 1))
+        return out
+
+#==============================================================================
+def ingest (files, first, NP, ncVar, thresholds, stats):
+    """
+    Adds members files (numbered from first) to a new Ensemble
+    (runs in worker processes of aggregate)
+    """
+    ens = Ensemble(NP, thresholds, stats)
+    for m, ncFile in enumerate(files):
+        ens.add(readMember(ncFile, ncVar), first + m)
+    return ens
+
+#==============================================================================
+def nodePercentiles (files, ncVar, q, nodes, step):
+    """
+    Exact percentiles q of the members over nodes=(start, end),
+    reading step nodes of all members at a time
+    Returns:
+        float np.array [len(q), end-start]
+    """
+    out = np.full([len(q), nodes[1] - nodes[0]], np.nan)
+    for n0 in range(nodes[0], nodes[1], step):
+        n1    = min(n0 + step, nodes[1])
+        block = np.empty([len(files), n1 - n0])
+        for m, ncFile in enumerate(files):
+            block[m] = readMember(ncFile, ncVar, (n0, n1))
+        valid = np.any(~np.isnan(block), axis=0)
+        if np.any(valid):
+            out[:, n0-nodes[0]:n1-nodes[0]][:, valid] = \
+                np.nanpercentile(block[:, valid], q, axis=0)
+    return out
+
+#==============================================================================
+def aggregate (files, ncVar='zeta_max', thresholds=(), percentiles=(),
+               stats=FieldStats.STATS, chunkBytes=256*1024**2,
+               workers=1, verbose=1):
+    """
+    Computes per-node ensemble statistics of the member files
+    Args:
+        files       (list)  : member netCDF files (e.g. maxele.63.nc)
+        ncVar       (str)   : name of netCDF field (default='zeta_max')
+        thresholds  (list)  : levels for exceedance probabilities
+        percentiles (list)  : percentiles (0..100) to compute exactly
+        stats       (tuple) : moments to compute, see adcirc.FieldStats
+        chunkBytes  (int)   : memory for one node chunk of all members
+                              in the percentile pass
+        workers     (int)   : number of processes ingesting members
+                              (and node chunks of the percentile pass)
+    Returns:
+        dict: see Ensemble.result(), plus 'lon', 'lat', 'variable' and,
+              with percentiles, 'percentiles' and 'percentile_values'
+              (np.array [len(percentiles), NP])
+    """
+    files = list(files)
+    if not len(files):
+        msg( 'e','No ensemble members.')
+        return
+    for ncFile in files:
+        if not os.path.exists (ncFile):
+            msg( 'e','File ' + ncFile + ' does not exist.')
+            return
+    if verbose:
+        msg( 'i','Aggregating [' + ncVar + '] over ' + str(len(files)) +
+             ' members.')
+
+    nc  = netCDF4.Dataset (files[0])
+    NP  = nc.variables[ncVar].shape[-1]
+    lon = nc.variables['x'][:]
+    lat = nc.variables['y'][:]
+    nc.close()
+
+    workers = max(1, min(int(workers), len(files)))
+    step    = int(max(1, chunkBytes // (8*len(files))))
+    q       = np.asarray(percentiles, dtype=float).ravel()
+    if workers == 1:
+        ens = ingest(files, 0, NP, ncVar, thresholds, stats)
+        if len(q):
+            pct = nodePercentiles(files, ncVar, q, (0, NP), step)
+    else:
+        import concurrent.futures
+        with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+            jobs = [pool.submit(ingest, files[a:b], a, NP, ncVar,
+                                thresholds, stats)
+                    for a, b in splitRange(len(files), workers)]
+            if len(q):
+                # every worker holds a chunk of all members
+                pjobs = [pool.submit(nodePercentiles, files, ncVar, q, n,
+                                     max(1, step // workers))
+                         for n in splitRange(NP, workers)]
+            # merged in member order, so results are deterministic
+            ens = jobs[0].result()
+            for j in jobs[1:]:
+                ens.merge(j.result())
+            if len(q):
+                pct = np.concatenate([j.result() for j in pjobs], axis=1)
+
+    out = ens.result()
+    if len(q):
+        out['percentiles']       = q
+        out['percentile_values'] = pct
+    out.update({'lon'      : lon,
+                'lat'      : lat,
+                'variable' : ncVar})
+    return out
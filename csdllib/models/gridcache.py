@@ -0,0 +1,359 @@
+"""
+On-disk cache of parsed ADCIRC grids.
+
+Each cached grid lives in its own entry directory named after a key built
+from the fort.14 path, size, modification time and (optionally) a hash of
+its content. Arrays are stored as .npy files and opened memory-mapped,
+so a cache hit costs a few file opens and no parsing or copying.
+Other products derived from the same grid (e.g. topology tables) can be
+stored in the same entry with store() and fetch(). Interpolation operators
+(methods.weights) are kept under the operators/ directory and count
+towards the cache size like the grid entries.
+
+@author: grapesh@gmail.com
+"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+from csdllib.oper.sys import msg
+
+FORMAT      = 2
+SOURCE_FILE = 'source.json'
+META_FILE   = 'meta.json'
+OPERATORS   = 'operators'
+MAX_BYTES   = 20*1024**3
+
+#==============================================================================
+def getCacheDir (cacheDir=None):
+    """
+    Returns the cache directory: cacheDir if given, otherwise
+    $CSDLLIB_CACHE, otherwise ~/.cache/csdllib
+    """
+    if cacheDir is None:
+        cacheDir = os.environ.get('CSDLLIB_CACHE',
+                        os.path.join(os.path.expanduser('~'),
+                                     '.cache', 'csdllib'))
+    os.makedirs(cacheDir, exist_ok=True)
+    return cacheDir
+
+#==============================================================================
+def fileHash (fileName, blockSize=8*1024**2):
+    """
+    Returns hex digest of the file content
+    """
+    h = hashlib.blake2b(digest_size=20)
+    with open(fileName, 'rb') as f:
+        for block in iter(lambda: f.read(blockSize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+#==============================================================================
+def gridKey (gridFile, contentHash=False):
+    """
+    Returns cache key of the grid file built from its absolute path,
+    size, modification time and, if contentHash, a hash of its content.
+    """
+    st   = os.stat(gridFile)
+    path = os.path.abspath(gridFile)
+    h    = hashlib.blake2b(digest_size=20)
+    h.update((path + '|' + str(st.st_size) + '|' +
+              str(st.st_mtime_ns)).encode())
+    if contentHash:
+        h.update(fileHash(gridFile).encode())
+    return h.hexdigest()
+
+#==============================================================================
+def entryPath (gridFile, cacheDir=None, contentHash=False):
+    """
+    Returns the directory of the cache entry for gridFile
+    """
+    return os.path.join(getCacheDir(cacheDir),
+                        gridKey(gridFile, contentHash))
+
+#==============================================================================
+def store (gridFile, product, arrays, meta=None,
+           cacheDir=None, contentHash=False, maxBytes=MAX_BYTES):
+    """
+    Stores a set of named arrays (and json-serializable metadata)
+    as the 'product' of the cache entry of gridFile.
+    Args:
+        gridFile (str)  : full path to the fort.14 the product derives from
+        product  (str)  : name of the product, e.g. 'grid'
+        arrays   (dict) : name -> np.array
+        meta     (dict) : scalars to keep along with the arrays
+        maxBytes (int)  : cache size limit enforced after storing
+                          (None to skip eviction)
+    Returns:
+        path (str) : directory of the stored product
+    """
+    entry = entryPath(gridFile, cacheDir, contentHash)
+    os.makedirs(entry, exist_ok=True)
+    st = os.stat(gridFile)
+    # written aside and renamed, so that readers never see a partial file
+    fd, src = tempfile.mkstemp(dir=entry, prefix='.' + SOURCE_FILE + '.')
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'path'  : os.path.abspath(gridFile),
+                   'size'  : st.st_size,
+                   'mtime' : st.st_mtime_ns}, f)
+    os.replace(src, os.path.join(entry, SOURCE_FILE))
+
+    tmp = tempfile.mkdtemp(dir=entry, prefix='.' + product + '.')
+    for name, value in arrays.items():
+        np.save(os.path.join(tmp, name + '.npy'), np.asarray(value),
+                allow_pickle=False)
+    info = {'format' : FORMAT,
+            'arrays' : sorted(arrays.keys()),
+            'meta'   : meta or {}}
+    with open(os.path.join(tmp, META_FILE), 'w') as f:
+        json.dump(info, f)
+
+    path = os.path.join(entry, product)
+    publish(tmp, path, keep=readInfo(path) is not None)
+
+    if maxBytes is not None:
+        evict(cacheDir, maxBytes, keep=entry)
+    return path
+
+#==============================================================================
+def publish (tmp, path, keep=False):
+    """
+    Moves the product directory tmp, written aside in the same parent
+    directory, to path, so that readers never see a partial product.
+    Args:
+        tmp  (str)  : directory holding the complete new product
+        path (str)  : final directory of the product
+        keep (bool) : the product at path is valid, keep it and discard tmp
+    Returns:
+        path (str)
+    """
+    if keep:
+        # same key, same source: another process has stored it already
+        shutil.rmtree(tmp, ignore_errors=True)
+        return path
+    parent, name = os.path.split(os.path.abspath(path))
+    old = None
+    if os.path.exists(path):
+        # move the stale product out of the way; another process
+        # may have done it already
+        old = tempfile.mkdtemp(dir=parent, prefix='.' + name + '.old.')
+        try:
+            os.rename(path, os.path.join(old, name))
+        except OSError:
+            pass
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        # another process has just stored the same product, use it
+        shutil.rmtree(tmp, ignore_errors=True)
+    if old is not None:
+        shutil.rmtree(old, ignore_errors=True)
+    return path
+
+#==============================================================================
+def readInfo (path):
+    """
+    Returns metadata of the stored product at path,
+    None if there is no valid product of the current format
+    """
+    try:
+        with open(os.path.join(path, META_FILE)) as f:
+            info = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if info.get('format') != FORMAT:
+        return None
+    return info
+
+#==============================================================================
+def fetch (gridFile, product, cacheDir=None, contentHash=False):
+    """
+    Opens the 'product' of the cache entry of gridFile.
+    Returns:
+        (arrays, meta) : read-only memory-mapped arrays and metadata,
+                         or None if the product is not cached
+    """
+    entry = entryPath(gridFile, cacheDir, contentHash)
+    path  = os.path.join(entry, product)
+    info  = readInfo(path)
+    if info is None:
+        return None
+    arrays = dict()
+    try:
+        for name in info['arrays']:
+            arrays[name] = np.load(os.path.join(path, name + '.npy'),
+                                   mmap_mode='r', allow_pickle=False)
+    except (IOError, OSError, ValueError):
+        # replaced or evicted by another process meanwhile
+        return None
+    touch(entry)
+    return arrays, info['meta']
+
+#==============================================================================
+def touch (entry, fileName=SOURCE_FILE):
+    """
+    Marks cache entry as recently used
+    (operators are marked by their META_FILE)
+    """
+    try:
+        os.utime(os.path.join(entry, fileName), None)
+    except OSError:
+        pass
+
+#==============================================================================
+def dirSize (path):
+    """
+    Returns total size (bytes) of the files under path
+    """
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for fn in files:
+            try:
+                size += os.path.getsize(os.path.join(root, fn))
+            except OSError:
+                pass
+    return size
+
+#==============================================================================
+def entries (cacheDir=None):
+    """
+    Lists cache entries, including saved interpolation operators
+    (their 'source' is None)
+    Returns:
+        list of dicts: 'path', 'source', 'size' (bytes), 'atime' (last use)
+    """
+    cacheDir = getCacheDir(cacheDir)
+    out = []
+    for name in os.listdir(cacheDir):
+        entry = os.path.join(cacheDir, name)
+        src   = os.path.join(entry, SOURCE_FILE)
+        if not os.path.isfile(src):
+            continue
+        try:
+            with open(src) as f:
+                source = json.load(f)['path']
+        except (IOError, ValueError, KeyError):
+            source = None
+        size = dirSize(entry)
+        try:
+            atime = os.path.getmtime(src)
+        except OSError:
+            continue
+        out.append({'path'   : entry,
+                    'source' : source,
+                    'size'   : size,
+                    'atime'  : atime})
+
+    opDir = os.path.join(cacheDir, OPERATORS)
+    if os.path.isdir(opDir):
+        for name in os.listdir(opDir):
+            if name.startswith('.'):
+                # being written or replaced
+                continue
+            entry = os.path.join(opDir, name)
+            try:
+                atime = os.path.getmtime(os.path.join(entry, META_FILE))
+            except OSError:
+                continue
+            out.append({'path'   : entry,
+                        'source' : None,
+                        'size'   : dirSize(entry),
+                        'atime'  : atime})
+    return out
+
+#==============================================================================
+def evict (cacheDir=None, maxBytes=MAX_BYTES, keep=None):
+    """
+    Removes least recently used entries until the cache fits in maxBytes.
+    The entry directory 'keep' (e.g. the one just written) is never removed.
+    Returns:
+        number of removed entries
+    """
+    items = sorted(entries(cacheDir), key=lambda e: e['atime'])
+    total = sum(e['size'] for e in items)
+    count = 0
+    for e in items:
+        if total <= maxBytes:
+            break
+        if keep is not None and \
+                os.path.abspath(e['path']) == os.path.abspath(keep):
+            continue
+        shutil.rmtree(e['path'], ignore_errors=True)
+        total -= e['size']
+        count += 1
+    return count
+
+#==============================================================================
+def invalidate (gridFile, cacheDir=None, keep=None):
+    """
+    Removes all cache entries made from gridFile, whatever its
+    size or modification time were at the moment of caching.
+    The entry directory 'keep' (e.g. the one of the current key, that
+    other processes may be writing into) is never removed.
+    Returns:
+        number of removed entries
+    """
+    path  = os.path.abspath(gridFile)
+    count = 0
+    for e in entries(cacheDir):
+        if e['source'] == path and not (keep is not None and
+                os.path.abspath(e['path']) == os.path.abspath(keep)):
+            shutil.rmtree(e['path'], ignore_errors=True)
+            count += 1
+    return count
+
+#==============================================================================
+def clear (cacheDir=None):
+    """
+    Removes all cache entries
+    """
+    count = 0
+    for e in entries(cacheDir):
+        shutil.rmtree(e['path'], ignore_errors=True)
+        count += 1
+    return count
+
+#==============================================================================
+def readGrid (gridFile, cacheDir=None, contentHash=False,
+              maxBytes=MAX_BYTES, verbose=1):
+    """
+    Reads ADCIRC grid through the cache: parses gridFile with
+    adcirc.readGrid on the first call and stores the result,
+    later calls open the cached arrays memory-mapped.
+    Args:
+        gridFile    (str)  : full path to fort.14 file
+        cacheDir    (str)  : cache directory (default: see getCacheDir)
+        contentHash (bool) : also key the entry by a hash of the file
+        maxBytes    (int)  : cache size limit, LRU entries are evicted
+    Returns:
+        grid (adcirc.Grid) : same as adcirc.readGrid, arrays are read-only
+    """
+    from csdllib.models import adcirc
+
+    if not os.path.exists (gridFile):
+        msg( 'error', 'File ' + gridFile + ' does not exist.')
+        return
+
+    t0  = time.time()
+    hit = fetch(gridFile, 'grid', cacheDir, contentHash)
+    if hit is not None:
+        arrays, meta = hit
+        if verbose:
+            msg( 'i','Opened cached grid for ' + gridFile + ' in ' +
+                 str(round(time.time()-t0, 3)) + ' s.')
+        return adcirc.unpackGrid(arrays, meta, gridFile)
+
+    grid = adcirc.readGrid(gridFile, verbose)
+    if grid is None:
+        return
+    invalidate(gridFile, cacheDir,
+               keep=entryPath(gridFile, cacheDir, contentHash))
+    arrays, meta = adcirc.packGrid(grid)
+    store(gridFile, 'grid', arrays, meta, cacheDir, contentHash, maxBytes)
+    if verbose:
+        msg( 'i','Cached grid ' + gridFile + '.')
+    return grid
@@ -5,9 +5,6 @@ Created on Thu Mar 16 10:02:14 2017
 @author: grapesh@gmail.com
 """
 import os
-import numpy as np
-from datetime import datetime
-from datetime import timedelta
 import csdllib
 import netCDF4
 import csv 
@@ -20,11 +17,13 @@ def readStations (f, fields):
     return csdllib.data.parse.csvTable (f, fields)
 
 #==============================================================================
-def readTimeSeries (ncFile, stationsList, stationsFields, ncVar = 'elev', verbose=1):
+def readTimeSeries (ncFile, stationsList, stationsFields, ncVar = 'elev', verbose=1,
+                    legacyTime=False):
     """
     Reads time series of the variable stored in netCDF file.
     Requires 'stationsList' and 'stationsFields' lists, 
     as it is read by nyhops.readStations()
+    'time' is datetime64[s], or datetime objects if legacyTime.
     """
     if verbose:
         csdllib.oper.sys.msg('i', 'Reading [' + ncVar + '] from ' + ncFile)
@@ -46,11 +45,8 @@ def readTimeSeries (ncFile, stationsList, stationsFields, ncVar = 'elev', verbos
         stations.append ( s [ stationsFields.index('station_name') ] )
         ids.append ( s [ stationsFields.index('nosid') ] )
 	
-    baseDate = datetime.strptime(nc.variables['time'].base_date[0:19],
-                                 '%Y-%m-%d %H:%M:%S')
-    realtime = np.array([baseDate + 
-                         timedelta(seconds=int(tim[i])) 
-                         for i in range(len(tim))])
+    baseDate = csdllib.oper.sys.parseBaseDate(nc.variables['time'].base_date)
+    realtime = csdllib.oper.sys.decodeTime(tim, baseDate, legacyTime)
 						 
     return  {'lat'       : lat, 
 	         'lon'       : lon,
@@ -3,6 +3,8 @@
 """
 
 import datetime
+import functools
+import numpy as np
 from configparser import ConfigParser
 import io, sys
 
@@ -36,6 +38,47 @@ def timeToStamp (date):
     SE   = str(date.second).zfill(2)
     return YYYY+MM+DD+HH+MI+SE
 #==============================================================================
+@functools.lru_cache(maxsize=64)
+def parseBaseDate (baseDate):
+    """
+    Parses base_date attribute of a netCDF time variable,
+    e.g. '2019-08-01 00:00:00' (seconds or time may be missing).
+    Results are cached, as every reader of a file set sees the same one.
+    Returns:
+        datetime
+    """
+    d = baseDate.decode() if isinstance(baseDate, bytes) else str(baseDate)
+    d = d[0:19].replace('T', ' ').strip()
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M',
+                '%Y-%m-%d %H', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(d, fmt)
+        except ValueError:
+            pass
+    raise ValueError('Cannot parse base date ' + d)
+
+#==============================================================================
+def decodeTime (tim, baseDate, legacy=False):
+    """
+    Converts model time (seconds since baseDate) to dates in one
+    vectorized operation. Fractional seconds are truncated, as before.
+    Args:
+        tim      (np.array) : seconds since baseDate
+        baseDate (datetime or str) : reference date or base_date attribute
+        legacy   (bool) : return np.array of datetime objects
+                          instead of datetime64[s]
+    Returns:
+        np.array of datetime64[s] (or of datetime if legacy)
+    """
+    if not isinstance(baseDate, datetime.datetime):
+        baseDate = parseBaseDate(baseDate)
+    sec  = np.asarray(np.ma.getdata(tim), dtype=float).astype(np.int64)
+    time = np.datetime64(baseDate, 's') + sec.astype('timedelta64[s]')
+    if legacy:
+        return time.astype(object)
+    return time
+
+#==============================================================================
 def msg (msgType, msge, out=sys.stdout):
     '''
     Customize standard I/O here.
@@ -0,0 +1,49 @@
+"""
+writeOffset63 output against the original element-by-element writer
+
+@author: grapesh@gmail.com
+"""
+import numpy as np
+import pytest
+from csdllib.models import adcirc
+
+#==============================================================================
+def legacyWriteOffset63 (val, offset63file, note=None):
+    """
+    The writer before vectorization
+    """
+    f = open(offset63file,'w')
+    if note is None:
+        f.write("# ADCIRC Offset file\n")
+    else:
+        f.write("# " + note + "\n")
+    f.write("1.0\n")
+    f.write("1.0\n")
+    for n in range(len(val)):
+        f.write(str(n+1) + ' ' + str(val[n]) + '\n')
+    f.close()
+
+#==============================================================================
+@pytest.mark.parametrize('val', [
+    np.array([0.1, 1.7, -2.25, 1e-5, 3e7, 0.], dtype=np.float32),
+    np.random.default_rng(0).normal(size=70000).astype(np.float32),
+    np.array([0, 3, -12, 100000], dtype=np.int32),
+    np.arange(-50000, 50000, 7, dtype=np.int64),
+    np.array([0.1, 1.7, -2.25, 1e-5, 3e16, 0.]),
+    ])
+def test_write_matches_legacy (tmp_path, val):
+    old = tmp_path / 'old.63'
+    new = tmp_path / 'new.63'
+    legacyWriteOffset63(val, str(old), note='test')
+    adcirc.writeOffset63(val, str(new), note='test', verbose=0)
+    assert new.read_bytes() == old.read_bytes()
+
+#==============================================================================
+def test_float32_round_trip (tmp_path):
+    val = np.array([0.1, 1.7], dtype=np.float32)
+    path = str(tmp_path / 'offset.63')
+    adcirc.writeOffset63(val, path, verbose=0)
+    with open(path) as f:
+        assert f.read().splitlines()[3:] == ['1 0.1', '2 1.7']
+    out = adcirc.readOffset63(path, verbose=0)
+    assert np.array_equal(out['value'].astype(np.float32), val)
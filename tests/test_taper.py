@@ -0,0 +1,47 @@
+"""
+Depth tapers on non-contiguous and list fields
+
+@author: grapesh@gmail.com
+"""
+import numpy as np
+from csdllib.methods import interp
+
+#==============================================================================
+def reference (z_full, z_zero, zg, vg):
+    """
+    Linear taper weights applied element by element
+    """
+    w = np.clip((np.asarray(zg) - z_zero)/(z_full - z_zero), 0., 1.)
+    return w*np.asarray(vg, dtype=float)
+
+#==============================================================================
+def test_transposed_in_place ():
+    rng = np.random.default_rng(0)
+    zg  = rng.uniform(0., 300., (40, 30))
+    vg  = rng.normal(size=(30, 40)).T          # not C-contiguous
+    ref = reference(10., 200., zg, vg)
+    out = interp.taperLinear(10., 200., zg, vg)
+    assert out is vg
+    assert np.allclose(vg, ref)
+
+#==============================================================================
+def test_strided_out ():
+    rng  = np.random.default_rng(1)
+    zg   = rng.uniform(0., 300., 500)
+    vg   = rng.normal(size=500)
+    buf  = np.zeros(1000)
+    interp.taper([('linear', 10., 200.)], zg, vg, out=buf[::2],
+                 blockSize=64)
+    assert np.allclose(buf[::2], reference(10., 200., zg, vg))
+    assert np.all(buf[1::2] == 0.)
+
+#==============================================================================
+def test_list_input ():
+    zg  = [0., 50., 100., 250.]
+    vg  = [1., 2., 3., 4.]
+    ref = reference(10., 200., zg, vg)
+    out = interp.taperLinear(10., 200., zg, vg)
+    assert np.allclose(out, ref)
+    assert np.allclose(vg, ref)
+    out = interp.taperExp(10., 200., zg, [1, 2, 3, 4])
+    assert isinstance(out, np.ndarray) and len(out) == 4